@@ -27,6 +27,9 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'uma_api.metrics.MetricsMiddleware',
+    'uma_api.slowQuery.SlowQueryMiddleware',
+    'uma_api.routers.DatabaseRoutingMiddleware',
     'corsheaders.middleware.CorsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
@@ -57,16 +60,74 @@ TEMPLATES = [
 
 WSGI_APPLICATION = 'config.wsgi.application'
 
+# DB_POOL=true の場合、プロセス内のコネクションプールから接続を借りる (CONN_MAX_AGE は0のままにする)
+DB_POOL = os.getenv('DB_POOL', 'false').lower() == 'true'
+
+# 永続接続の保持秒数 (空文字または none の場合は無期限)
+_conn_max_age = os.getenv('DB_CONN_MAX_AGE', '0').strip()
+
 DATABASES = {
     'default': {
-        'ENGINE': 'django.db.backends.postgresql',
+        'ENGINE': 'uma_api.db.backends.postgresql_pool' if DB_POOL else 'django.db.backends.postgresql',
         'NAME': os.getenv('POSTGRES_DB', 'umamusumeDB'),
         'USER': os.getenv('POSTGRES_USER', 'umamusumeDB_User'),
         'PASSWORD': os.getenv('POSTGRES_PASSWORD', 'umamusumeDB_Password'),
         'HOST': os.getenv('DB_HOST', 'db'),  # Docker環境では'db'、ローカルでは'localhost'
-        'PORT': '5432',
+        'PORT': os.getenv('DB_PORT', '5432'),
+        # 永続接続の保持秒数 (0:リクエストごとに切断、None:無期限)
+        'CONN_MAX_AGE': None if _conn_max_age.lower() in ('', 'none') else int(_conn_max_age),
+        # 永続接続を再利用する前に使用可能か確認する
+        'CONN_HEALTH_CHECKS': os.getenv('DB_CONN_HEALTH_CHECKS', 'true').lower() == 'true',
+        'POOL': {
+            'min_size': int(os.getenv('DB_POOL_MIN_SIZE', 0)),
+            'max_size': int(os.getenv('DB_POOL_MAX_SIZE', 10)),
+            'timeout': float(os.getenv('DB_POOL_TIMEOUT', 10)),
+            'max_idle': float(os.getenv('DB_POOL_MAX_IDLE', 300)),
+            'max_lifetime': float(os.getenv('DB_POOL_MAX_LIFETIME', 3600)),
+            'check_interval': float(os.getenv('DB_POOL_CHECK_INTERVAL', 30)),
+        },
+    }
+}
+
+# 読み込み用レプリカ (DB_REPLICA_HOST を指定した場合のみ)。参照のみのAPIの読み込みを振り分ける
+if os.getenv('DB_REPLICA_HOST'):
+    DATABASES['replica'] = {
+        **DATABASES['default'],
+        'HOST': os.getenv('DB_REPLICA_HOST'),
+        'PORT': os.getenv('DB_REPLICA_PORT', DATABASES['default']['PORT']),
+        # テストではプライマリのテストDBをそのまま使う
+        'TEST': {'MIRROR': 'default'},
+    }
+
+# ユーザー別データのシャード (DB_SHARD_HOSTS をカンマ区切りで指定した場合のみ)。マスタは全シャードに複製する
+_shard_hosts = [host for host in os.getenv('DB_SHARD_HOSTS', '').split(',') if host]
+for _index, _host in enumerate(_shard_hosts):
+    DATABASES[f'shard{_index}'] = {**DATABASES['default'], 'HOST': _host}
+UMA_SHARDS = [f'shard{index}' for index in range(len(_shard_hosts))] or ['default']
+
+DATABASE_ROUTERS = ['uma_api.routers.ShardRouter', 'uma_api.routers.ReplicaRouter']
+UMA_DB_REPLICA = 'replica'
+# 書き込んだユーザーの読み込みをプライマリに固定する秒数 (レプリカの遅延より長くする)
+UMA_DB_STICKY_SECONDS = int(os.getenv('DB_REPLICA_STICKY_SECONDS', 5))
+
+# キャッシュ (既定の file は同じホストのワーカー間で共有される。locmem はプロセスごとのため、
+# レスポンスキャッシュ・マスタのキャッシュは無効になり、レプリカとは併用できない)
+UMA_CACHE_BACKEND = os.getenv('UMA_CACHE_BACKEND', 'file')
+_cache_backends = {
+    'locmem': 'django.core.cache.backends.locmem.LocMemCache',
+    'file': 'django.core.cache.backends.filebased.FileBasedCache',
+}
+CACHES = {
+    'default': {
+        'BACKEND': _cache_backends[UMA_CACHE_BACKEND],
+        'LOCATION': os.getenv('UMA_CACHE_LOCATION', os.path.join(BASE_DIR, 'cache') if UMA_CACHE_BACKEND == 'file' else 'uma_api'),
+        'OPTIONS': {'MAX_ENTRIES': int(os.getenv('UMA_CACHE_MAX_ENTRIES', 10000))},
     }
 }
+# ユーザー別データのAPIレスポンスをキャッシュする秒数 (書き込み時はバージョン更新で即時に無効になる)
+UMA_RESPONSE_CACHE_SECONDS = int(os.getenv('UMA_RESPONSE_CACHE_SECONDS', 300))
+# マスタから作るAPIレスポンス・既定レースパターンをキャッシュする秒数 (load_data 実行時は即時に無効になる)
+UMA_CATALOG_CACHE_SECONDS = int(os.getenv('UMA_CATALOG_CACHE_SECONDS', 3600))
 
 AUTH_PASSWORD_VALIDATORS = [
     {'NAME': 'django.contrib.auth.password_validation.UserAttributeSimilarityValidator'},
@@ -83,12 +144,23 @@ USE_TZ = True
 STATIC_URL = 'static/'
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
+# UMA_JWT_STATELESS=true の場合、認証時にユーザーをDBから取得せずトークンのクレームから組み立てる
+UMA_JWT_STATELESS = os.getenv('UMA_JWT_STATELESS', 'true').lower() == 'true'
+
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': (
-        'rest_framework_simplejwt.authentication.JWTAuthentication',
+        'uma_api.authentication.StatelessJWTAuthentication' if UMA_JWT_STATELESS
+        else 'uma_api.authentication.DatabaseJWTAuthentication',
     ),
     'DEFAULT_PERMISSION_CLASSES': ['rest_framework.permissions.IsAuthenticated'],
-    'DEFAULT_RENDERER_CLASSES': ['rest_framework.renderers.JSONRenderer'],
+    # Accept・Content-Type が application/msgpack の場合は MessagePack で送受信する
+    'DEFAULT_RENDERER_CLASSES': ['rest_framework.renderers.JSONRenderer', 'uma_api.renderers.MessagePackRenderer'],
+    'DEFAULT_PARSER_CLASSES': [
+        'rest_framework.parsers.JSONParser',
+        'uma_api.parsers.MessagePackParser',
+        'rest_framework.parsers.FormParser',
+        'rest_framework.parsers.MultiPartParser',
+    ],
 }
 
 SIMPLE_JWT = {
@@ -97,6 +169,7 @@ SIMPLE_JWT = {
     'ROTATE_REFRESH_TOKENS': True,
     'USER_ID_FIELD': 'user_id',
     'USER_ID_CLAIM': 'user_id',
+    'TOKEN_USER_CLASS': 'uma_api.authentication.UmamusumeTokenUser',
 }
 
 CORS_ALLOWED_ORIGINS = ["http://localhost:3000", "http://127.0.0.1:3000"]
@@ -105,9 +178,63 @@ CORS_ALLOW_CREDENTIALS = True
 MEDIA_URL = '/media/'
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 
+# /metrics へのアクセスを許可するIP (カンマ区切り、未設定の場合はローカルホストのみ)
+UMA_METRICS_ALLOWED_IPS = [ip for ip in os.getenv('UMA_METRICS_ALLOWED_IPS', '127.0.0.1,::1').split(',') if ip]
+
+# 非同期APIのレースパターン生成に使うプール (thread または process) とワーカー数 (未設定の場合はCPU数)
+UMA_PATTERN_EXECUTOR = os.getenv('UMA_PATTERN_EXECUTOR', 'thread')
+UMA_PATTERN_WORKERS = int(os.getenv('UMA_PATTERN_WORKERS', 0)) or None
+# 1プロセスで同時に実行するレースパターン生成の上限 (未設定の場合はCPU数。同じ入力のリクエストは1回の生成結果を共有する)
+UMA_PATTERN_MAX_CONCURRENCY = int(os.getenv('UMA_PATTERN_MAX_CONCURRENCY', 0)) or None
+# レースパターン生成ジョブ: 結果の保持秒数、ワーカー停止とみなす実行秒数、ロングポーリング (非同期APIのみ) で待つ最大秒数、
+# 未完了のジョブの Retry-After 秒数
+UMA_PATTERN_JOB_TTL_SECONDS = int(os.getenv('UMA_PATTERN_JOB_TTL_SECONDS', 600))
+UMA_PATTERN_JOB_TIMEOUT_SECONDS = int(os.getenv('UMA_PATTERN_JOB_TIMEOUT_SECONDS', 300))
+UMA_PATTERN_JOB_MAX_WAIT_SECONDS = int(os.getenv('UMA_PATTERN_JOB_MAX_WAIT_SECONDS', 30))
+UMA_PATTERN_JOB_RETRY_AFTER_SECONDS = int(os.getenv('UMA_PATTERN_JOB_RETRY_AFTER_SECONDS', 2))
+
+# CPU負荷の高いAPI (レースパターン・残レース・因子計算) の受付制限
+# ユーザーごとのトークンバケット (1秒あたりの補充数・最大数) と、1プロセスの同時実行数 (未設定の場合はCPU数)
+UMA_ADMISSION_RATE = float(os.getenv('UMA_ADMISSION_RATE', 2))
+UMA_ADMISSION_BURST = int(os.getenv('UMA_ADMISSION_BURST', 10))
+UMA_ADMISSION_MAX_CONCURRENCY = int(os.getenv('UMA_ADMISSION_MAX_CONCURRENCY', 0)) or None
+# 同時実行数の上限で空きを待つ秒数 (超えると503) と、503の Retry-After 秒数
+UMA_ADMISSION_QUEUE_SECONDS = float(os.getenv('UMA_ADMISSION_QUEUE_SECONDS', 1))
+UMA_ADMISSION_RETRY_AFTER = int(os.getenv('UMA_ADMISSION_RETRY_AFTER', 1))
+# 前段のリバースプロキシ・ロードバランサーの段数 (未認証のリクエストは X-Forwarded-For のクライアントIPごとに制限する。0の場合は REMOTE_ADDR)
+UMA_TRUSTED_PROXY_COUNT = int(os.getenv('UMA_TRUSTED_PROXY_COUNT', 0))
+
+# 低速SQLログ: 閾値(ミリ秒、負の値で無効)と /api/monitor/slow-queries で返す上位件数
+UMA_SLOW_QUERY_MS = float(os.getenv('UMA_SLOW_QUERY_MS', 100))
+UMA_SLOW_QUERY_TOP_N = int(os.getenv('UMA_SLOW_QUERY_TOP_N', 20))
+
+# スタッフ向けプロファイル (X-Uma-Profile: 1 ヘッダー) の保存先
+UMA_PROFILE_DIR = os.getenv('UMA_PROFILE_DIR', os.path.join(BASE_DIR, 'profiles'))
+
+# ログ設定
+# UMA_LOG_MODE=queue の場合、キュー経由でバックグラウンドスレッドからJSON Lines形式で出力する
+UMA_LOG_MODE = os.getenv('UMA_LOG_MODE', 'sync')
+UMA_LOG_FILE = os.getenv('UMA_LOG_FILE', 'uma_api.log')
+# コンソール出力 (queueモードではリスナースレッドから出力し、既定では出力しない)
+UMA_LOG_PRINT = os.getenv('UMA_LOG_PRINT', 'false' if UMA_LOG_MODE == 'queue' else 'true').lower() == 'true'
+# DEBUG にするとレースパターン生成の処理内訳(トレース)も出力する
+UMA_LOG_LEVEL = os.getenv('UMA_LOG_LEVEL', 'INFO')
+
+if UMA_LOG_MODE == 'queue':
+    _uma_log_handler = {
+        'level': UMA_LOG_LEVEL,
+        '()': 'uma_api.utils.QueueListenerHandler',
+        'filename': UMA_LOG_FILE,
+        'max_bytes': int(os.getenv('UMA_LOG_MAX_BYTES', 10 * 1024 * 1024)),
+        'backup_count': int(os.getenv('UMA_LOG_BACKUP_COUNT', 5)),
+        'console': UMA_LOG_PRINT,
+    }
+else:
+    _uma_log_handler = {'level': UMA_LOG_LEVEL, 'class': 'logging.FileHandler', 'filename': UMA_LOG_FILE}
+
 LOGGING = {
     'version': 1,
     'disable_existing_loggers': False,
-    'handlers': {'file': {'level': 'INFO', 'class': 'logging.FileHandler', 'filename': 'uma_api.log'}},
-    'loggers': {'uma_api': {'handlers': ['file'], 'level': 'INFO', 'propagate': True}},
-}
\ No newline at end of file
+    'handlers': {'file': _uma_log_handler},
+    'loggers': {'uma_api': {'handlers': ['file'], 'level': UMA_LOG_LEVEL, 'propagate': True}},
+}
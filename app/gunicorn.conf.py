@@ -0,0 +1,69 @@
+# 本番用サーバー設定 (gunicorn)
+# 起動: gunicorn -c gunicorn.conf.py
+#
+# GUNICORN_WORKER_CLASS でワーカーを選択する。
+#   gthread (既定): WSGIで起動し、同期APIを1ワーカーあたり GUNICORN_THREADS 本のスレッドで並行処理する。
+#                   APIのほとんどは同期ビューのため、通常はこちらを使用する。
+#   uvicorn:        ASGIで起動し、/api/async/ 以下の非同期APIをイベントループで処理する。
+#                   同期ビューは sync_to_async でスレッドに受け渡して実行するため、1リクエストごとに
+#                   スレッド切り替えの負荷がかかり、同時実行数はイベントループのスレッドプールに制限される。
+#                   非同期APIを主に使う構成でのみ選択し、負荷試験で同期APIのスループットを確認すること。
+import multiprocessing
+import os
+
+bind = os.getenv('GUNICORN_BIND', '0.0.0.0:8000')
+
+_worker_kind = os.getenv('GUNICORN_WORKER_CLASS', 'gthread')
+if _worker_kind == 'uvicorn':
+    wsgi_app = 'config.asgi:application'
+    worker_class = 'uvicorn.workers.UvicornWorker'
+    # 非同期ワーカーは1プロセスで多数の接続を扱えるため、CPU数程度で十分
+    workers = int(os.getenv('GUNICORN_WORKERS', multiprocessing.cpu_count()))
+else:
+    wsgi_app = 'config.wsgi:application'
+    worker_class = 'gthread'
+    # レースパターン生成などCPU負荷の高い同期処理があるため、プロセス数はCPU数の2倍+1を目安にする
+    workers = int(os.getenv('GUNICORN_WORKERS', multiprocessing.cpu_count() * 2 + 1))
+    threads = int(os.getenv('GUNICORN_THREADS', 4))
+
+# レースパターン生成など重い処理を考慮したタイムアウト(秒)
+timeout = int(os.getenv('GUNICORN_TIMEOUT', 60))
+graceful_timeout = int(os.getenv('GUNICORN_GRACEFUL_TIMEOUT', 30))
+keepalive = int(os.getenv('GUNICORN_KEEPALIVE', 5))
+
+# メモリ断片化対策として一定リクエストごとにワーカーを再起動する
+max_requests = int(os.getenv('GUNICORN_MAX_REQUESTS', 10000))
+max_requests_jitter = int(os.getenv('GUNICORN_MAX_REQUESTS_JITTER', 1000))
+
+accesslog = '-'
+errorlog = '-'
+
+# 起動時にマスタのAPIレスポンス・既定レースパターンを作成しておく (初回リクエストの遅延対策)
+warm_caches_on_startup = os.getenv('UMA_WARM_CACHES_ON_STARTUP', 'false').lower() == 'true'
+
+
+def on_starting(server):
+    """マスタプロセスの起動時に1回だけ、共有キャッシュ・既定レースパターンを作成する
+    ワーカーごとに作成すると同じ既定レースパターンを重複して作成し、起動が timeout を超えてワーカーが停止されるため、
+    ワーカーを起動する前にマスタで作成する (既定レースパターンはCPU数のプロセスで並列に作成する)。
+    """
+    if not warm_caches_on_startup:
+        return
+    import django
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings')
+    django.setup()
+    from django.db import connections
+    from uma_api.catalog import warm_caches
+    for name, count, seconds in warm_caches():
+        server.log.info('warm_caches: %s %d件 %.2f秒', name, count, seconds)
+    # fork したワーカーがマスタのDB接続を共有しないよう、閉じておく
+    connections.close_all()
+
+
+def post_worker_init(worker):
+    """ワーカーの起動後に、プロセス内に保持するG1〜G3レース一覧・目安育成数を作成する (既定レースパターンは on_starting で作成済み)"""
+    if not warm_caches_on_startup:
+        return
+    from uma_api.catalog import warm_local_caches
+    for name, count, seconds in warm_local_caches():
+        worker.log.info('warm_local_caches: %s %d件 %.2f秒', name, count, seconds)
@@ -0,0 +1,214 @@
+import asyncio
+import math
+import os
+import threading
+import time
+from functools import wraps
+
+from django.conf import settings
+from rest_framework.response import Response
+
+from .metrics import REGISTRY
+from .renderers import render_response
+
+admission_count = REGISTRY.counter(
+    'uma_api_admission_total',
+    'CPU負荷の高いAPIの受付結果 (admitted: 受付 / queued: 空き待ち後に受付 / rate_limited: 429 / overloaded: 503)',
+    ('view', 'result'),
+)
+admission_in_flight = REGISTRY.gauge('uma_api_admission_in_flight', '実行中のCPU負荷の高いAPIの数')
+admission_queued = REGISTRY.gauge('uma_api_admission_queued', '同時実行数の上限で空きを待っているリクエスト数')
+
+RATE_LIMITED_MESSAGE = 'リクエストが多すぎます。しばらくしてから再度お試しください。'
+OVERLOADED_MESSAGE = 'サーバーが混み合っています。しばらくしてから再度お試しください。'
+
+
+class TokenBucket:
+    """ユーザーごとのトークンバケット (プロセス内)
+    UMA_ADMISSION_RATE 個/秒でトークンが補充され、最大 UMA_ADMISSION_BURST 個まで貯まる。
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._buckets = {}
+
+    def take(self, key):
+        """トークンを1つ消費する
+        * @param key ユーザーを表すキー
+        * @return float 消費できた場合は0、できなかった場合は次のトークンまでの秒数
+        """
+        rate = getattr(settings, 'UMA_ADMISSION_RATE', 2.0)
+        burst = getattr(settings, 'UMA_ADMISSION_BURST', 10)
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.get(key, (burst, now))
+            tokens = min(burst, tokens + (now - updated) * rate)
+            if tokens < 1:
+                self._buckets[key] = (tokens, now)
+                return (1 - tokens) / rate
+            self._buckets[key] = (tokens - 1, now)
+            if len(self._buckets) > getattr(settings, 'UMA_ADMISSION_MAX_KEYS', 10000):
+                self._prune(now, rate, burst)
+        return 0.0
+
+    def _prune(self, now, rate, burst):
+        """満タンまで補充されたバケットを削除する (削除しても次回は満タンから始まるため結果は変わらない)"""
+        self._buckets = {
+            key: (tokens, updated) for key, (tokens, updated) in self._buckets.items()
+            if tokens + (now - updated) * rate < burst
+        }
+
+    def clear(self):
+        with self._lock:
+            self._buckets.clear()
+
+
+class ConcurrencyLimiter:
+    """CPU負荷の高いAPIの同時実行数を UMA_ADMISSION_MAX_CONCURRENCY (未設定の場合はCPU数) までに制限する (プロセス内)"""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._limit = None
+        self._semaphore = None
+        self._in_flight = 0
+        self._queued = 0
+
+    def _get_semaphore(self):
+        limit = getattr(settings, 'UMA_ADMISSION_MAX_CONCURRENCY', None) or os.cpu_count()
+        with self._lock:
+            if self._limit != limit:
+                self._limit, self._semaphore = limit, threading.BoundedSemaphore(limit)
+            return self._semaphore
+
+    def _change(self, in_flight=0, queued=0):
+        with self._lock:
+            self._in_flight += in_flight
+            self._queued += queued
+            admission_in_flight.set(self._in_flight)
+            admission_queued.set(self._queued)
+
+    def acquire(self):
+        """空きがなければ UMA_ADMISSION_QUEUE_SECONDS 秒まで待って実行枠を取得する
+        * @return tuple (取得した実行枠 (取得できなかった場合はNone), 空きを待ったか)
+        """
+        semaphore = self._get_semaphore()
+        if semaphore.acquire(blocking=False):
+            self._change(in_flight=1)
+            return semaphore, False
+        self._change(queued=1)
+        try:
+            acquired = semaphore.acquire(timeout=getattr(settings, 'UMA_ADMISSION_QUEUE_SECONDS', 1.0))
+        finally:
+            self._change(queued=-1)
+        if not acquired:
+            return None, True
+        self._change(in_flight=1)
+        return semaphore, True
+
+    async def aacquire(self):
+        """acquire の非同期版 (イベントループを止めないよう、空きを短い間隔で確認する)"""
+        semaphore = self._get_semaphore()
+        if semaphore.acquire(blocking=False):
+            self._change(in_flight=1)
+            return semaphore, False
+        self._change(queued=1)
+        try:
+            deadline = time.monotonic() + getattr(settings, 'UMA_ADMISSION_QUEUE_SECONDS', 1.0)
+            acquired = False
+            while not acquired and time.monotonic() < deadline:
+                await asyncio.sleep(0.01)
+                acquired = semaphore.acquire(blocking=False)
+        finally:
+            self._change(queued=-1)
+        if not acquired:
+            return None, True
+        self._change(in_flight=1)
+        return semaphore, True
+
+    def release(self, semaphore):
+        """取得した実行枠を返す"""
+        semaphore.release()
+        self._change(in_flight=-1)
+
+
+token_bucket = TokenBucket()
+limiter = ConcurrencyLimiter()
+
+
+def get_client_ip(request):
+    """クライアントのIPアドレスを取得する
+    UMA_TRUSTED_PROXY_COUNT にリバースプロキシ・ロードバランサーの段数を指定した場合は、X-Forwarded-For の
+    右から その段数目 (信頼するプロキシが追加した値) を使う。それより左の値はクライアントが偽装できるため使わない。
+    * @param request HTTPリクエストオブジェクト
+    * @return str IPアドレス
+    """
+    remote_addr = request.META.get('REMOTE_ADDR', '')
+    proxy_count = getattr(settings, 'UMA_TRUSTED_PROXY_COUNT', 0)
+    forwarded_for = request.META.get('HTTP_X_FORWARDED_FOR')
+    if proxy_count <= 0 or not forwarded_for:
+        return remote_addr
+    hops = [hop.strip() for hop in forwarded_for.split(',') if hop.strip()]
+    if not hops:
+        return remote_addr
+    return hops[-min(proxy_count, len(hops))]
+
+
+def _client_key(request):
+    """トークンバケットのキー (認証済みの場合はユーザーID、未認証の場合はIPアドレス)"""
+    user = getattr(request, 'user', None)
+    user_id = getattr(user, 'user_id', None)
+    if user_id is not None:
+        return f'user:{user_id}'
+    return f'ip:{get_client_ip(request)}'
+
+
+def _retry_after(seconds):
+    return {'Retry-After': str(max(1, math.ceil(seconds)))}
+
+
+def admission_control(view_func):
+    """CPU負荷の高いAPIに、ユーザーごとのトークンバケットと同時実行数の制限を適用するデコレータ
+    トークンがない場合は429、同時実行数の上限で UMA_ADMISSION_QUEUE_SECONDS 秒待っても空かない場合は503を、
+    どちらも Retry-After を付けてすぐに返す。
+    api_view・permission_classes (キャッシュする場合は cache_user_response) の内側に付ける。非同期ビューにも使用できる。
+    * @param view_func ビュー関数
+    * @return ビュー関数
+    """
+    view_name = view_func.__name__
+    if asyncio.iscoroutinefunction(view_func):
+        # 同期版と同じ関数名のため、メトリクスでは区別する
+        view_name = f'async_{view_name}'
+
+        @wraps(view_func)
+        async def async_wrapper(request, *args, **kwargs):
+            wait = token_bucket.take(_client_key(request))
+            if wait:
+                admission_count.inc(view=view_name, result='rate_limited')
+                return render_response(request, {'error': RATE_LIMITED_MESSAGE}, status=429, headers=_retry_after(wait))
+            semaphore, queued = await limiter.aacquire()
+            if semaphore is None:
+                admission_count.inc(view=view_name, result='overloaded')
+                return render_response(request, {'error': OVERLOADED_MESSAGE}, status=503, headers=_retry_after(
+                    getattr(settings, 'UMA_ADMISSION_RETRY_AFTER', 1)))
+            admission_count.inc(view=view_name, result='queued' if queued else 'admitted')
+            try:
+                return await view_func(request, *args, **kwargs)
+            finally:
+                limiter.release(semaphore)
+        return async_wrapper
+
+    @wraps(view_func)
+    def wrapper(request, *args, **kwargs):
+        wait = token_bucket.take(_client_key(request))
+        if wait:
+            admission_count.inc(view=view_name, result='rate_limited')
+            return Response({'error': RATE_LIMITED_MESSAGE}, status=429, headers=_retry_after(wait))
+        semaphore, queued = limiter.acquire()
+        if semaphore is None:
+            admission_count.inc(view=view_name, result='overloaded')
+            return Response({'error': OVERLOADED_MESSAGE}, status=503, headers=_retry_after(
+                getattr(settings, 'UMA_ADMISSION_RETRY_AFTER', 1)))
+        admission_count.inc(view=view_name, result='queued' if queued else 'admitted')
+        try:
+            return view_func(request, *args, **kwargs)
+        finally:
+            limiter.release(semaphore)
+    return wrapper
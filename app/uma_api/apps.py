@@ -3,4 +3,15 @@ from django.apps import AppConfig
 
 class UmaApiConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
-    name = 'uma_api'
\ No newline at end of file
+    name = 'uma_api'
+    def ready(self):
+        # シャードへのユーザー複製のシグナルを登録する
+        from . import sharding  # noqa: F401
+
+        # メトリクス・低速SQLの集計用に、全DB接続 (スレッドごとに作られる接続を含む) でSQLを監視する
+        from django.db import connections
+        from django.db.backends.signals import connection_created
+        from .metrics import install_query_observers
+        connection_created.connect(install_query_observers, dispatch_uid='uma_api.install_query_observers')
+        for connection in connections.all(initialized_only=True):
+            install_query_observers(connection)
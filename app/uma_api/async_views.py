@@ -0,0 +1,340 @@
+import asyncio
+import math
+import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial, wraps
+
+import django
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth.models import AnonymousUser
+from django.core.handlers.asgi import ASGIRequest
+from rest_framework.exceptions import AuthenticationFailed
+from rest_framework.settings import api_settings
+from rest_framework_simplejwt.authentication import JWTStatelessUserAuthentication
+
+from .models import *
+from .serializers import *
+from .utils import UmamusumeLog
+from .parsers import parse_request_body
+from .renderers import render_response
+from .racePattern import aload_race_pattern_inputs, build_race_pattern_data, compact_race_pattern, is_default_race_pattern_inputs
+from .response_cache import get_data_version
+from .singleflight import pattern_flight
+from .admission import admission_control
+from .catalog import cache_default_race_pattern, get_default_breeding_counts, get_default_race_pattern, get_g_races
+from .pattern_jobs import await_pattern_job, get_retry_after
+from .race_views import (
+    build_remaining_results, get_race_list_queryset, parse_race_list_filters, parse_race_pattern_params, pattern_job_data,
+)
+from .tracing import Tracer, NULL_TRACER
+
+_pattern_executor = None
+
+
+def _init_pattern_worker():
+    """プロセスプールのワーカーでDjangoを初期化する (モデルの復元に必要)"""
+    django.setup()
+
+
+def get_pattern_executor():
+    """レースパターン生成を実行するプールを取得する
+    UMA_PATTERN_EXECUTOR が process の場合はプロセスプール、それ以外はスレッドプールを使用する。
+    * @return Executor プール
+    """
+    global _pattern_executor
+    if _pattern_executor is None:
+        workers = getattr(settings, 'UMA_PATTERN_WORKERS', None) or os.cpu_count()
+        if getattr(settings, 'UMA_PATTERN_EXECUTOR', 'thread') == 'process':
+            _pattern_executor = ProcessPoolExecutor(max_workers=workers, initializer=_init_pattern_worker)
+        else:
+            _pattern_executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='race-pattern')
+    return _pattern_executor
+
+
+async def _authenticate(request):
+    """DRFの認証クラスでリクエストを認証する
+    ステートレス認証はDBを参照しないため、そのまま呼び出す。
+    * @param request HTTPリクエストオブジェクト
+    * @return ユーザー (認証情報がない場合はNone)
+    """
+    for authentication_class in api_settings.DEFAULT_AUTHENTICATION_CLASSES:
+        authenticator = authentication_class()
+        if isinstance(authenticator, JWTStatelessUserAuthentication):
+            result = authenticator.authenticate(request)
+        else:
+            result = await sync_to_async(authenticator.authenticate)(request)
+        if result is not None:
+            return result[0]
+    return None
+
+
+def async_api_view(methods, allow_any=False):
+    """非同期ビュー用のデコレータ (api_view と permission_classes の代わり)
+    メソッドの確認・JWT認証・リクエストボディ (JSON・MessagePack) の読み込みを行い、request.user と request.data を設定する。
+    * @param methods 許可するHTTPメソッドのリスト
+    * @param allow_any Trueの場合は未認証のリクエストも許可する
+    * @return デコレータ
+    """
+    def decorator(view_func):
+        @wraps(view_func)
+        async def wrapper(request, *args, **kwargs):
+            if request.method not in methods:
+                return render_response(request, {'detail': f'メソッド "{request.method}" は許可されていません。'}, status=405)
+
+            try:
+                user = await _authenticate(request)
+            except AuthenticationFailed as e:
+                detail = e.detail.get('detail', e.detail) if isinstance(e.detail, dict) else e.detail
+                return render_response(request, {'detail': str(detail)}, status=401)
+            # 遅延評価のセッションユーザーを非同期コンテキストで評価しないよう置き換える
+            request.user = user or AnonymousUser()
+            if not allow_any and not request.user.is_authenticated:
+                return render_response(request, {'detail': '認証情報が含まれていません。'}, status=401)
+
+            request.data = {}
+            if request.method == 'POST' and request.body:
+                try:
+                    request.data = parse_request_body(request)
+                except ValueError:
+                    return render_response(request, {'detail': 'リクエストボディの形式が正しくありません。'}, status=400)
+            return await view_func(request, *args, **kwargs)
+
+        # api_view と同様にCSRFチェックの対象外とする (csrf_exempt は非同期関数に対応していないため属性で指定)
+        wrapper.csrf_exempt = True
+        return wrapper
+    return decorator
+
+
+@async_api_view(['POST'], allow_any=True)
+async def race_list(request):
+    """レースのリストをDBから取得するAPI (非同期版)
+    * @param request HTTPリクエストオブジェクト
+    * @param request.data.state レース場状態 (-1:全て, 0:芝, 1:ダート)
+    * @param request.data.distance 距離 (-1:全て, 1:短距離, 2:マイル, 3:中距離, 4:長距離)
+    * @param request.GET.fields 返すフィールド (カンマ区切り、省略時はすべて)
+    * @return HttpResponse レースリストデータ
+    """
+    logger = UmamusumeLog(request)
+    logger.logwrite('start', 'asyncRaceList')
+
+    try:
+        try:
+            state, distance = parse_race_list_filters(request.data)
+        except ValueError as e:
+            logger.logwrite('error', f'asyncRaceList - 不正な絞り込み条件: {e}')
+            return render_response(request, {'error': str(e)}, status=400)
+        races = [race async for race in get_race_list_queryset(state, distance)]
+
+        fields, _ = parse_sparse_fieldset(request.GET)
+        serializer = RaceSerializer(races, many=True, fields=fields)
+        logger.logwrite('end', f'asyncRaceList - 取得件数:{len(serializer.data)} (state:{state}, distance:{distance})')
+        return render_response(request, {'data': serializer.data})
+    except Exception as e:
+        logger.logwrite('error', f'asyncRaceList:{e}')
+        return render_response(request, {'error': 'レースリスト取得エラー'}, status=500)
+
+
+@async_api_view(['GET'], allow_any=True)
+async def umamusume_list(request):
+    """ウマ娘情報を取得するAPI (非同期版)
+    * @param request HTTPリクエストオブジェクト
+    * @param request.GET.fields 返すフィールド (カンマ区切り、省略時はすべて)
+    * @return HttpResponse ウマ娘リストデータ
+    """
+    logger = UmamusumeLog(request)
+    logger.logwrite('start', 'asyncUmamusumeList')
+
+    try:
+        # umamusume_nameの五十音順でソートして取得
+        umamusumes = [umamusume async for umamusume in Umamusume.objects.all().order_by('umamusume_name')]
+
+        fields, _ = parse_sparse_fieldset(request.GET)
+        serializer = UmamusumeSerializer(umamusumes, many=True, fields=fields)
+        logger.logwrite('end', f'asyncUmamusumeList - 件数:{len(serializer.data)}')
+        return render_response(request, {'data': serializer.data})
+    except Exception as e:
+        logger.logwrite('error', f'asyncUmamusumeList:{e}')
+        return render_response(request, {'error': 'ウマ娘リスト取得エラー'}, status=500)
+
+
+@async_api_view(['GET'], allow_any=True)
+async def live_list(request):
+    """ライブのリストをデータベースから取得するAPI (非同期版)
+    * @param request HTTPリクエストオブジェクト
+    * @param request.GET.fields 返すフィールド (カンマ区切り、省略時はすべて)
+    * @return HttpResponse ライブリストデータ
+    """
+    logger = UmamusumeLog(request)
+    logger.logwrite('start', 'asyncLiveList')
+
+    try:
+        lives = [live async for live in Live.objects.all()]
+        fields, _ = parse_sparse_fieldset(request.GET)
+        serializer = LiveSerializer(lives, many=True, fields=fields)
+        logger.logwrite('end', f'asyncLiveList - 取得件数:{len(serializer.data)}')
+        return render_response(request, {'data': serializer.data})
+    except Exception as e:
+        logger.logwrite('error', f'asyncLiveList:{e}')
+        return render_response(request, {'error': 'ライブリスト取得エラー'}, status=500)
+
+
+@async_api_view(['GET'])
+@admission_control
+async def remaining(request):
+    """ユーザーが登録したウマ娘の未出走データを取得するAPI (非同期版)
+    * @param request HTTPリクエストオブジェクト
+    * @param request.user.user_id ユーザーID
+    * @param request.GET.fields 返すフィールド (カンマ区切り、省略時はすべて)
+    * @param request.GET.expand 展開する入れ子のフィールド (カンマ区切り、指定しないものはIDのみ。省略時はすべて展開)
+    * @return HttpResponse ウマ娘別の残レース情報
+    """
+    logger = UmamusumeLog(request)
+    logger.logwrite('start', 'asyncRemaining')
+
+    try:
+        user_id = request.user.user_id
+        fields, expand = parse_sparse_fieldset(request.GET)
+        needs_breeding_count = is_field_requested(fields, 'breedingCount')
+        regist_umamusumes = [
+            ru async for ru in RegistUmamusume.objects.filter(user_id=user_id).select_related('umamusume')
+        ]
+        regist_umamusume_ids = [ru.umamusume_id for ru in regist_umamusumes]
+
+        run_races = [
+            item async for item in RegistUmamusumeRace.objects.filter(
+                user_id=user_id,
+                umamusume_id__in=regist_umamusume_ids
+            ).values('umamusume_id', 'race_id')
+        ]
+        target_races = await sync_to_async(get_g_races)()
+        # シナリオレースは目安育成数を返す場合のみ取得する
+        scenario_races = [
+            sr async for sr in ScenarioRace.objects.filter(umamusume_id__in=regist_umamusume_ids).select_related('race')
+        ] if needs_breeding_count else []
+
+        # 出走済みレースがないウマ娘がいる場合のみ、作成済みの目安育成数を取得する
+        has_unrun = set(regist_umamusume_ids) - {item['umamusume_id'] for item in run_races}
+        default_breeding_counts = (
+            await sync_to_async(get_default_breeding_counts)() if has_unrun and needs_breeding_count else None
+        )
+        sorted_results = build_remaining_results(
+            regist_umamusumes, run_races, target_races, scenario_races, default_breeding_counts, fields, expand
+        )
+        logger.logwrite('end', f'asyncRemaining - 取得ウマ娘数:{len(sorted_results)} (user_id:{user_id})')
+        return render_response(request, {'data': sorted_results})
+    except Exception as e:
+        logger.logwrite('error', f'asyncRemaining:{e}')
+        return render_response(request, {'error': '残レース取得エラー'}, status=500)
+
+
+async def _build_race_pattern(user_id, umamusume_id, tracer):
+    """ユーザーの出走状況を取得し、レースパターンを生成する (既定レースパターンがあればそれを返す)
+    * @param user_id ユーザーID
+    * @param umamusume_id ウマ娘ID
+    * @param tracer 処理区間を記録するトレーサー
+    * @return list レースパターンデータ
+    """
+    with tracer.span('1.load') as span:
+        inputs = await aload_race_pattern_inputs(user_id, umamusume_id)
+        span.set(candidates=len(inputs[1]))
+
+    # 出走済みのG1〜G3レースがない場合は、ウマ娘ごとに共通の既定レースパターン (DefaultRacePlan) を使う
+    use_default = is_default_race_pattern_inputs(inputs[1], inputs[3])
+    race_pattern = None
+    if use_default:
+        race_pattern = await sync_to_async(get_default_race_pattern)(inputs[0], inputs[2])
+    if race_pattern is None:
+        executor = get_pattern_executor()
+        # トレーサーはプロセス間で共有できないため、スレッドプールの場合のみフェーズ単位で記録する
+        build_tracer = tracer if isinstance(executor, ThreadPoolExecutor) else NULL_TRACER
+        with tracer.span('build'):
+            race_pattern = await asyncio.get_running_loop().run_in_executor(
+                executor, partial(build_race_pattern_data, *inputs, tracer=build_tracer)
+            )
+        if use_default:
+            await sync_to_async(cache_default_race_pattern)(inputs[0], inputs[2], race_pattern)
+    return race_pattern
+
+
+@async_api_view(['POST'])
+@admission_control
+async def get_race_pattern(request):
+    """残レースから計算したレース順序を出力するAPI (非同期版)
+    データ取得は非同期ORMで行い、CPU負荷の高いパターン生成はプールで実行する。
+    * @param request HTTPリクエストオブジェクト
+    * @param request.user.user_id ユーザーID
+    * @param request.data.umamusumeId ウマ娘ID
+    * @param request.data.count カウント (0〜RACE_PATTERN_MAX_COUNT)
+    * @param request.data.responseFormat 'compact' の場合、各パターンをスロットごとのレースIDの配列で返す
+    * @return HttpResponse レースパターンデータ
+    """
+    logger = UmamusumeLog(request)
+    logger.logwrite('start', 'asyncGetRacePattern')
+
+    try:
+        user_id = request.user.user_id
+        try:
+            umamusume_id, count = parse_race_pattern_params(request.data)
+        except ValueError as e:
+            logger.logwrite('error', f'asyncGetRacePattern - 不正なパラメータ: {e}')
+            return render_response(request, {'error': str(e)}, status=400)
+
+        tracer = Tracer('async_get_race_pattern')
+        # 同じ入力のリクエストが処理中の場合はその結果を共有する
+        key = (user_id, umamusume_id, count, await sync_to_async(get_data_version)(user_id))
+        race_pattern = await pattern_flight.ado(key, _build_race_pattern, user_id, umamusume_id, tracer)
+        tracer.finish()
+        tracer.record_metrics()
+        logger.log_trace('asyncGetRacePattern', tracer)
+
+        if request.data.get('responseFormat') == 'compact':
+            race_pattern = compact_race_pattern(race_pattern)
+        return render_response(request, {'data': race_pattern})
+    except Exception as e:
+        logger.logwrite('error', f'asyncGetRacePattern:{e}')
+        return render_response(request, {'error': '残レース計算エラー'}, status=500)
+
+
+@async_api_view(['GET'])
+async def pattern_job_status(request, job_id):
+    """レースパターン生成ジョブの状態と結果を取得するAPI (非同期版)
+    wait を指定すると、ジョブが完了するまで最大 wait 秒待ってから返す (ロングポーリング)。
+    待つ間は asyncio.sleep でイベントループに処理を返すため、ASGIサーバーでは待機中も他のリクエストを処理できる。
+    WSGIサーバーでは待機中にワーカーのスレッドを占有するため、wait を無視してすぐに返す。
+    * @param request HTTPリクエストオブジェクト
+    * @param request.user.user_id ユーザーID
+    * @param request.GET.wait 完了を待つ秒数 (最大 UMA_PATTERN_JOB_MAX_WAIT_SECONDS、省略時は待たない)
+    * @param request.GET.responseFormat 'compact' の場合、結果をコンパクト形式で返す
+    * @param job_id ジョブID
+    * @return HttpResponse ジョブID・状態・結果
+    """
+    logger = UmamusumeLog(request)
+    logger.logwrite('start', 'asyncPatternJobStatus')
+
+    try:
+        user_id = request.user.user_id
+        try:
+            wait = float(request.GET.get('wait', 0))
+        except ValueError:
+            wait = math.nan
+        # nan・inf は上限との比較で除外できないため、数値でない値と同様に扱う
+        if not math.isfinite(wait):
+            return render_response(request, {'error': 'waitは数値で指定してください。'}, status=400)
+        wait = min(max(wait, 0), getattr(settings, 'UMA_PATTERN_JOB_MAX_WAIT_SECONDS', 30))
+        if not isinstance(request, ASGIRequest):
+            wait = 0
+
+        job = await await_pattern_job(job_id, user_id, wait)
+        if job is None:
+            logger.logwrite('error', f'asyncPatternJobStatus - ジョブが見つかりません: job_id={job_id}, user_id={user_id}')
+            return render_response(request, {'error': 'ジョブが見つかりません。'}, status=404)
+
+        logger.logwrite('end', f'asyncPatternJobStatus - job_id:{job_id} status:{job.status}')
+        compact = request.GET.get('responseFormat') == 'compact'
+        retry_after = get_retry_after(job)
+        headers = {'Retry-After': str(retry_after)} if retry_after is not None else None
+        return render_response(request, {'data': pattern_job_data(job, compact)}, headers=headers)
+    except Exception as e:
+        logger.logwrite('error', f'asyncPatternJobStatus:{e}')
+        return render_response(request, {'error': 'ジョブ取得エラー'}, status=500)
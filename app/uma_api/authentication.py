@@ -0,0 +1,60 @@
+from django.utils.functional import cached_property
+from rest_framework.permissions import BasePermission
+from rest_framework_simplejwt.authentication import JWTAuthentication, JWTStatelessUserAuthentication
+from rest_framework_simplejwt.models import TokenUser
+from rest_framework_simplejwt.tokens import RefreshToken
+
+from .models import UserPersonal
+
+
+class UmamusumeTokenUser(TokenUser):
+    """トークンのクレームから組み立てる軽量なユーザー (DBを参照しない)
+    ほとんどのAPIは user_id しか使わないため、UserPersonal の代わりに使用する。
+    * @param token 検証済みのトークン
+    """
+    @cached_property
+    def user_id(self):
+        return self.id
+
+    @cached_property
+    def user_name(self):
+        return self.token.get('user_name', '')
+
+
+# ユーザーをDBから取得せず、SIMPLE_JWT['TOKEN_USER_CLASS'] (UmamusumeTokenUser) を返す認証クラス
+StatelessJWTAuthentication = JWTStatelessUserAuthentication
+
+# UserPersonal のモデルそのものが必要なAPIで使用する認証クラス
+DatabaseJWTAuthentication = JWTAuthentication
+
+
+def is_staff_user(user):
+    """スタッフ専用の機能を利用できるユーザーかを判定する
+    トークンのクレームは発行後の権限変更・無効化を反映しないため、クレームがスタッフの場合はDBで再確認する。
+    * @param user 認証済みのユーザー
+    * @return bool 現在もスタッフの場合True
+    """
+    if not getattr(user, 'is_staff', False):
+        return False
+    if isinstance(user, UserPersonal):
+        # DBから取得したユーザーはそのまま判定できる
+        return user.is_active
+    return UserPersonal.objects.filter(user_id=user.user_id, is_staff=True, is_active=True).exists()
+
+
+class IsStaffUser(BasePermission):
+    """スタッフ専用APIの権限クラス (スタッフ権限をDBで再確認する)"""
+    def has_permission(self, request, view):
+        return is_staff_user(request.user)
+
+
+def issue_tokens(user):
+    """ログインユーザーのリフレッシュトークンを発行する
+    ステートレス認証で使用するため、ユーザー名とスタッフ権限をクレームに含める。
+    * @param user ユーザーオブジェクト
+    * @return RefreshToken リフレッシュトークン (access_token も同じクレームを持つ)
+    """
+    refresh = RefreshToken.for_user(user)
+    refresh['user_name'] = user.user_name
+    refresh['is_staff'] = user.is_staff
+    return refresh
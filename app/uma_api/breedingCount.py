@@ -1,13 +1,15 @@
 from .models import ScenarioRace
-def getbreedingCountData( umamusume , remaining_races ):
+def getbreedingCountData( umamusume , remaining_races , scenario_races=None ):
     """全冠までの目安育成数を計算する関数
     * @param umamusume ウマ娘オブジェクト
-    * @param remaining_races 残レースのクエリセット
+    * @param remaining_races 残レースのリストまたはクエリセット
+    * @param scenario_races ウマ娘に紐づくシナリオレース (raceを取得済みのもの、省略時はDBから取得)
     * @return int 必要な育成回数
     """
     
     # 1. ウマ娘に紐づくシナリオレースを取得
-    scenario_races = ScenarioRace.objects.filter(umamusume_id=umamusume.umamusume_id)
+    if scenario_races is None:
+        scenario_races = ScenarioRace.objects.filter(umamusume_id=umamusume.umamusume_id).select_related('race')
     
     # 2. シナリオレースと被るタイミングの残レースを抽出
     conflicting_races = []
@@ -1,3 +1,35 @@
+from collections import namedtuple
+from functools import lru_cache
+from itertools import permutations
+
+
+# 因子計算APIのIDを因子名に変換するマップ
+FACTOR_DISTANCE_MAP = {1: "短距離", 2: "マイル", 3: "中距離", 4: "長距離"}
+FACTOR_SURFACE_MAP = {1: "芝", 2: "ダート"}
+FACTOR_STYLE_MAP = {1: "逃げ", 2: "先行", 3: "差し", 4: "追込"}
+
+# calculate_aptitude_factors が参照する適性のみを抜き出した、ハッシュ可能な適性プロファイル
+AptitudeProfile = namedtuple('AptitudeProfile', [
+    'dirt_aptitude', 'sprint_aptitude', 'mile_aptitude', 'classic_aptitude', 'long_distance_aptitude',
+])
+
+
+def get_aptitude_profile(umamusume):
+    """ウマ娘オブジェクトから因子計算用の適性プロファイルを作成する
+    * @param umamusume ウマ娘オブジェクト (Noneも可)
+    * @return AptitudeProfile|None 適性プロファイル
+    """
+    if not umamusume:
+        return None
+    return AptitudeProfile(
+        dirt_aptitude=umamusume.dirt_aptitude,
+        sprint_aptitude=umamusume.sprint_aptitude,
+        mile_aptitude=umamusume.mile_aptitude,
+        classic_aptitude=umamusume.classic_aptitude,
+        long_distance_aptitude=umamusume.long_distance_aptitude,
+    )
+
+
 def calculate_aptitude_factors(umamusume, target_surface, target_style):
     """
     ウマ娘の適性と目標因子に基づいて、継承させるべき因子を計算します。
@@ -61,4 +93,77 @@ def calculate_aptitude_factors(umamusume, target_surface, target_style):
 
     # --- デフォルト: 補強が不要な場合 ---
     # ユーザーが指定した目標の馬場と脚質を返す。
-    return target_surface, target_style
\ No newline at end of file
+    return target_surface, target_style
+
+
+def _get_main_factor_pool(factor_1, factor_2, surface, style):
+    """祖父母のメイン因子プールを決定する
+    サブ因子が「差し」x2なら「芝」x2、サブ因子が「芝」x2なら「差し」x2
+    """
+    if factor_1 == "差し" and factor_2 == "差し":
+        return ("芝", "芝")
+    if factor_1 == "芝" and factor_2 == "芝":
+        return ("差し", "差し")
+    return (surface, style)
+
+
+@lru_cache(maxsize=4096)
+def build_factor_patterns(grandparent_profile, grandmother_profile, surface, style):
+    """祖父母の適性プロファイルと目標因子から、継承因子パターンを生成する
+    結果は入力のみに依存するため、プロファイル単位でメモ化する。
+    返却値は共有されるため、呼び出し側で変更しないこと。
+    * @param grandparent_profile 祖父母Aの適性プロファイル
+    * @param grandmother_profile 祖父母Bの適性プロファイル
+    * @param surface 目標の馬場因子 (例: "芝")
+    * @param style 目標の脚質因子 (例: "差し")
+    * @return tuple 因子パターンのタプル
+    """
+    # 祖父母A・Bの適性因子を計算
+    factor_a_1, factor_a_2 = calculate_aptitude_factors(grandparent_profile, surface, style)
+    factor_b_1, factor_b_2 = calculate_aptitude_factors(grandmother_profile, surface, style)
+
+    # 1. 各祖父母のメイン因子プールを決定
+    main_a_pool = _get_main_factor_pool(factor_a_1, factor_a_2, surface, style)
+    main_b_pool = _get_main_factor_pool(factor_b_1, factor_b_2, surface, style)
+
+    # 2. 各因子の組み合わせ(順列)を生成
+    main_a_perms = sorted(set(permutations(main_a_pool)))
+    sub_a_perms = sorted(set(permutations((factor_a_1, factor_a_2))))
+    main_b_perms = sorted(set(permutations(main_b_pool)))
+    sub_b_perms = sorted(set(permutations((factor_b_1, factor_b_2))))
+
+    # 3. MainとSubの全組み合わせを生成し、出現順を保ったまま重複を削除する
+    unique_patterns = []
+    seen_factors = set()
+
+    def add_pattern(main_a, sub_a, main_b, sub_b):
+        key = (main_a, sub_a, main_b, sub_b)
+        if key in seen_factors:
+            return
+        seen_factors.add(key)
+        unique_patterns.append({
+            "factors": {
+                "grandparent_a": {
+                    "aaa": main_a[0], "aba": main_a[1],
+                    "aab": sub_a[0], "abb": sub_a[1],
+                    "aa": factor_a_1, "ab": factor_a_2,
+                },
+                "grandparent_b": {
+                    "baa": main_b[0], "bba": main_b[1],
+                    "bab": sub_b[0], "bbb": sub_b[1],
+                    "ba": factor_b_1, "bb": factor_b_2,
+                },
+            },
+            "name": f"{len(unique_patterns) + 1}",
+        })
+
+    for p_main_a in main_a_perms:
+        for p_sub_a in sub_a_perms:
+            for p_main_b in main_b_perms:
+                for p_sub_b in sub_b_perms:
+                    # パターン1: 基本の組み合わせ
+                    add_pattern(p_main_a, p_sub_a, p_main_b, p_sub_b)
+                    # パターン2: 祖父母AとBのメイン因子を入れ替えた組み合わせ
+                    add_pattern(p_main_b, p_sub_a, p_main_a, p_sub_b)
+
+    return tuple(unique_patterns)
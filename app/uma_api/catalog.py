@@ -0,0 +1,291 @@
+import hashlib
+import json
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import django
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connections, transaction
+from django.utils import timezone
+
+from .response_cache import get_catalog_version, is_shared_cache
+
+# プロセス内に保持するマスタ由来のデータ {名前: (マスタのバージョン, 作成時刻, 値)}
+_local = {}
+_local_lock = threading.Lock()
+
+# warm_caches で作成するレースリストの条件 (state, distance)
+RACE_LIST_FILTERS = [(state, distance) for state in (-1, 0, 1) for distance in (-1, 1, 2, 3, 4)]
+
+
+def _get_timeout():
+    return getattr(settings, 'UMA_CATALOG_CACHE_SECONDS', 3600)
+
+
+def _get_local(name, builder):
+    """プロセス内に保持したデータを取得する (マスタのバージョンが変わるか、保持期間を過ぎた場合は作り直す)
+    キャッシュがワーカー間で共有されない場合は load_data によるバージョンの更新が見えないため、保持せずに毎回作成する。
+    """
+    if not is_shared_cache():
+        return builder()
+    version = get_catalog_version()
+    entry = _local.get(name)
+    if entry is None or entry[0] != version or time.monotonic() - entry[1] >= _get_timeout():
+        value = builder()
+        with _local_lock:
+            entry = _local[name] = (version, time.monotonic(), value)
+    return entry[2]
+
+
+def get_g_races():
+    """G1〜G3の全レースを取得する (プロセス内で共有するため、取得したオブジェクトは変更しないこと)
+    残レース計算・レースパターン生成で使用する。
+    * @return list レースのリスト
+    """
+    from .models import Race
+    return _get_local('g_races', lambda: list(Race.objects.filter(race_rank__in=[1, 2, 3])))
+
+
+def _acter_list():
+    from .models import UmamusumeActer
+    from .serializers import UmamusumeActerSerializer
+    return UmamusumeActerSerializer(UmamusumeActer.objects.select_related('umamusume').order_by('-birthday'), many=True).data
+
+
+def _live_list():
+    from .models import Live
+    from .serializers import LiveSerializer
+    return LiveSerializer(Live.objects.all(), many=True).data
+
+
+def _umamusume_list():
+    from .models import Umamusume
+    from .serializers import UmamusumeSerializer
+    # umamusume_nameの五十音順でソートして取得
+    return UmamusumeSerializer(Umamusume.objects.all().order_by('umamusume_name'), many=True).data
+
+
+def _race_list(state, distance):
+    from .race_views import get_race_list_queryset
+    from .serializers import RaceSerializer
+    return RaceSerializer(get_race_list_queryset(state, distance), many=True).data
+
+
+def _race_regist_list():
+    from .models import Race
+    from .serializers import RaceSerializer
+    races = Race.objects.filter(race_rank__in=[1, 2, 3]).order_by('race_rank', 'race_months', 'half_flag')
+    return RaceSerializer(races, many=True).data
+
+
+# マスタのみから作るAPIレスポンス {名前: 作成関数}
+CATALOG_SNAPSHOTS = {
+    'acter_list': _acter_list,
+    'live_list': _live_list,
+    'umamusume_list': _umamusume_list,
+    'race_list': _race_list,
+    'race_regist_list': _race_regist_list,
+}
+
+
+def get_catalog_snapshot(name, *args, refresh=False):
+    """マスタのみから作るAPIレスポンスのデータを、マスタのバージョンごとにキャッシュして取得する
+    * @param name CATALOG_SNAPSHOTS の名前
+    * @param args 作成関数の引数 (絞り込み条件など)
+    * @param refresh Trueの場合はキャッシュを使わずに作り直す
+    * @return list シリアライズ済みのデータ
+    """
+    if not is_shared_cache():
+        # load_data (別プロセス) によるバージョンの更新が見えないため、キャッシュしない
+        return list(CATALOG_SNAPSHOTS[name](*args))
+    key = f"uma_api:catalog:{name}:{get_catalog_version()}:{':'.join(map(str, args))}"
+    data = None if refresh else cache.get(key)
+    if data is None:
+        data = list(CATALOG_SNAPSHOTS[name](*args))
+        cache.set(key, data, _get_timeout())
+    return data
+
+
+def _field_values(instance):
+    return [getattr(instance, field.attname) for field in instance._meta.concrete_fields]
+
+
+def _g_races_digest():
+    from .models import Race
+    races = sorted(_field_values(race) for race in get_g_races())
+    fields = [field.attname for field in Race._meta.concrete_fields]
+    return hashlib.sha1(json.dumps([fields, races], default=str).encode()).hexdigest()
+
+
+def default_plan_hash(umamusume, scenario_races):
+    """既定レースパターンの入力 (ウマ娘・シナリオレース・G1〜G3全レース) のハッシュ値を取得する
+    マスタが変わった場合のみ値が変わるため、DefaultRacePlan・キャッシュのバージョンとして使用する。
+    * @param umamusume ウマ娘オブジェクト
+    * @param scenario_races ウマ娘のシナリオレースのリスト (raceを取得済みのもの)
+    * @return str SHA-1のハッシュ値
+    """
+    scenario = sorted(
+        [scenario_race.race_number, scenario_race.random_group, scenario_race.senior_flag, *_field_values(scenario_race.race)]
+        for scenario_race in scenario_races
+    )
+    data = [_field_values(umamusume), scenario, _get_local('g_races_digest', _g_races_digest)]
+    return hashlib.sha1(json.dumps(data, default=str).encode()).hexdigest()
+
+
+def _default_pattern_key(umamusume_id, catalog_hash):
+    return f'uma_api:default_pattern:{umamusume_id}:{catalog_hash}'
+
+
+def get_default_race_pattern(umamusume, scenario_races):
+    """出走済みのG1〜G3レースがない場合のレースパターンを、キャッシュ・DefaultRacePlan から取得する
+    * @param umamusume ウマ娘オブジェクト
+    * @param scenario_races ウマ娘のシナリオレースのリスト (raceを取得済みのもの)
+    * @return list レースパターンデータ (未作成の場合はNone)
+    """
+    from .models import DefaultRacePlan
+
+    catalog_hash = default_plan_hash(umamusume, scenario_races)
+    key = _default_pattern_key(umamusume.umamusume_id, catalog_hash)
+    race_pattern = cache.get(key)
+    if race_pattern is None:
+        race_pattern = DefaultRacePlan.objects.filter(
+            umamusume_id=umamusume.umamusume_id, catalog_hash=catalog_hash
+        ).values_list('race_pattern', flat=True).first()
+        if race_pattern is not None:
+            cache.set(key, race_pattern, _get_timeout())
+    return race_pattern
+
+
+def cache_default_race_pattern(umamusume, scenario_races, race_pattern):
+    """DefaultRacePlan が未作成の場合に、リクエスト時に作成したレースパターンをキャッシュに保存する
+    * @param umamusume ウマ娘オブジェクト
+    * @param scenario_races ウマ娘のシナリオレースのリスト (raceを取得済みのもの)
+    * @param race_pattern レースパターンデータ
+    * @return None
+    """
+    key = _default_pattern_key(umamusume.umamusume_id, default_plan_hash(umamusume, scenario_races))
+    cache.set(key, race_pattern, _get_timeout())
+
+
+def get_default_breeding_counts():
+    """DefaultRacePlan の目安育成数をプロセス内に保持して取得する
+    * @return dict {(ウマ娘ID, ハッシュ値): 目安育成数}
+    """
+    from .models import DefaultRacePlan
+    return _get_local('default_breeding_counts', lambda: {
+        (umamusume_id, catalog_hash): breeding_count
+        for umamusume_id, catalog_hash, breeding_count in DefaultRacePlan.objects.values_list(
+            'umamusume_id', 'catalog_hash', 'breeding_count')
+    })
+
+
+def build_default_race_plan(umamusume_id):
+    """出走済みレースがない状態のレースパターン・目安育成数を作成する (ユーザーによらずウマ娘ごとに同じになる)
+    * @param umamusume_id ウマ娘ID
+    * @return tuple (ウマ娘ID, レースパターンデータ, 目安育成数)
+    """
+    from .breedingCount import getbreedingCountData
+    from .racePattern import build_race_pattern_data, load_race_pattern_inputs_by_race_ids
+
+    umamusume, remaining_races, scenario_races, all_g_races = load_race_pattern_inputs_by_race_ids(umamusume_id)
+    breeding_count = getbreedingCountData(umamusume, remaining_races, scenario_races)
+    race_pattern = build_race_pattern_data(umamusume, remaining_races, scenario_races, all_g_races)
+    # JSONFieldに保存した値と同じ形にする
+    return umamusume_id, json.loads(json.dumps(race_pattern, default=str)), breeding_count
+
+
+def _map_in_pool(func, items, workers):
+    """workers が1の場合は同じプロセスで、それ以外はプロセスプールで func を実行する"""
+    if workers == 1:
+        yield from map(func, items)
+        return
+    # fork したワーカーが親プロセスのDB接続を共有しないよう、先に閉じておく
+    connections.close_all()
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_warm_worker) as executor:
+        yield from executor.map(func, items, chunksize=4)
+
+
+def refresh_default_race_plans(workers=None):
+    """全ウマ娘の DefaultRacePlan を現在のマスタに合わせて作成し、古いハッシュのものを削除する
+    入力のハッシュ値が変わっていないウマ娘は作成し直さない。別のプロセスが同時に作成した場合は、その作成済みのものを使う。
+    * @param workers 作成するプロセス数 (省略時はCPU数、1の場合は同じプロセスで作成)
+    * @return tuple (作成件数, 全ウマ娘数)
+    """
+    from .models import DefaultRacePlan, ScenarioRace, Umamusume
+
+    scenario_races = {}
+    for scenario_race in ScenarioRace.objects.select_related('race'):
+        scenario_races.setdefault(scenario_race.umamusume_id, []).append(scenario_race)
+    hashes = {
+        umamusume.umamusume_id: default_plan_hash(umamusume, scenario_races.get(umamusume.umamusume_id, []))
+        for umamusume in Umamusume.objects.order_by('umamusume_id')
+    }
+    existing = set(DefaultRacePlan.objects.values_list('umamusume_id', 'catalog_hash'))
+    missing_ids = [umamusume_id for umamusume_id, catalog_hash in hashes.items() if (umamusume_id, catalog_hash) not in existing]
+
+    now = timezone.now()
+    plans = [
+        DefaultRacePlan(
+            umamusume_id=umamusume_id, catalog_hash=hashes[umamusume_id],
+            race_pattern=race_pattern, breeding_count=breeding_count, created_date=now,
+        )
+        for umamusume_id, race_pattern, breeding_count in _map_in_pool(build_default_race_plan, missing_ids, workers)
+    ]
+    with transaction.atomic():
+        DefaultRacePlan.objects.bulk_create(plans, batch_size=100, ignore_conflicts=True)
+        stale_ids = [
+            plan_id for plan_id, umamusume_id, catalog_hash in DefaultRacePlan.objects.values_list('id', 'umamusume_id', 'catalog_hash')
+            if hashes.get(umamusume_id) != catalog_hash
+        ]
+        DefaultRacePlan.objects.filter(id__in=stale_ids).delete()
+    # プロセス内に保持した目安育成数を作り直す
+    _local.pop('default_breeding_counts', None)
+    return len(plans), len(hashes)
+
+
+def _init_warm_worker():
+    """プロセスプールのワーカーでDjangoを初期化する"""
+    django.setup()
+
+
+def warm_local_caches():
+    """プロセス内に保持するG1〜G3レース一覧・目安育成数を作成する (gunicornのワーカーごとに実行する)
+    既定レースパターンは作成しないため、作成済みでない場合は warm_caches を先に実行する。
+    * @return list (対象, 件数, 処理時間(秒)) のリスト
+    """
+    report = []
+    start = time.perf_counter()
+    report.append(('g_races', len(get_g_races()), time.perf_counter() - start))
+    start = time.perf_counter()
+    report.append(('default_breeding_counts', len(get_default_breeding_counts()), time.perf_counter() - start))
+    return report
+
+
+def warm_caches(workers=None):
+    """マスタのAPIレスポンス・G1〜G3レース一覧・全ウマ娘の既定レースパターンを作成してキャッシュする
+    既定レースパターンは DefaultRacePlan にない場合のみ作成する。CPU負荷が高いため、workers が2以上の場合はプロセスを分けて並列に作成する。
+    * @param workers 既定レースパターンを作成するプロセス数 (省略時はCPU数、1の場合は同じプロセスで作成)
+    * @return list (対象, 件数, 処理時間(秒)) のリスト
+    """
+    from .models import DefaultRacePlan
+
+    report = []
+    start = time.perf_counter()
+    names = [(name, ()) for name in CATALOG_SNAPSHOTS if name != 'race_list']
+    names += [('race_list', filters) for filters in RACE_LIST_FILTERS]
+    for name, args in names:
+        get_catalog_snapshot(name, *args, refresh=True)
+    report.append(('catalog_snapshots', len(names), time.perf_counter() - start))
+
+    start = time.perf_counter()
+    built, _ = refresh_default_race_plans(workers)
+    report.append(('default_plans', built, time.perf_counter() - start))
+
+    start = time.perf_counter()
+    plans = DefaultRacePlan.objects.values_list('umamusume_id', 'catalog_hash', 'race_pattern')
+    for umamusume_id, catalog_hash, race_pattern in plans:
+        cache.set(_default_pattern_key(umamusume_id, catalog_hash), race_pattern, _get_timeout())
+    report.append(('default_patterns', len(plans), time.perf_counter() - start))
+    return report + warm_local_caches()
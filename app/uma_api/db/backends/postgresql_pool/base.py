@@ -0,0 +1,92 @@
+import threading
+
+from django.db.backends.postgresql import base as postgresql_base
+from django.db.backends.postgresql.creation import DatabaseCreation as PostgresqlDatabaseCreation
+from django.db.backends.postgresql.psycopg_any import IsolationLevel
+
+from uma_api.db.pool import ConnectionPool
+
+# 接続先ごとのプール (同じ接続パラメータのDatabaseWrapper間で共有する)
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def close_pools(alias):
+    """指定したエイリアスのプールをすべて閉じる
+    * @param alias DBエイリアス
+    * @return None
+    """
+    with _pools_lock:
+        keys = [key for key in _pools if key[0] == alias]
+        pools = [_pools.pop(key) for key in keys]
+    for pool in pools:
+        pool.close()
+
+
+def _reset_connection(connection):
+    """返却時に未完了のトランザクションを破棄する"""
+    if connection.info.transaction_status != postgresql_base.Database.extensions.TRANSACTION_STATUS_IDLE:
+        connection.rollback()
+
+
+def _connection_factory(settings_dict, alias, conn_params):
+    """プールで新規接続を作成する関数を返す
+    プールは同じ接続先のDatabaseWrapper (スレッドごとに作られる) で共有するため、最初に接続したDatabaseWrapperではなく
+    設定と接続パラメータのみを保持し、接続のたびに一時的なDatabaseWrapperで親クラスの接続処理を行う。
+    * @param settings_dict DB設定
+    * @param alias DBエイリアス
+    * @param conn_params 接続パラメータ
+    * @return function 新規接続を返す関数
+    """
+    settings_dict = dict(settings_dict)
+    conn_params = dict(conn_params)
+
+    def connect():
+        # 分離レベルやjsonbの設定は親クラスの処理で接続ごとに行われる
+        return postgresql_base.DatabaseWrapper(settings_dict, alias).get_new_connection(conn_params)
+    return connect
+
+
+class DatabaseCreation(PostgresqlDatabaseCreation):
+    """テストDBの削除前に、プールに残った接続を閉じる (接続が残っているとDROP DATABASEが失敗するため)"""
+    def _destroy_test_db(self, test_database_name, verbosity):
+        close_pools(self.connection.alias)
+        super()._destroy_test_db(test_database_name, verbosity)
+
+
+class DatabaseWrapper(postgresql_base.DatabaseWrapper):
+    """接続をプールから借り、close時にプールへ返却するPostgreSQLバックエンド
+    プールの設定は DATABASES の POOL (min_size, max_size, timeout, max_idle, max_lifetime, check_interval) で指定する。
+    """
+    creation_class = DatabaseCreation
+
+    def get_pool(self, conn_params):
+        """接続パラメータに対応するプールを取得する (テストDBなど接続先が変わる場合は別のプールになる)
+        * @param conn_params 接続パラメータ
+        * @return ConnectionPool プール
+        """
+        key = (self.alias, tuple(sorted((name, str(value)) for name, value in conn_params.items())))
+        with _pools_lock:
+            pool = _pools.get(key)
+            if pool is None:
+                pool = _pools[key] = ConnectionPool(
+                    _connection_factory(self.settings_dict, self.alias, conn_params),
+                    name=f"{self.alias}:{conn_params.get('dbname', '')}",
+                    reset=_reset_connection,
+                    **self.settings_dict.get('POOL', {}),
+                )
+            return pool
+
+    def get_new_connection(self, conn_params):
+        self._pool = self.get_pool(conn_params)
+        connection = self._pool.acquire()
+        # 再利用した接続でも、親クラスの接続処理と同じく isolation_level を設定しておく
+        options = self.settings_dict['OPTIONS']
+        self.isolation_level = IsolationLevel(options.get('isolation_level', IsolationLevel.READ_COMMITTED))
+        return connection
+
+    def _close(self):
+        if self.connection is not None:
+            with self.wrap_database_errors:
+                # 使用不可になった接続はプールに戻さずに閉じる
+                self._pool.release(self.connection, discard=self.errors_occurred and not self.is_usable())
@@ -0,0 +1,244 @@
+import threading
+import time
+from collections import deque
+
+from ..metrics import REGISTRY, LATENCY_BUCKETS
+
+pool_size = REGISTRY.gauge('uma_api_db_pool_size', 'プール内の接続数', ('pool',))
+pool_max_size = REGISTRY.gauge('uma_api_db_pool_max_size', 'プールの最大接続数', ('pool',))
+pool_in_use = REGISTRY.gauge('uma_api_db_pool_in_use', '使用中の接続数', ('pool',))
+pool_idle = REGISTRY.gauge('uma_api_db_pool_idle', '待機中の接続数', ('pool',))
+pool_waiting = REGISTRY.gauge('uma_api_db_pool_waiting', '接続の空きを待っているリクエスト数', ('pool',))
+pool_checkouts = REGISTRY.counter('uma_api_db_pool_checkouts_total', '接続の貸し出し回数', ('pool',))
+pool_timeouts = REGISTRY.counter('uma_api_db_pool_timeouts_total', '接続待ちのタイムアウト回数', ('pool',))
+pool_discards = REGISTRY.counter(
+    'uma_api_db_pool_discards_total', '破棄した接続数', ('pool', 'reason'))
+pool_wait = REGISTRY.histogram(
+    'uma_api_db_pool_wait_seconds', '接続の貸し出しまでの待ち時間(秒)', LATENCY_BUCKETS, ('pool',))
+
+_pools = set()
+_pools_lock = threading.Lock()
+
+
+class PoolTimeout(Exception):
+    """タイムアウトまでに接続を貸し出せなかった場合の例外"""
+
+
+def default_check(connection):
+    """接続が使用可能かを確認する (失敗した場合は例外)"""
+    cursor = connection.cursor()
+    try:
+        cursor.execute('SELECT 1')
+    finally:
+        cursor.close()
+
+
+class ConnectionPool:
+    """DB-API 2.0 の接続を使い回すスレッドセーフなコネクションプール
+    * @param connect 新しい接続を作成する関数
+    * @param name プール名 (メトリクスのラベルに使用)
+    * @param min_size アイドル接続を破棄する際に残す最小接続数
+    * @param max_size 最大接続数
+    * @param timeout 接続の空きを待つ最大秒数
+    * @param max_idle アイドル状態のまま保持する最大秒数
+    * @param max_lifetime 接続を使い回す最大秒数 (超えた接続は返却時に破棄)
+    * @param check_interval この秒数以上アイドルだった接続は、貸し出し前にヘルスチェックする (0:毎回)
+    * @param check ヘルスチェック関数 (例外で使用不可と判定)
+    * @param reset 返却時に接続を初期状態に戻す関数 (例外の場合は破棄)
+    """
+    def __init__(self, connect, name='default', min_size=0, max_size=10, timeout=10.0,
+                 max_idle=300.0, max_lifetime=3600.0, check_interval=30.0, check=default_check, reset=None):
+        self.connect = connect
+        self.name = name
+        self.min_size = min_size
+        self.max_size = max_size
+        self.timeout = timeout
+        self.max_idle = max_idle
+        self.max_lifetime = max_lifetime
+        self.check_interval = check_interval
+        self.check = check
+        self.reset = reset
+
+        self._cond = threading.Condition()
+        # (接続, 作成時刻, 最終返却時刻) を後入れ先出しで保持する
+        self._idle = deque()
+        self._created_at = {}
+        self._size = 0
+        self._waiting = 0
+        self._closed = False
+        with _pools_lock:
+            _pools.add(self)
+
+    def acquire(self):
+        """接続を借りる (空きがない場合は timeout 秒まで待つ)
+        * @return 接続
+        """
+        start = time.monotonic()
+        deadline = start + self.timeout
+        while True:
+            connection, needs_check = self._checkout(deadline)
+            if connection is None:
+                # 空きがあるため新しく接続する
+                try:
+                    connection = self.connect()
+                except BaseException:
+                    with self._cond:
+                        self._size -= 1
+                        self._cond.notify()
+                    raise
+                with self._cond:
+                    self._created_at[id(connection)] = time.monotonic()
+            elif needs_check:
+                try:
+                    self.check(connection)
+                except Exception:
+                    self._discard(connection, 'unhealthy')
+                    continue
+            pool_checkouts.inc(pool=self.name)
+            pool_wait.observe(time.monotonic() - start, pool=self.name)
+            return connection
+
+    def _checkout(self, deadline):
+        """アイドル接続を取り出すか、新規接続の枠を確保する
+        * @return tuple (アイドル接続 または 新規接続の場合None, ヘルスチェックが必要か)
+        """
+        discarded = []
+        try:
+            with self._cond:
+                if self._closed:
+                    raise PoolTimeout(f'{self.name}: プールは終了しています')
+                self._waiting += 1
+                try:
+                    while True:
+                        now = time.monotonic()
+                        while self._idle:
+                            connection, created_at, released_at = self._idle.pop()
+                            if self._is_expired(created_at, now):
+                                discarded.append(connection)
+                                self._forget(connection)
+                                continue
+                            return connection, now - released_at >= self.check_interval
+                        if self._size < self.max_size:
+                            self._size += 1
+                            return None, False
+                        remaining = deadline - now
+                        if remaining <= 0:
+                            pool_timeouts.inc(pool=self.name)
+                            raise PoolTimeout(f'{self.name}: {self.timeout}秒以内に接続を取得できませんでした')
+                        self._cond.wait(remaining)
+                finally:
+                    self._waiting -= 1
+        finally:
+            for connection in discarded:
+                pool_discards.inc(pool=self.name, reason='expired')
+                self._close_quietly(connection)
+
+    def release(self, connection, discard=False):
+        """接続を返却する
+        * @param connection 接続
+        * @param discard Trueの場合は再利用せずに閉じる
+        * @return None
+        """
+        reason = 'discarded' if discard else None
+        if reason is None and getattr(connection, 'closed', False):
+            reason = 'closed'
+        if reason is None and self.reset is not None:
+            try:
+                self.reset(connection)
+            except Exception:
+                reason = 'reset_failed'
+
+        now = time.monotonic()
+        with self._cond:
+            created_at = self._created_at.get(id(connection), now)
+            if reason is None and (self._closed or self._is_expired(created_at, now)):
+                reason = 'expired'
+            if reason is None:
+                self._idle.append((connection, created_at, now))
+                stale = self._prune_idle(now)
+                self._cond.notify()
+            else:
+                self._forget(connection)
+                stale = []
+        if reason is not None:
+            pool_discards.inc(pool=self.name, reason=reason)
+            self._close_quietly(connection)
+        for stale_connection in stale:
+            pool_discards.inc(pool=self.name, reason='idle')
+            self._close_quietly(stale_connection)
+
+    def _discard(self, connection, reason):
+        with self._cond:
+            self._forget(connection)
+        pool_discards.inc(pool=self.name, reason=reason)
+        self._close_quietly(connection)
+
+    def _forget(self, connection):
+        """接続をプールの管理から外す (ロック内で呼ぶ)"""
+        self._created_at.pop(id(connection), None)
+        self._size -= 1
+        self._cond.notify()
+
+    def _is_expired(self, created_at, now):
+        return self.max_lifetime is not None and now - created_at >= self.max_lifetime
+
+    def _prune_idle(self, now):
+        """max_idle を超えたアイドル接続を、最小接続数を残して取り出す (ロック内で呼ぶ)"""
+        stale = []
+        while self._idle and self._size > self.min_size and now - self._idle[0][2] >= self.max_idle:
+            connection, _, _ = self._idle.popleft()
+            self._forget(connection)
+            stale.append(connection)
+        return stale
+
+    @staticmethod
+    def _close_quietly(connection):
+        try:
+            connection.close()
+        except Exception:
+            pass
+
+    def close(self):
+        """アイドル接続をすべて閉じ、以後の貸し出しを止める (使用中の接続は返却時に閉じる)"""
+        with self._cond:
+            self._closed = True
+            idle = [connection for connection, _, _ in self._idle]
+            self._idle.clear()
+            for connection in idle:
+                self._forget(connection)
+            self._cond.notify_all()
+        for connection in idle:
+            self._close_quietly(connection)
+        with _pools_lock:
+            _pools.discard(self)
+
+    def stats(self):
+        """プールの利用状況を返す
+        * @return dict 接続数・使用中・待機中・待ちリクエスト数など
+        """
+        with self._cond:
+            idle = len(self._idle)
+            return {
+                'name': self.name,
+                'size': self._size,
+                'max_size': self.max_size,
+                'in_use': self._size - idle,
+                'idle': idle,
+                'waiting': self._waiting,
+            }
+
+
+def collect_pool_metrics():
+    """全プールの利用状況をゲージに反映する (/metrics の出力直前に呼ばれる)"""
+    with _pools_lock:
+        pools = list(_pools)
+    for pool in pools:
+        stats = pool.stats()
+        pool_size.set(stats['size'], pool=pool.name)
+        pool_max_size.set(stats['max_size'], pool=pool.name)
+        pool_in_use.set(stats['in_use'], pool=pool.name)
+        pool_idle.set(stats['idle'], pool=pool.name)
+        pool_waiting.set(stats['waiting'], pool=pool.name)
+
+
+REGISTRY.add_collector(collect_pool_metrics)
@@ -0,0 +1,175 @@
+import numpy as np
+
+from .calculations import FACTOR_DISTANCE_MAP, FACTOR_SURFACE_MAP, FACTOR_STYLE_MAP
+
+# 因子カテゴリ (適性行列の列順)
+FACTOR_CATEGORIES = ("芝", "ダート", "短距離", "マイル", "中距離", "長距離", "逃げ", "先行", "差し", "追込")
+_CATEGORY_INDEX = {name: idx for idx, name in enumerate(FACTOR_CATEGORIES)}
+
+# FACTOR_CATEGORIES と同じ順序のウマ娘モデルの適性フィールド
+_APTITUDE_FIELDS = (
+    'turf_aptitude', 'dirt_aptitude',
+    'sprint_aptitude', 'mile_aptitude', 'classic_aptitude', 'long_distance_aptitude',
+    'front_runner_aptitude', 'early_foot_aptitude', 'midfield_aptitude', 'closer_aptitude',
+)
+
+APTITUDE_VALUE_MAP = {'S': 4, 'A': 3, 'B': 2, 'C': 1, 'D': 0, 'E': -1, 'F': -2, 'G': -3}
+# 想定外の適性文字はどの補強条件にも一致しない値として扱う
+_UNKNOWN_APTITUDE = 99
+
+_TURF = _CATEGORY_INDEX["芝"]
+_DIRT = _CATEGORY_INDEX["ダート"]
+_SPRINT = _CATEGORY_INDEX["短距離"]
+_MILE = _CATEGORY_INDEX["マイル"]
+_CLASSIC = _CATEGORY_INDEX["中距離"]
+_LONG = _CATEGORY_INDEX["長距離"]
+_MIDFIELD = _CATEGORY_INDEX["差し"]
+
+# calculate_aptitude_factors の優先順位
+_E_PRIORITY = (_MILE, _CLASSIC, _LONG, _SPRINT, _DIRT)
+_D_PRIORITY = np.array([_CLASSIC, _MILE, _LONG, _SPRINT, _DIRT])
+
+
+def build_aptitude_matrix(umamusumes):
+    """ウマ娘のリストを適性値の行列に変換する
+    * @param umamusumes ウマ娘オブジェクトのリスト
+    * @return ndarray (ウマ娘数, 因子カテゴリ数) の適性値行列
+    """
+    matrix = np.full((len(umamusumes), len(FACTOR_CATEGORIES)), _UNKNOWN_APTITUDE, dtype=np.int16)
+    for row, umamusume in enumerate(umamusumes):
+        for col, field in enumerate(_APTITUDE_FIELDS):
+            matrix[row, col] = APTITUDE_VALUE_MAP.get(getattr(umamusume, field), _UNKNOWN_APTITUDE)
+    return matrix
+
+
+def vectorized_aptitude_factors(aptitudes, surface_idx, style_idx):
+    """calculate_aptitude_factors をウマ娘の行列に対して一括で適用する
+    * @param aptitudes 適性値行列
+    * @param surface_idx 目標の馬場因子のカテゴリ番号
+    * @param style_idx 目標の脚質因子のカテゴリ番号
+    * @return tuple 因子ペアのカテゴリ番号配列 (factor_one, factor_two)
+    """
+    count = len(aptitudes)
+    factor_one = np.full(count, surface_idx)
+    factor_two = np.full(count, style_idx)
+    decided = np.zeros(count, dtype=bool)
+
+    def assign(mask, first, second):
+        target = mask & ~decided
+        factor_one[target] = first[target] if isinstance(first, np.ndarray) else first
+        factor_two[target] = second[target] if isinstance(second, np.ndarray) else second
+        decided[target] = True
+
+    # 優先度1: ダート適性 'G' or 'F'
+    assign(aptitudes[:, _DIRT] <= -2, _DIRT, _DIRT)
+
+    # 優先度2: E適性の補強 (マイル > 中距離 > 長距離 > 短距離 > ダート)
+    for col in _E_PRIORITY:
+        assign(aptitudes[:, col] == -1, col, col)
+
+    # 優先度3: D適性の補強 (中距離 > マイル > 長距離 > 短距離 > ダート)
+    is_d = aptitudes[:, _D_PRIORITY] == 0
+    d_count = is_d.sum(axis=1)
+    first_d = _D_PRIORITY[np.argmax(is_d, axis=1)]
+    second_d = _D_PRIORITY[np.argmax(is_d & (np.cumsum(is_d, axis=1) == 2), axis=1)]
+    assign(d_count >= 2, first_d, second_d)
+    # D適性が1つだけの場合は、補強因子と異なる方の目標因子を組み合わせる
+    assign(d_count == 1, first_d, np.where(first_d != surface_idx, surface_idx, style_idx))
+
+    return factor_one, factor_two
+
+
+def build_factor_counts(aptitudes, surface_idx, style_idx):
+    """各ウマ娘を祖父母にした場合に継承される因子の個数をカテゴリ別に集計する
+    calculate_parent_factors のパターンと同様に、メイン因子2個とサブ因子ペア2組を数える。
+    * @param aptitudes 適性値行列
+    * @param surface_idx 目標の馬場因子のカテゴリ番号
+    * @param style_idx 目標の脚質因子のカテゴリ番号
+    * @return tuple (因子個数行列, factor_one配列, factor_two配列)
+    """
+    factor_one, factor_two = vectorized_aptitude_factors(aptitudes, surface_idx, style_idx)
+    rows = np.arange(len(aptitudes))
+    counts = np.zeros((len(aptitudes), len(FACTOR_CATEGORIES)), dtype=np.int16)
+
+    # メイン因子プール: サブ因子が「差し」x2なら「芝」x2、「芝」x2なら「差し」x2
+    main_one = np.full(len(aptitudes), surface_idx)
+    main_two = np.full(len(aptitudes), style_idx)
+    midfield_pair = (factor_one == _MIDFIELD) & (factor_two == _MIDFIELD)
+    turf_pair = (factor_one == _TURF) & (factor_two == _TURF)
+    main_one[midfield_pair] = main_two[midfield_pair] = _TURF
+    main_one[turf_pair] = main_two[turf_pair] = _MIDFIELD
+
+    np.add.at(counts, (rows, main_one), 1)
+    np.add.at(counts, (rows, main_two), 1)
+    np.add.at(counts, (rows, factor_one), 2)
+    np.add.at(counts, (rows, factor_two), 2)
+    return counts, factor_one, factor_two
+
+
+def _required_factor_counts(target_aptitudes, target_categories):
+    """目標カテゴリごとに、補強に必要な因子数を求める
+    calculate_factor_composition と同じ基準 (G〜E:4, D:3, C:2) で、十分な適性でも1個は評価する。
+    """
+    required = np.zeros(len(FACTOR_CATEGORIES), dtype=np.int16)
+    for col in target_categories:
+        value = target_aptitudes[col]
+        if value <= -1:
+            required[col] = 4
+        elif value == 0:
+            required[col] = 3
+        elif value == 1:
+            required[col] = 2
+        else:
+            required[col] = 1
+    return required
+
+
+def search_best_lineages(target_umamusume, candidates, surface_id, distance_id, style_id, limit=10):
+    """所持ウマ娘の全ペアを祖父母候補として評価し、上位の血統を返す
+    スコアは目標の馬場・距離・脚質について、必要数を上限とした継承因子数の合計。
+    同点の場合は祖父母自身の目標適性の合計が高い方を優先する。
+    * @param target_umamusume 育成対象のウマ娘オブジェクト
+    * @param candidates 祖父母候補のウマ娘オブジェクトのリスト
+    * @param surface_id 馬場ID (1:芝, 2:ダート)
+    * @param distance_id 距離ID (1:短距離, 2:マイル, 3:中距離, 4:長距離)
+    * @param style_id 脚質ID (1:逃げ, 2:先行, 3:差し, 4:追込)
+    * @param limit 返却する血統数
+    * @return list 血統候補リスト (スコア降順)
+    """
+    candidates = [c for c in candidates if c.umamusume_id != target_umamusume.umamusume_id]
+    if len(candidates) < 2:
+        return []
+
+    surface_idx = _CATEGORY_INDEX[FACTOR_SURFACE_MAP[surface_id]]
+    distance_idx = _CATEGORY_INDEX[FACTOR_DISTANCE_MAP[distance_id]]
+    style_idx = _CATEGORY_INDEX[FACTOR_STYLE_MAP[style_id]]
+    target_categories = (surface_idx, distance_idx, style_idx)
+
+    aptitudes = build_aptitude_matrix(candidates)
+    counts, factor_one, factor_two = build_factor_counts(aptitudes, surface_idx, style_idx)
+    required = _required_factor_counts(build_aptitude_matrix([target_umamusume])[0], target_categories)
+
+    # 全ペア (i < j) の因子数を合算し、必要数を上限にスコア化する
+    first_idx, second_idx = np.triu_indices(len(candidates), k=1)
+    pair_counts = counts[first_idx] + counts[second_idx]
+    reinforcement = np.minimum(pair_counts, required).sum(axis=1)
+
+    own_aptitudes = np.where(aptitudes == _UNKNOWN_APTITUDE, 0, aptitudes)[:, list(target_categories)].sum(axis=1)
+    affinity = own_aptitudes[first_idx] + own_aptitudes[second_idx]
+
+    order = np.lexsort((-affinity, -reinforcement))[:limit]
+
+    lineages = []
+    for pair in order:
+        i, j = first_idx[pair], second_idx[pair]
+        lineages.append({
+            'grandparent': {'umamusume_id': candidates[i].umamusume_id, 'umamusume_name': candidates[i].umamusume_name},
+            'grandmother': {'umamusume_id': candidates[j].umamusume_id, 'umamusume_name': candidates[j].umamusume_name},
+            'score': int(reinforcement[pair]),
+            'affinity': int(affinity[pair]),
+            'factors': {
+                'grandparent_a': [FACTOR_CATEGORIES[factor_one[i]], FACTOR_CATEGORIES[factor_two[i]]],
+                'grandparent_b': [FACTOR_CATEGORIES[factor_one[j]], FACTOR_CATEGORIES[factor_two[j]]],
+            },
+        })
+    return lineages
@@ -2,7 +2,11 @@ import json
 import os
 from datetime import datetime
 from django.core.management.base import BaseCommand
+from django.db import DEFAULT_DB_ALIAS
 from uma_api.models import *
+from uma_api.catalog import refresh_default_race_plans
+from uma_api.response_cache import bump_catalog_version
+from uma_api.sharding import get_shards, sync_catalog
 
 class Command(BaseCommand):
     """初期データをJSONファイルから読み込むDjangoコマンド
@@ -11,6 +15,9 @@ class Command(BaseCommand):
     """
     help = 'Load initial data from JSON files'
 
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=1, help='既定レースパターンを作成するプロセス数 (既定: 1)')
+
     def handle(self, *args, **options):
         """メイン処理メソッド
         * @param args コマンドライン引数
@@ -40,6 +47,20 @@ class Command(BaseCommand):
                 live_data = json.load(f)
             self.load_lives(live_data)
 
+        # シャードを使用している場合は、シャードのマスタも更新する (シャード内でマスタと結合して参照するため)
+        for alias in get_shards():
+            if alias == DEFAULT_DB_ALIAS:
+                continue
+            counts = sync_catalog(alias)
+            self.stdout.write(f"{alias}: マスタを複製しました ({', '.join(f'{name}:{count}' for name, count in counts.items())})")
+
+        # マスタに依存するキャッシュ (APIレスポンス・既定レースパターンなど) を無効にする
+        bump_catalog_version()
+
+        # 出走済みレースがない場合のレースパターン・目安育成数を作成する
+        built, total = refresh_default_race_plans(options['workers'])
+        self.stdout.write(f'既定レースパターンを作成しました ({built}/{total}件)')
+
     # ------------------ RACE ------------------ #
     def load_races(self, race_data):
         """レースデータをロードするメソッド
@@ -174,6 +195,8 @@ class Command(BaseCommand):
         * @param live_data ライブデータ辞書
         * @return None
         """
+        # 歌唱ウマ娘の名前解決用に、ウマ娘を一括で取得しておく (N+1問題対策)
+        umamusume_by_name = {umamusume.umamusume_name: umamusume for umamusume in Umamusume.objects.all()}
         for live_name, live_info in live_data.items():
             if not Live.objects.filter(live_name=live_info['曲名']).exists():
                 live = Live.objects.create(
@@ -185,19 +208,19 @@ class Command(BaseCommand):
                 
                 singers = live_info['歌唱ウマ娘']
                 if '1' in singers and singers['1'] == 'all':
-                    for umamusume in Umamusume.objects.all():
+                    for umamusume in umamusume_by_name.values():
                         if not VocalUmamusume.objects.filter(live=live, umamusume=umamusume).exists():
                             VocalUmamusume.objects.create(live=live, umamusume=umamusume)
                     self.stdout.write(f'{live_info["曲名"]}に全員を登録しました。')
                 else:
                     for singer_name in singers.values():
-                        try:
-                            umamusume = Umamusume.objects.get(umamusume_name=singer_name)
-                            if not VocalUmamusume.objects.filter(live=live, umamusume=umamusume).exists():
-                                VocalUmamusume.objects.create(live=live, umamusume=umamusume)
-                                self.stdout.write(f'{live_info["曲名"]}に{singer_name}を登録しました。')
-                        except Umamusume.DoesNotExist:
+                        umamusume = umamusume_by_name.get(singer_name)
+                        if umamusume is None:
                             self.stdout.write(f'ウマ娘 {singer_name} が見つかりません。')
+                            continue
+                        if not VocalUmamusume.objects.filter(live=live, umamusume=umamusume).exists():
+                            VocalUmamusume.objects.create(live=live, umamusume=umamusume)
+                            self.stdout.write(f'{live_info["曲名"]}に{singer_name}を登録しました。')
 
     # ------------------ HELPERS ------------------ #
     def get_race_distance(self, distance_str):
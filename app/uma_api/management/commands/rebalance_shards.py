@@ -0,0 +1,50 @@
+from django.core.management.base import BaseCommand
+from django.db import DEFAULT_DB_ALIAS
+from uma_api.sharding import find_user_ids, get_shards, move_user, shard_for_user, sync_catalog
+
+class Command(BaseCommand):
+    """マスタを全シャードに複製し、割り当てと異なるDBにあるユーザー別データを移動するDjangoコマンド
+    シャードの追加・削除後や、単一DBからシャード構成に移行する際に実行する。
+    * @param args コマンドライン引数
+    * @param options コマンドオプション
+    """
+    help = 'Replicate catalog tables to every shard and move user data to its assigned shard'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help='移動対象のユーザーを表示するだけで変更しない')
+        parser.add_argument('--skip-catalog', action='store_true', help='マスタの複製を行わない')
+
+    def handle(self, *args, **options):
+        """メイン処理メソッド
+        * @param args コマンドライン引数
+        * @param options コマンドオプション
+        * @return None
+        """
+        shards = get_shards()
+        dry_run = options['dry_run']
+
+        if not options['skip_catalog'] and not dry_run:
+            for alias in shards:
+                if alias == DEFAULT_DB_ALIAS:
+                    continue
+                counts = sync_catalog(alias)
+                self.stdout.write(f"{alias}: マスタを複製しました ({', '.join(f'{name}:{count}' for name, count in counts.items())})")
+
+        # シャードに含まれない default も移動元として確認する (単一DBからの移行)
+        moved_users = 0
+        for source in dict.fromkeys([DEFAULT_DB_ALIAS, *shards]):
+            for user_id in sorted(find_user_ids(source)):
+                target = shard_for_user(user_id, shards)
+                if target == source:
+                    continue
+                moved_users += 1
+                if dry_run:
+                    self.stdout.write(f'user_id:{user_id} {source} -> {target}')
+                    continue
+                counts = move_user(user_id, source, target)
+                self.stdout.write(
+                    f"user_id:{user_id} {source} -> {target} ({', '.join(f'{name}:{count}' for name, count in counts.items())})"
+                )
+
+        message = f'移動対象のユーザー: {moved_users}人' if dry_run else f'{moved_users}人のデータを移動しました'
+        self.stdout.write(self.style.SUCCESS(message))
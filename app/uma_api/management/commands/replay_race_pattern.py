@@ -0,0 +1,77 @@
+import cProfile
+import io
+import json
+import os
+import pstats
+import time
+from django.core.management.base import BaseCommand, CommandError
+from uma_api.profiling import get_profile_dir
+from uma_api.racePattern import build_race_pattern_data, load_race_pattern_inputs_by_race_ids, race_pattern_digest
+
+class Command(BaseCommand):
+    """保存したプロファイルの入力スナップショットから、レースパターン生成をオフラインで再現するDjangoコマンド
+    * @param args コマンドライン引数
+    * @param options コマンドオプション
+    """
+    help = 'Replay a captured race pattern profile snapshot'
+
+    def add_arguments(self, parser):
+        parser.add_argument('snapshot', help='スナップショットJSONのパス、またはプロファイルID')
+        parser.add_argument('--repeat', type=int, default=1, help='パターン生成の繰り返し回数')
+        parser.add_argument('--sort', default='cumulative', help='プロファイル結果のソートキー')
+        parser.add_argument('--limit', type=int, default=30, help='表示する関数の数')
+        parser.add_argument('--output', help='再現時のプロファイル(.prof)の出力先')
+
+    def handle(self, *args, **options):
+        """メイン処理メソッド
+        * @param args コマンドライン引数
+        * @param options コマンドオプション
+        * @return None
+        """
+        data = self.load_snapshot(options['snapshot'])
+        snapshot = data['snapshot']
+
+        # データ取得は計測対象外 (カタログは現在のDBから読み込む)
+        inputs = load_race_pattern_inputs_by_race_ids(
+            snapshot['umamusume_id'], remaining_race_ids=set(snapshot['remaining_race_ids'])
+        )
+        if len(inputs[1]) != len(snapshot['remaining_race_ids']):
+            self.stderr.write(self.style.WARNING('スナップショットの残レースの一部が現在のDBに存在しません'))
+
+        profile = cProfile.Profile()
+        start = time.perf_counter()
+        for _ in range(max(options['repeat'], 1)):
+            profile.enable()
+            race_pattern = build_race_pattern_data(*inputs)
+            profile.disable()
+        elapsed = time.perf_counter() - start
+
+        stream = io.StringIO()
+        pstats.Stats(profile, stream=stream).sort_stats(options['sort']).print_stats(options['limit'])
+        self.stdout.write(stream.getvalue())
+
+        self.stdout.write(f"パターン数: {len(race_pattern['patterns'])}")
+        self.stdout.write(f"処理時間: {elapsed / max(options['repeat'], 1):.4f}秒/回 (取得時: {data.get('elapsed', 0):.4f}秒)")
+        self.stdout.write(f"SQL件数 (取得時): {len(data.get('queries', []))}")
+
+        expected_digest = snapshot.get('result_digest')
+        if expected_digest:
+            if race_pattern_digest(race_pattern) == expected_digest:
+                self.stdout.write(self.style.SUCCESS('取得時と同じ結果を再現しました'))
+            else:
+                self.stdout.write(self.style.WARNING('取得時と結果が異なります (カタログが変更された可能性があります)'))
+
+        if options['output']:
+            profile.dump_stats(options['output'])
+            self.stdout.write(f"プロファイルを出力しました: {options['output']}")
+
+    def load_snapshot(self, snapshot):
+        """スナップショットJSONを読み込む
+        * @param snapshot JSONのパス、またはプロファイルID
+        * @return dict スナップショットデータ
+        """
+        path = snapshot if os.path.exists(snapshot) else os.path.join(get_profile_dir(), f'{snapshot}.json')
+        if not os.path.exists(path):
+            raise CommandError(f'スナップショットが見つかりません: {snapshot}')
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
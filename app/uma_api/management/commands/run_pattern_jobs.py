@@ -0,0 +1,58 @@
+import multiprocessing
+import signal
+import threading
+
+import django
+from django.core.management.base import BaseCommand
+from django.db import connections
+from uma_api.pattern_jobs import default_worker_name, work
+
+
+def _run_worker(index, poll_interval):
+    """ワーカープロセスのメイン処理 (SIGTERMで実行中のジョブの完了後に終了する)"""
+    django.setup()
+    stop_event = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop_event.set())
+    work(default_worker_name(index), poll_interval=poll_interval, stop_event=stop_event)
+
+
+class Command(BaseCommand):
+    """pattern_job_table の待機中のレースパターン生成ジョブを実行するDjangoコマンド
+    外部のメッセージブローカーは使わず、DBを定期的に確認してジョブを取得する。複数起動しても同じジョブは1回だけ実行される。
+    * @param args コマンドライン引数
+    * @param options コマンドオプション
+    """
+    help = 'Run queued race pattern jobs from the database'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=1, help='ワーカープロセス数 (既定: 1)')
+        parser.add_argument('--poll-interval', type=float, default=1.0, help='待機中のジョブがない場合にDBを確認する間隔(秒)')
+        parser.add_argument('--once', action='store_true', help='待機中のジョブをすべて実行したら終了する')
+
+    def handle(self, *args, **options):
+        """メイン処理メソッド
+        * @param args コマンドライン引数
+        * @param options コマンドオプション
+        * @return None
+        """
+        workers = options['workers']
+        poll_interval = options['poll_interval']
+
+        if options['once'] or workers == 1:
+            processed = work(default_worker_name(), poll_interval=poll_interval, once=options['once'])
+            self.stdout.write(self.style.SUCCESS(f'{processed}件のジョブを実行しました'))
+            return
+
+        # fork したワーカーが親プロセスのDB接続を共有しないよう、先に閉じておく
+        connections.close_all()
+        processes = [
+            multiprocessing.Process(target=_run_worker, args=(index, poll_interval), name=f'pattern-job-{index}')
+            for index in range(workers)
+        ]
+        for process in processes:
+            process.start()
+        # 停止時はワーカーに SIGTERM を送り、実行中のジョブの完了を待つ
+        signal.signal(signal.SIGTERM, lambda signum, frame: [process.terminate() for process in processes])
+        self.stdout.write(f'{workers}個のワーカーを起動しました')
+        for process in processes:
+            process.join()
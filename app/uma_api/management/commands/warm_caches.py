@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand
+from uma_api.catalog import warm_caches
+
+class Command(BaseCommand):
+    """マスタのAPIレスポンス・G1〜G3レース一覧・全ウマ娘の既定レースパターンを作成してキャッシュするDjangoコマンド
+    デプロイ後や load_data の実行後に、初回リクエストの遅延を避けるために実行する。
+    * @param args コマンドライン引数
+    * @param options コマンドオプション
+    """
+    help = 'Pre-build catalog responses and default race patterns into the cache'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=None, help='既定レースパターンを作成するプロセス数 (省略時はCPU数、1の場合は並列化しない)')
+
+    def handle(self, *args, **options):
+        """メイン処理メソッド
+        * @param args コマンドライン引数
+        * @param options コマンドオプション
+        * @return None
+        """
+        total = 0.0
+        for name, count, seconds in warm_caches(workers=options['workers']):
+            total += seconds
+            self.stdout.write(f'{name}: {count}件 ({seconds:.2f}秒)')
+        self.stdout.write(self.style.SUCCESS(f'キャッシュを作成しました ({total:.2f}秒)'))
@@ -0,0 +1,306 @@
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import partial
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseForbidden
+
+# ヒストグラムのバケット境界
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100, 200, 500)
+RESPONSE_SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+
+def _escape_label_value(value):
+    """Prometheusのラベル値をエスケープする"""
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(label_names, label_values, extra=None):
+    """ラベルを {name="value",...} 形式の文字列にする"""
+    pairs = [f'{name}="{_escape_label_value(value)}"' for name, value in zip(label_names, label_values)]
+    if extra:
+        pairs.extend(f'{name}="{_escape_label_value(value)}"' for name, value in extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_value(value):
+    """数値をPrometheusのテキスト形式に変換する"""
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    """メトリクスの基底クラス
+    * @param name メトリクス名
+    * @param help_text 説明文
+    * @param label_names ラベル名のタプル
+    """
+    metric_type = 'untyped'
+
+    def __init__(self, name, help_text, label_names=()):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self._lock = threading.Lock()
+        self._series = {}
+
+    def _key(self, labels):
+        return tuple(labels.get(name, '') for name in self.label_names)
+
+    def render(self):
+        """Prometheusテキスト形式の行リストを返す"""
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} {self.metric_type}']
+        with self._lock:
+            series = sorted(self._series.items())
+            lines.extend(self._render_series(series))
+        return lines
+
+    def _render_series(self, series):
+        for key, value in series:
+            yield f'{self.name}{_format_labels(self.label_names, key)} {_format_value(value)}'
+
+    def clear(self):
+        """全系列を削除する"""
+        with self._lock:
+            self._series.clear()
+
+
+class Counter(_Metric):
+    """単調増加するカウンタ"""
+    metric_type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._series[key] = self._series.get(key, 0) + amount
+
+    def value(self, **labels):
+        with self._lock:
+            return self._series.get(self._key(labels), 0)
+
+
+class Gauge(_Metric):
+    """任意の値を設定するゲージ"""
+    metric_type = 'gauge'
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._series[self._key(labels)] = value
+
+    def value(self, **labels):
+        with self._lock:
+            return self._series.get(self._key(labels), 0)
+
+
+class Histogram(_Metric):
+    """バケット別の観測数・合計・件数を保持するヒストグラム
+    * @param buckets バケット境界 (昇順)
+    """
+    metric_type = 'histogram'
+
+    def __init__(self, name, help_text, buckets, label_names=()):
+        super().__init__(name, help_text, label_names)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                # [バケット別件数..., +Inf件数] と合計値
+                series = self._series[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][bisect_left(self.buckets, value)] += 1
+            series[1] += value
+
+    def snapshot(self, **labels):
+        """指定ラベルの (件数, 合計) を返す"""
+        with self._lock:
+            series = self._series.get(self._key(labels))
+            if series is None:
+                return 0, 0.0
+            return sum(series[0]), series[1]
+
+    def _render_series(self, series):
+        for key, (counts, total) in series:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                labels = _format_labels(self.label_names, key, extra=[('le', _format_value(float(bound)))])
+                yield f'{self.name}_bucket{labels} {cumulative}'
+            labels = _format_labels(self.label_names, key)
+            yield f'{self.name}_sum{labels} {_format_value(total)}'
+            yield f'{self.name}_count{labels} {cumulative}'
+
+
+class MetricsRegistry:
+    """プロセス内のメトリクスを保持するレジストリ"""
+    def __init__(self):
+        self._metrics = {}
+        self._collectors = []
+        self._lock = threading.Lock()
+
+    def _register(self, metric):
+        with self._lock:
+            return self._metrics.setdefault(metric.name, metric)
+
+    def counter(self, name, help_text, label_names=()):
+        return self._register(Counter(name, help_text, label_names))
+
+    def gauge(self, name, help_text, label_names=()):
+        return self._register(Gauge(name, help_text, label_names))
+
+    def histogram(self, name, help_text, buckets, label_names=()):
+        return self._register(Histogram(name, help_text, buckets, label_names))
+
+    def add_collector(self, collector):
+        """出力直前に呼ばれるコールバックを登録する (ゲージの値更新などに使用)
+        * @param collector 引数なしの関数
+        """
+        with self._lock:
+            if collector not in self._collectors:
+                self._collectors.append(collector)
+
+    def render(self):
+        """全メトリクスをPrometheusテキスト形式で出力する
+        * @return str メトリクス文字列
+        """
+        for collector in list(self._collectors):
+            collector()
+        lines = []
+        for metric in sorted(self._metrics.values(), key=lambda m: m.name):
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = MetricsRegistry()
+
+request_count = REGISTRY.counter(
+    'uma_api_requests_total', 'APIリクエスト数', ('view', 'method', 'status'))
+request_duration = REGISTRY.histogram(
+    'uma_api_request_duration_seconds', 'APIの処理時間(秒)', LATENCY_BUCKETS, ('view', 'method'))
+request_db_queries = REGISTRY.histogram(
+    'uma_api_request_db_queries', '1リクエストあたりのDBクエリ数', QUERY_COUNT_BUCKETS, ('view', 'method'))
+request_db_duration = REGISTRY.histogram(
+    'uma_api_request_db_duration_seconds', '1リクエストあたりのDB処理時間(秒)', LATENCY_BUCKETS, ('view', 'method'))
+response_size = REGISTRY.histogram(
+    'uma_api_response_size_bytes', 'レスポンスサイズ(バイト)', RESPONSE_SIZE_BUCKETS, ('view', 'method'))
+
+
+# 現在のリクエストでSQLを監視する関数のタプル (execute_wrapper と同じ引数で呼ばれる)
+# ASGIでは同期ビューが別スレッド (別のDB接続) で実行されるため、接続ではなくコンテキストに紐付けて引き継ぐ
+_query_observers = ContextVar('uma_api_query_observers', default=())
+
+
+@contextmanager
+def observe_queries(*observers):
+    """ブロック内 (sync_to_async で実行されるスレッドを含む) で実行されたSQLを監視する
+    * @param observers execute_wrapper と同じ引数を受け取る関数
+    """
+    token = _query_observers.set(_query_observers.get() + observers)
+    try:
+        yield
+    finally:
+        _query_observers.reset(token)
+
+
+def _execute_with_observers(execute, sql, params, many, context):
+    """全DB接続に登録する execute_wrapper (監視する関数がある場合のみ経由させる)"""
+    for observer in reversed(_query_observers.get()):
+        execute = partial(observer, execute)
+    return execute(sql, params, many, context)
+
+
+def install_query_observers(connection, **kwargs):
+    """DB接続に監視用の execute_wrapper を登録する (connection_created シグナルから呼ばれる)
+    * @param connection DB接続
+    """
+    if _execute_with_observers not in connection.execute_wrappers:
+        connection.execute_wrappers.append(_execute_with_observers)
+
+
+class QueryStats:
+    """observe_queries に渡し、クエリ数とDB処理時間を集計するクラス"""
+    def __init__(self):
+        self.count = 0
+        self.duration = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.duration += time.perf_counter() - start
+            self.count += 1
+
+
+def get_view_name(request):
+    """リクエストに対応するURL名を取得する (未解決の場合は 'unmatched')"""
+    resolver_match = getattr(request, 'resolver_match', None)
+    if resolver_match is None:
+        return 'unmatched'
+    return resolver_match.url_name or resolver_match.view_name or 'unmatched'
+
+
+class MetricsMiddleware:
+    """API単位の処理時間・クエリ数・DB処理時間・レスポンスサイズを記録するミドルウェア
+    ASGIで非同期ビューを動かす場合に備え、同期・非同期の両方に対応する。
+    クエリは observe_queries で監視するため、ASGIで同期ビューが別スレッドで実行された場合も集計される。
+    * @param get_response 次の処理
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        stats = QueryStats()
+        start = time.perf_counter()
+        with observe_queries(stats):
+            response = self.get_response(request)
+        return self._record(request, response, stats, time.perf_counter() - start)
+
+    async def __acall__(self, request):
+        stats = QueryStats()
+        start = time.perf_counter()
+        with observe_queries(stats):
+            response = await self.get_response(request)
+        return self._record(request, response, stats, time.perf_counter() - start)
+
+    def _record(self, request, response, stats, elapsed):
+        labels = {'view': get_view_name(request), 'method': request.method}
+        request_count.inc(status=response.status_code, **labels)
+        request_duration.observe(elapsed, **labels)
+        request_db_queries.observe(stats.count, **labels)
+        request_db_duration.observe(stats.duration, **labels)
+        if not response.streaming:
+            response_size.observe(len(response.content), **labels)
+        return response
+
+
+# /metrics へのアクセスを許可する既定のIP (ローカルホストのみ)
+METRICS_DEFAULT_ALLOWED_IPS = ('127.0.0.1', '::1')
+
+
+def metrics_view(request):
+    """メトリクスをPrometheusテキスト形式で出力するエンドポイント
+    UMA_METRICS_ALLOWED_IPS に含まれるIPからのアクセスのみ許可する (既定はローカルホストのみ)。
+    * @param request HTTPリクエストオブジェクト
+    * @return HttpResponse メトリクス文字列
+    """
+    allowed_ips = getattr(settings, 'UMA_METRICS_ALLOWED_IPS', METRICS_DEFAULT_ALLOWED_IPS)
+    if request.META.get('REMOTE_ADDR') not in allowed_ips:
+        return HttpResponseForbidden()
+    return HttpResponse(REGISTRY.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
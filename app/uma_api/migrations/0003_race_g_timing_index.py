@@ -0,0 +1,21 @@
+# Generated by Django 4.2.5 on 2026-10-19 10:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('uma_api', '0002_alter_userpersonal_managers_userpersonal_groups_and_more'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='race',
+            index=models.Index(
+                condition=models.Q(('race_rank__in', [1, 2, 3])),
+                fields=['race_months', 'half_flag'],
+                name='race_g_timing_idx',
+            ),
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 4.2.5 on 2026-10-19 12:00
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('uma_api', '0003_race_g_timing_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DefaultRacePlan',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('catalog_hash', models.CharField(max_length=40)),
+                ('race_pattern', models.JSONField()),
+                ('breeding_count', models.IntegerField()),
+                ('created_date', models.DateTimeField()),
+                ('umamusume', models.ForeignKey(db_column='umamusume_id', on_delete=django.db.models.deletion.CASCADE, to='uma_api.umamusume')),
+            ],
+            options={
+                'db_table': 'default_race_plan_table',
+                'unique_together': {('umamusume', 'catalog_hash')},
+            },
+        ),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 4.2.5 on 2026-10-19 14:00
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import uuid
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('uma_api', '0004_defaultraceplan'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PatternJob',
+            fields=[
+                ('job_id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('count', models.IntegerField(blank=True, null=True)),
+                ('status', models.CharField(choices=[('pending', '待機中'), ('running', '実行中'), ('done', '完了'), ('failed', '失敗')], default='pending', max_length=10)),
+                ('result', models.JSONField(blank=True, null=True)),
+                ('error', models.CharField(blank=True, default='', max_length=255)),
+                ('worker', models.CharField(blank=True, default='', max_length=100)),
+                ('created_date', models.DateTimeField()),
+                ('started_date', models.DateTimeField(blank=True, null=True)),
+                ('finished_date', models.DateTimeField(blank=True, null=True)),
+                ('expire_date', models.DateTimeField()),
+                ('umamusume', models.ForeignKey(db_column='umamusume_id', on_delete=django.db.models.deletion.CASCADE, to='uma_api.umamusume')),
+                ('user', models.ForeignKey(db_column='user_id', on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'db_table': 'pattern_job_table',
+                'indexes': [models.Index(fields=['status', 'created_date'], name='pattern_job_status_idx')],
+            },
+        ),
+    ]
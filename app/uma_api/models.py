@@ -1,3 +1,5 @@
+import uuid
+
 from django.db import models
 from django.contrib.auth.hashers import make_password, check_password
 from django.contrib.auth.models import AbstractBaseUser, PermissionsMixin, BaseUserManager
@@ -112,6 +114,13 @@ class Race(models.Model):
 
     class Meta:
         db_table = 'race_table'
+        indexes = [
+            # 残レース検索 (set_remaining_race, set_race_return など) はG1〜G3のみを対象とするため部分インデックスにする
+            models.Index(
+                fields=['race_months', 'half_flag'], name='race_g_timing_idx',
+                condition=models.Q(race_rank__in=[1, 2, 3]),
+            ),
+        ]
 
 
 class ScenarioRace(models.Model):
@@ -158,3 +167,52 @@ class Jewel(models.Model):
     class Meta:
         db_table = 'user_jewel_table'
         unique_together = ('user', 'year', 'month', 'day')
+
+
+class DefaultRacePlan(models.Model):
+    """出走済みのG1〜G3レースがない場合のレースパターン・目安育成数 (load_data 実行時に作成する)
+    レースパターンの入力 (ウマ娘・シナリオレース・G1〜G3レース) のハッシュごとに保存する。
+    """
+    umamusume = models.ForeignKey(Umamusume, on_delete=models.CASCADE, db_column='umamusume_id')
+    catalog_hash = models.CharField(max_length=40)
+    race_pattern = models.JSONField()
+    breeding_count = models.IntegerField()
+    created_date = models.DateTimeField()
+
+    class Meta:
+        db_table = 'default_race_plan_table'
+        unique_together = ('umamusume', 'catalog_hash')
+
+
+class PatternJob(models.Model):
+    """バックグラウンドで実行するレースパターン生成ジョブ (run_pattern_jobs コマンドのワーカーが実行する)"""
+    STATUS_PENDING = 'pending'
+    STATUS_RUNNING = 'running'
+    STATUS_DONE = 'done'
+    STATUS_FAILED = 'failed'
+    STATUS_CHOICES = [
+        (STATUS_PENDING, '待機中'),
+        (STATUS_RUNNING, '実行中'),
+        (STATUS_DONE, '完了'),
+        (STATUS_FAILED, '失敗'),
+    ]
+
+    job_id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    user = models.ForeignKey(UserPersonal, on_delete=models.CASCADE, db_column='user_id')
+    umamusume = models.ForeignKey(Umamusume, on_delete=models.CASCADE, db_column='umamusume_id')
+    count = models.IntegerField(blank=True, null=True)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=STATUS_PENDING)
+    result = models.JSONField(blank=True, null=True)
+    error = models.CharField(max_length=255, blank=True, default='')
+    worker = models.CharField(max_length=100, blank=True, default='')
+    created_date = models.DateTimeField()
+    started_date = models.DateTimeField(blank=True, null=True)
+    finished_date = models.DateTimeField(blank=True, null=True)
+    expire_date = models.DateTimeField()
+
+    class Meta:
+        db_table = 'pattern_job_table'
+        indexes = [
+            # ワーカーが待機中のジョブを古い順に取得する
+            models.Index(fields=['status', 'created_date'], name='pattern_job_status_idx'),
+        ]
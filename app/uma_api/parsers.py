@@ -0,0 +1,31 @@
+import json
+
+import msgpack
+from rest_framework.exceptions import ParseError
+from rest_framework.parsers import BaseParser
+
+
+class MessagePackParser(BaseParser):
+    """MessagePack のリクエストボディを読み込むパーサー (Content-Type: application/msgpack)"""
+    media_type = 'application/msgpack'
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        try:
+            return msgpack.unpackb(stream.read(), raw=False)
+        except (ValueError, TypeError) as e:
+            raise ParseError(f'MessagePackの形式が正しくありません: {e}')
+
+
+def parse_request_body(request):
+    """DRFの Request を使わないビュー (非同期ビューなど) で、Content-Type に応じてリクエストボディを読み込む
+    MessagePack 以外は JSON として読み込む。
+    * @param request HTTPリクエストオブジェクト
+    * @return 読み込んだデータ
+    * @raise ValueError 形式が正しくない場合
+    """
+    if request.content_type == MessagePackParser.media_type:
+        try:
+            return msgpack.unpackb(request.body, raw=False)
+        except TypeError as e:
+            raise ValueError(e)
+    return json.loads(request.body)
@@ -0,0 +1,180 @@
+import asyncio
+import os
+import socket
+import threading
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import close_old_connections
+from django.db.models import Q
+from django.utils import timezone
+
+from .metrics import REGISTRY
+from .models import PatternJob
+from .racePattern import get_race_pattern_data
+from .sharding import user_shard
+
+pattern_job_count = REGISTRY.counter('uma_api_pattern_jobs_total', 'レースパターン生成ジョブの件数', ('status',))
+
+
+def _get_ttl():
+    return getattr(settings, 'UMA_PATTERN_JOB_TTL_SECONDS', 600)
+
+
+def _get_timeout():
+    return getattr(settings, 'UMA_PATTERN_JOB_TIMEOUT_SECONDS', 300)
+
+
+def submit_pattern_job(user_id, umamusume_id, count):
+    """レースパターン生成ジョブを登録する
+    同じユーザー・ウマ娘・カウントの待機中または実行中のジョブがある場合は、新たに登録せずにそのジョブを返す。
+    * @param user_id ユーザーID
+    * @param umamusume_id ウマ娘ID
+    * @param count カウント
+    * @return PatternJob 登録したジョブ
+    """
+    now = timezone.now()
+    job = PatternJob.objects.filter(
+        user_id=user_id, umamusume_id=umamusume_id, count=count,
+        status__in=[PatternJob.STATUS_PENDING, PatternJob.STATUS_RUNNING], expire_date__gt=now,
+    ).order_by('created_date').first()
+    if job is None:
+        job = PatternJob.objects.create(
+            user_id=user_id, umamusume_id=umamusume_id, count=count,
+            created_date=now, expire_date=now + timedelta(seconds=_get_ttl()),
+        )
+        pattern_job_count.inc(status='submitted')
+    return job
+
+
+def get_pattern_job(job_id, user_id):
+    """ユーザーのジョブを取得する (保持期間を過ぎたジョブは取得しない)
+    * @param job_id ジョブID
+    * @param user_id ユーザーID
+    * @return PatternJob ジョブ (存在しない場合はNone)
+    """
+    return PatternJob.objects.filter(job_id=job_id, user_id=user_id, expire_date__gt=timezone.now()).first()
+
+
+def _is_finished(job):
+    return job.status in (PatternJob.STATUS_DONE, PatternJob.STATUS_FAILED)
+
+
+async def aget_pattern_job(job_id, user_id):
+    """ユーザーのジョブを取得する (get_pattern_job の非同期版)
+    * @param job_id ジョブID
+    * @param user_id ユーザーID
+    * @return PatternJob ジョブ (存在しない場合はNone)
+    """
+    return await PatternJob.objects.filter(job_id=job_id, user_id=user_id, expire_date__gt=timezone.now()).afirst()
+
+
+async def await_pattern_job(job_id, user_id, timeout, interval=0.5):
+    """ジョブが完了 (または失敗) するか、timeout 秒が経過するまで待って取得する (ロングポーリング)
+    待つ間は asyncio.sleep でイベントループに処理を返すため、待機中も他のリクエストを処理できる。
+    * @param job_id ジョブID
+    * @param user_id ユーザーID
+    * @param timeout 待つ秒数 (0の場合は待たない)
+    * @param interval DBを確認する間隔(秒)
+    * @return PatternJob ジョブ (存在しない場合はNone)
+    """
+    deadline = time.monotonic() + timeout
+    while True:
+        job = await aget_pattern_job(job_id, user_id)
+        remaining = deadline - time.monotonic()
+        if job is None or _is_finished(job) or remaining <= 0:
+            return job
+        await asyncio.sleep(min(interval, remaining))
+
+
+def get_retry_after(job):
+    """未完了のジョブを再取得するまでの秒数を返す (完了したジョブはNone)
+    * @param job ジョブ
+    * @return int Retry-After の秒数
+    """
+    if _is_finished(job):
+        return None
+    return getattr(settings, 'UMA_PATTERN_JOB_RETRY_AFTER_SECONDS', 2)
+
+
+def claim_next_job(worker_name):
+    """待機中のジョブを古い順に1件取得し、実行中にする
+    タイムアウト (UMA_PATTERN_JOB_TIMEOUT_SECONDS) を過ぎた実行中のジョブは、ワーカーが停止したものとして再実行する。
+    状態を条件にした UPDATE で取得するため、複数のワーカーが同じジョブを実行することはない。
+    * @param worker_name ワーカー名
+    * @return PatternJob 取得したジョブ (ない場合はNone)
+    """
+    now = timezone.now()
+    claimable = PatternJob.objects.filter(
+        Q(status=PatternJob.STATUS_PENDING)
+        | Q(status=PatternJob.STATUS_RUNNING, started_date__lt=now - timedelta(seconds=_get_timeout())),
+        expire_date__gt=now,
+    )
+    for job in claimable.order_by('created_date')[:10]:
+        claimed = PatternJob.objects.filter(job_id=job.job_id, status=job.status, started_date=job.started_date).update(
+            status=PatternJob.STATUS_RUNNING, started_date=now, worker=worker_name,
+        )
+        if claimed:
+            job.status, job.started_date, job.worker = PatternJob.STATUS_RUNNING, now, worker_name
+            return job
+    return None
+
+
+def run_pattern_job(job):
+    """ジョブのレースパターンを生成して結果を保存する
+    * @param job 実行中にしたジョブ
+    * @return str 終了後の状態
+    """
+    try:
+        # ユーザー別データはジョブのユーザーのシャードから読み込む
+        with user_shard(job.user_id):
+            race_pattern = get_race_pattern_data(job.count, job.user_id, job.umamusume_id)
+        updates = {'status': PatternJob.STATUS_DONE, 'result': race_pattern}
+    except Exception as e:
+        updates = {'status': PatternJob.STATUS_FAILED, 'error': str(e)[:255]}
+    now = timezone.now()
+    # 結果の保持期間は完了時から数える
+    PatternJob.objects.filter(job_id=job.job_id, worker=job.worker).update(
+        finished_date=now, expire_date=now + timedelta(seconds=_get_ttl()), **updates,
+    )
+    pattern_job_count.inc(status=updates['status'])
+    return updates['status']
+
+
+def purge_expired_jobs():
+    """保持期間を過ぎたジョブを削除する
+    * @return int 削除件数
+    """
+    deleted, _ = PatternJob.objects.filter(expire_date__lte=timezone.now()).delete()
+    return deleted
+
+
+def default_worker_name(index=0):
+    """ワーカー名 (ホスト名:プロセスID:番号) を作成する"""
+    return f'{socket.gethostname()}:{os.getpid()}:{index}'
+
+
+def work(worker_name, poll_interval=1.0, once=False, stop_event=None):
+    """ジョブを取得して実行し続けるワーカーのメインループ
+    待機中のジョブがない間は poll_interval 秒ごとにDBを確認し、保持期間を過ぎたジョブを削除する。
+    * @param worker_name ワーカー名
+    * @param poll_interval 待機中のジョブがない場合にDBを確認する間隔(秒)
+    * @param once Trueの場合は待機中のジョブがなくなった時点で終了する
+    * @param stop_event 設定されると終了するイベント (省略時は終了しない)
+    * @return int 実行したジョブ数
+    """
+    stop_event = stop_event or threading.Event()
+    processed = 0
+    while not stop_event.is_set():
+        close_old_connections()
+        job = claim_next_job(worker_name)
+        if job is not None:
+            run_pattern_job(job)
+            processed += 1
+            continue
+        purge_expired_jobs()
+        if once:
+            break
+        stop_event.wait(poll_interval)
+    return processed
@@ -0,0 +1,101 @@
+import cProfile
+import json
+import os
+import time
+import uuid
+
+from django.conf import settings
+from django.utils import timezone
+
+from .authentication import is_staff_user
+from .metrics import observe_queries
+
+# プロファイル取得を要求するリクエストヘッダー (X-Uma-Profile: 1)
+PROFILE_HEADER = 'HTTP_X_UMA_PROFILE'
+# 保存したプロファイルのIDを返すレスポンスヘッダー
+PROFILE_ID_HEADER = 'X-Uma-Profile-Id'
+
+
+def is_profile_requested(request):
+    """プロファイル取得の対象リクエストかを判定する
+    スタッフユーザーがヘッダーを付与した場合のみ対象とする。
+    * @param request HTTPリクエストオブジェクト
+    * @return bool 対象の場合True
+    """
+    if request.META.get(PROFILE_HEADER, '').lower() not in ('1', 'true'):
+        return False
+    return is_staff_user(request.user)
+
+
+def get_profile_dir():
+    """プロファイルの保存先ディレクトリを取得する"""
+    return getattr(settings, 'UMA_PROFILE_DIR', os.path.join(settings.BASE_DIR, 'profiles'))
+
+
+class _QueryRecorder:
+    """observe_queries に渡し、全DB接続 (シャード・レプリカを含む) で実行されたSQLを記録するクラス
+    * @param queries 記録先のリスト
+    """
+    def __init__(self, queries):
+        self.queries = queries
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            connection = context['connection']
+            if not many:
+                # CaptureQueriesContext と同じく、パラメータを埋め込んだSQLを記録する
+                sql = connection.ops.last_executed_query(context['cursor'], sql, params)
+            self.queries.append({
+                'sql': sql, 'time': f'{time.perf_counter() - start:.3f}', 'alias': connection.alias,
+            })
+
+
+class RequestProfiler:
+    """処理をcProfileで計測し、実行されたSQLとともに保存するクラス
+    * @param view_name 計測対象のAPI名
+    """
+    def __init__(self, view_name):
+        self.view_name = view_name
+        self.profile_id = f'{timezone.now():%Y%m%d%H%M%S}_{view_name}_{uuid.uuid4().hex[:8]}'
+        self.profile = cProfile.Profile()
+        self.queries = []
+        self.elapsed = 0.0
+
+    def run(self, func, *args, **kwargs):
+        """関数を計測しながら実行する
+        * @param func 計測対象の関数
+        * @return 関数の戻り値
+        """
+        start = time.perf_counter()
+        with observe_queries(_QueryRecorder(self.queries)):
+            self.profile.enable()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.profile.disable()
+                self.elapsed += time.perf_counter() - start
+
+    def save(self, snapshot):
+        """プロファイル(.prof)と入力スナップショット(.json)を保存する
+        * @param snapshot 再現に必要な入力データの辞書
+        * @return str スナップショットファイルのパス
+        """
+        profile_dir = get_profile_dir()
+        os.makedirs(profile_dir, exist_ok=True)
+        base_path = os.path.join(profile_dir, self.profile_id)
+
+        self.profile.dump_stats(f'{base_path}.prof')
+        data = {
+            'profile_id': self.profile_id,
+            'view': self.view_name,
+            'captured_at': timezone.now().isoformat(),
+            'elapsed': self.elapsed,
+            'snapshot': snapshot,
+            'queries': [{'sql': query['sql'], 'time': query['time'], 'alias': query['alias']} for query in self.queries],
+        }
+        with open(f'{base_path}.json', 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False, indent=2)
+        return f'{base_path}.json'
@@ -1,10 +1,37 @@
-def fill_empty_slots_with_any_races(pattern, remaining_races, used_races):
+import hashlib
+import json
+
+from asgiref.sync import sync_to_async
+
+from .catalog import cache_default_race_pattern, get_default_race_pattern, get_g_races
+from .tracing import NULL_TRACER
+
+
+def build_slot_index(races):
+    """レースを出走タイミング (級, 月, 前後半) ごとにまとめる (元の並び順を保持する)
+    * @param races レースのリスト
+    * @return dict {(級番号, 月, 前後半): レースのリスト}
+    """
+    slot_index = {}
+    for race in races:
+        for grade_num, grade_flag in ((1, race.junior_flag), (2, race.classic_flag), (3, race.senior_flag)):
+            if grade_flag:
+                slot_index.setdefault((grade_num, race.race_months, race.half_flag), []).append(race)
+    return slot_index
+
+
+def fill_empty_slots_with_any_races(pattern, remaining_races, used_races, slot_index=None):
     """残レースが0になるまで、空いているタイミングに任意のレースを追加
     * @param pattern レースパターン辞書
     * @param remaining_races 残レースのクエリセット
     * @param used_races 使用済みレースIDセット
-    * @return None
+    * @param slot_index remaining_races を含むレースの build_slot_index の結果 (省略時は remaining_races から作成)
+    * @return int 全スロットを走査したループ回数
     """
+    if slot_index is None:
+        slot_index = build_slot_index(remaining_races)
+    remaining_race_ids = {race.race_id for race in remaining_races}
+
     grade_mappings = {
         'junior': (pattern['junior'], 1),
         'classic': (pattern['classic'], 2), 
@@ -15,7 +42,9 @@ def fill_empty_slots_with_any_races(pattern, remaining_races, used_races):
     is_larc = pattern.get('scenario') == 'ラーク'
     
     # 残レースが0になるまでループ
+    passes = 0
     while True:
+        passes += 1
         added_any_race = False
         
         for grade_name, (grade_races, grade_num) in grade_mappings.items():
@@ -33,24 +62,11 @@ def fill_empty_slots_with_any_races(pattern, remaining_races, used_races):
                         if grade_name == 'senior' and ((month == 6 and half == 1) or (month >= 7)):
                             continue
                     
-                    # 残レースから適合するレースを検索
-                    matching_races = []
-                    for race in remaining_races:
-                        # レースの級を判定
-                        race_grade_match = False
-                        if grade_num == 1 and race.junior_flag:
-                            race_grade_match = True
-                        elif grade_num == 2 and race.classic_flag:
-                            race_grade_match = True
-                        elif grade_num == 3 and race.senior_flag:
-                            race_grade_match = True
-                        
-                        # 条件マッチング（馬場・距離は問わない）
-                        if (race.race_months == month and 
-                            race.half_flag == half and 
-                            race_grade_match and
-                            race.race_id not in used_races):
-                            matching_races.append(race)
+                    # 残レースから適合するレースを検索 (級・月・前後半が一致するもの。馬場・距離は問わない)
+                    matching_races = [
+                        race for race in slot_index.get((grade_num, month, half), ())
+                        if race.race_id in remaining_race_ids and race.race_id not in used_races
+                    ]
                     
                     # 見つかったレースを優先順位付けして追加
                     if matching_races:
@@ -86,6 +102,7 @@ def fill_empty_slots_with_any_races(pattern, remaining_races, used_races):
         # このループで何も追加されなかったら終了
         if not added_any_race:
             break
+    return passes
 
 def calculate_factor_composition(umamusume_data, pattern_races, reinforcement_strategy=None, is_larc=False):
     """ウマ娘の適性とパターン内レースを元に因子構成を計算
@@ -512,42 +529,171 @@ def _fill_junior_slots(pattern, remaining_races, used_races):
                     used_races.add(race.race_id)
                     break
 
-def get_race_pattern_data(count, user_id, umamusume_id):
+def load_race_pattern_inputs(user_id, umamusume_id):
+    """ユーザーの出走状況から、レースパターン生成に必要なデータを取得する
+    * @param user_id ユーザーID
+    * @param umamusume_id ウマ娘ID
+    * @return tuple (ウマ娘データ, 残レースリスト, シナリオレースリスト, G1〜G3全レースリスト)
+    """
+    from .models import RegistUmamusume, RegistUmamusumeRace
+
+    regist_umamusume = RegistUmamusume.objects.select_related('umamusume').get(user_id=user_id, umamusume_id=umamusume_id)
+    regist_race_ids = set(RegistUmamusumeRace.objects.filter(
+        user_id=user_id, umamusume_id=umamusume_id
+    ).values_list('race_id', flat=True))
+    umamusume_data, remaining_races, scenario_races, all_g_races = load_race_pattern_inputs_by_race_ids(
+        umamusume_id, exclude_race_ids=regist_race_ids, umamusume_data=regist_umamusume.umamusume
+    )
+    return umamusume_data, remaining_races, scenario_races, all_g_races
+
+
+async def aload_race_pattern_inputs(user_id, umamusume_id):
+    """load_race_pattern_inputs の非同期版 (非同期ORMを使用する)
+    * @param user_id ユーザーID
+    * @param umamusume_id ウマ娘ID
+    * @return tuple (ウマ娘データ, 残レースリスト, シナリオレースリスト, G1〜G3全レースリスト)
+    """
+    from .models import RegistUmamusume, RegistUmamusumeRace, ScenarioRace
+
+    regist_umamusume = await RegistUmamusume.objects.select_related('umamusume').aget(user_id=user_id, umamusume_id=umamusume_id)
+    regist_race_ids = {
+        race_id async for race_id in RegistUmamusumeRace.objects.filter(
+            user_id=user_id, umamusume_id=umamusume_id
+        ).values_list('race_id', flat=True)
+    }
+    all_g_races = await sync_to_async(get_g_races)()
+    remaining_races = [race for race in all_g_races if race.race_id not in regist_race_ids]
+    scenario_races = [sr async for sr in ScenarioRace.objects.filter(umamusume_id=umamusume_id).select_related('race')]
+    return regist_umamusume.umamusume, remaining_races, scenario_races, all_g_races
+
+
+def load_race_pattern_inputs_by_race_ids(umamusume_id, remaining_race_ids=None, exclude_race_ids=(), umamusume_data=None):
+    """残レースIDを指定して、レースパターン生成に必要なデータを取得する
+    プロファイルのスナップショット再現など、ユーザーの出走状況を使わない場合に使用する。
+    * @param umamusume_id ウマ娘ID
+    * @param remaining_race_ids 残レースIDの集合 (Noneの場合はG1〜G3全レース)
+    * @param exclude_race_ids 残レースから除外するレースIDの集合
+    * @param umamusume_data 取得済みのウマ娘データ (省略時はDBから取得)
+    * @return tuple (ウマ娘データ, 残レースリスト, シナリオレースリスト, G1〜G3全レースリスト)
+    """
+    from .models import Umamusume, ScenarioRace
+
+    if umamusume_data is None:
+        umamusume_data = Umamusume.objects.get(umamusume_id=umamusume_id)
+    all_g_races = get_g_races()
+    remaining_races = [
+        race for race in all_g_races
+        if (remaining_race_ids is None or race.race_id in remaining_race_ids) and race.race_id not in exclude_race_ids
+    ]
+    scenario_races = list(ScenarioRace.objects.filter(umamusume_id=umamusume_id).select_related('race'))
+    return umamusume_data, remaining_races, scenario_races, all_g_races
+
+
+def race_pattern_digest(race_pattern):
+    """レースパターンデータのハッシュ値を取得する (プロファイル再現時の結果比較用)
+    * @param race_pattern レースパターンデータ
+    * @return str SHA-256のハッシュ値
+    """
+    serialized = json.dumps(race_pattern, ensure_ascii=False, sort_keys=True, default=str)
+    return hashlib.sha256(serialized.encode('utf-8')).hexdigest()
+
+
+# コンパクト形式のスロット順 (級, 月, 前後半): ジュニア級7月〜12月・クラシック級1月〜12月・シニア級1月〜12月の前半・後半
+COMPACT_SLOTS = [
+    (grade_name, month, half)
+    for grade_name, month_range in [('junior', range(7, 13)), ('classic', range(1, 13)), ('senior', range(1, 13))]
+    for month in month_range
+    for half in [0, 1]
+]
+_COMPACT_SLOT_INDEX = {slot: idx for idx, slot in enumerate(COMPACT_SLOTS)}
+
+
+def compact_race_pattern(race_pattern):
+    """レースパターンデータを、スロットごとのレースIDの配列で表すコンパクト形式に変換する
+    各パターンの races は COMPACT_SLOTS の順のレースID (空きはNone) の配列で、レース名はクライアントのマスタから引く。
+    レースIDが同じパターンは最初のもののみ残す。元のデータは共有されている場合があるため変更しない。
+    * @param race_pattern レースパターンデータ
+    * @return dict コンパクト形式のレースパターンデータ
+    """
+    patterns = []
+    seen = set()
+    for pattern in race_pattern['patterns']:
+        races = [None] * len(COMPACT_SLOTS)
+        for grade_name in ('junior', 'classic', 'senior'):
+            for race_data in pattern[grade_name]:
+                races[_COMPACT_SLOT_INDEX[(grade_name, race_data['month'], race_data['half'])]] = race_data['race_id']
+        if tuple(races) in seen:
+            continue
+        seen.add(tuple(races))
+        compact = {key: value for key, value in pattern.items() if key not in ('junior', 'classic', 'senior')}
+        compact['races'] = races
+        patterns.append(compact)
+    return {'format': 'compact', 'patterns': patterns}
+
+
+def is_default_race_pattern_inputs(remaining_races, all_g_races):
+    """出走済みのG1〜G3レースがなく、ウマ娘ごとの既定レースパターンと同じ結果になる入力かを返す
+    * @param remaining_races 残レースのリスト
+    * @param all_g_races G1〜G3全レースのリスト
+    * @return bool 既定レースパターンを使える場合True
+    """
+    return len(remaining_races) == len(all_g_races)
+
+
+def get_race_pattern_data(count, user_id, umamusume_id, tracer=NULL_TRACER, use_cache=True):
     """レースパターンデータを生成するメイン関数
     * @param count 生成するパターン数
     * @param user_id ユーザーID
     * @param umamusume_id ウマ娘ID
+    * @param tracer 処理区間を記録するトレーサー (省略時は記録しない)
+    * @param use_cache Falseの場合は既定レースパターンのキャッシュを使わずに生成する
     * @return list レースパターンリスト
     """
-    from .models import RegistUmamusume, RegistUmamusumeRace, Race, ScenarioRace
-
     # --- 1. データ取得 ---
-    regist_umamusume = RegistUmamusume.objects.get(user_id=user_id, umamusume_id=umamusume_id)
-    umamusume_data = regist_umamusume.umamusume
-    regist_race_ids = RegistUmamusumeRace.objects.filter(
-        user_id=user_id, umamusume_id=umamusume_id
-    ).values_list('race_id', flat=True)
-    remaining_races_qs = Race.objects.exclude(race_id__in=regist_race_ids).filter(race_rank__in=[1, 2, 3])
-    scenario_races = ScenarioRace.objects.filter(umamusume_id=umamusume_id)
-    all_g_races = list(Race.objects.filter(race_rank__in=[1, 2, 3]))
-
+    with tracer.span('1.load') as span:
+        umamusume_data, remaining_races, scenario_races, all_g_races = load_race_pattern_inputs(user_id, umamusume_id)
+        span.set(candidates=len(remaining_races))
+
+    # 出走済みのG1〜G3レースがない場合は、ウマ娘ごとに共通の既定レースパターン (DefaultRacePlan) を使う
+    if use_cache and is_default_race_pattern_inputs(remaining_races, all_g_races):
+        race_pattern = get_default_race_pattern(umamusume_data, scenario_races)
+        if race_pattern is None:
+            race_pattern = build_race_pattern_data(umamusume_data, remaining_races, scenario_races, all_g_races, tracer=tracer)
+            cache_default_race_pattern(umamusume_data, scenario_races, race_pattern)
+        return race_pattern
+    return build_race_pattern_data(umamusume_data, remaining_races, scenario_races, all_g_races, tracer=tracer)
+
+
+def build_race_pattern_data(umamusume_data, remaining_races_qs, scenario_races, all_g_races, tracer=NULL_TRACER):
+    """取得済みのデータからレースパターンを生成する (DBアクセスなし)
+    * @param umamusume_data ウマ娘データオブジェクト
+    * @param remaining_races_qs 残レースのリスト
+    * @param scenario_races シナリオレースのリスト (raceを取得済みのもの)
+    * @param all_g_races G1〜G3全レースのリスト
+    * @param tracer 処理区間を記録するトレーサー (省略時は記録しない)
+    * @return dict レースパターンデータ
+    """
     # --- 2. 事前準備 ---
-    # 2.1 補強戦略リストを作成
-    strategies = _get_reinforcement_strategies(umamusume_data)
-    
-    # 2.2 シナリオレースIDを取得
-    _, scenario_race_ids = _extract_conflicting_races(scenario_races, remaining_races_qs)
-    
-    # 2.3 レース名からIDを引くためのマップを作成
-    race_map = {(r.race_name, r.race_months, r.half_flag): r.race_id for r in all_g_races}
-    
+    with tracer.span('2.prepare', candidates=len(remaining_races_qs)):
+        # 2.1 補強戦略リストを作成
+        strategies = _get_reinforcement_strategies(umamusume_data)
+
+        # 2.2 シナリオレースIDを取得
+        _, scenario_race_ids = _extract_conflicting_races(scenario_races, remaining_races_qs)
+
+        # 2.3 レース名からIDを引くためのマップを作成
+        race_map = {(r.race_name, r.race_months, r.half_flag): r.race_id for r in all_g_races}
+
+        # 2.4 空きスロットの充填で使う、出走タイミングごとの残レース
+        slot_index = build_slot_index(remaining_races_qs)
+
     # --- 3. パターン生成ループ ---
     patterns = []
     
     # ラーク主要レース（凱旋門賞、ニエル賞、フォワ賞）が一つも残っていない場合、
     # ラークパターンは作成済みか作成不可能とみなし、フラグをTrueに設定する
     larc_key_race_names = {'凱旋門賞', 'ニエル賞', 'フォワ賞'}
-    has_remaining_larc_races = remaining_races_qs.filter(race_name__in=larc_key_race_names).exists()
+    has_remaining_larc_races = any(race.race_name in larc_key_race_names for race in remaining_races_qs)
     larc_created = not has_remaining_larc_races
     
     # 全パターンで共有する使用済みレースIDセット
@@ -563,41 +709,54 @@ def get_race_pattern_data(count, user_id, umamusume_id):
         # 3.0. このパターン用の準備
         strategy = strategies[pattern_index % len(strategies)]
 
-        # 戦略に基づいて、このパターンで使用するレースをフィルタリング
-        remaining_races = _filter_races_by_strategy(list(remaining_races_qs), strategy, umamusume_data)
-        
-        # フィルタリング後のレースリストから競合レースを再抽出
-        conflicting_races, _ = _extract_conflicting_races(scenario_races, remaining_races)
-
-        # 3.1. 優先馬場・距離の決定
-        available_conflicts = [r for r in conflicting_races if r.race_id not in used_races]
-        preferred_surface, preferred_distance = _determine_preferred_conditions(umamusume_data, available_conflicts)
-
-        # 3.2. 基本パターンの作成
-        pattern, has_conflicts = _create_base_pattern(conflicting_races, used_races, preferred_surface, preferred_distance)
-        pattern['strategy'] = strategy # 表示やデバッグ用に戦略を記録
-
-        # 3.3. ラークシナリオ判定 & 適用
-        is_larc, larc_created, used_races = _apply_larc_scenario_if_applicable(pattern, larc_created, race_map, used_races , scenario_races)
-        # 3.4. シナリオ名決定 & 適用
-        _determine_and_apply_scenario(pattern, is_larc, has_conflicts)
-
-        # 3.5. 空きスロットの充填 (1/3): 主要な馬場・距離の計算
-        races_in_pattern = _get_all_races_in_pattern(pattern, all_g_races)
-        most_common_surface, most_common_distance = _calculate_and_set_main_conditions(pattern, races_in_pattern)
-
-        # 3.6. 空きスロットの充填 (2/3): 各種ルールに基づいて埋める
-        _fill_junior_slots(pattern, remaining_races, used_races)
-        fill_empty_slots_with_any_races(pattern, remaining_races, used_races)
-        
-        # 3.7. 空きスロットの充填 (3/3): 最終的なレースリストと主要な馬場・距離の再計算
-        final_races_in_pattern = _get_all_races_in_pattern(pattern, all_g_races)
-        _calculate_and_set_main_conditions(pattern, final_races_in_pattern)
-        
-    
-        # 3.8. 因子構成と合計レース数を計算
-        pattern['factors'] = calculate_factor_composition(umamusume_data, final_races_in_pattern, reinforcement_strategy=strategy, is_larc=is_larc)
-        pattern['totalRaces'] = len(final_races_in_pattern)
+        with tracer.span('3.iteration', index=pattern_index, strategy=strategy) as iteration_span:
+            # 戦略に基づいて、このパターンで使用するレースをフィルタリング
+            with tracer.span('3.0.filter') as span:
+                remaining_races = _filter_races_by_strategy(list(remaining_races_qs), strategy, umamusume_data)
+
+                # フィルタリング後のレースリストから競合レースを再抽出
+                conflicting_races, _ = _extract_conflicting_races(scenario_races, remaining_races)
+                span.set(candidates=len(remaining_races), conflicts=len(conflicting_races))
+
+            # 3.1. 優先馬場・距離の決定
+            with tracer.span('3.1.preferred_conditions'):
+                available_conflicts = [r for r in conflicting_races if r.race_id not in used_races]
+                preferred_surface, preferred_distance = _determine_preferred_conditions(umamusume_data, available_conflicts)
+
+            # 3.2. 基本パターンの作成
+            with tracer.span('3.2.base_pattern'):
+                pattern, has_conflicts = _create_base_pattern(conflicting_races, used_races, preferred_surface, preferred_distance)
+                pattern['strategy'] = strategy # 表示やデバッグ用に戦略を記録
+
+            # 3.3. ラークシナリオ判定 & 適用
+            with tracer.span('3.3.larc'):
+                is_larc, larc_created, used_races = _apply_larc_scenario_if_applicable(pattern, larc_created, race_map, used_races , scenario_races)
+            # 3.4. シナリオ名決定 & 適用
+            with tracer.span('3.4.scenario'):
+                _determine_and_apply_scenario(pattern, is_larc, has_conflicts)
+
+            # 3.5. 空きスロットの充填 (1/3): 主要な馬場・距離の計算
+            with tracer.span('3.5.main_conditions'):
+                races_in_pattern = _get_all_races_in_pattern(pattern, all_g_races)
+                most_common_surface, most_common_distance = _calculate_and_set_main_conditions(pattern, races_in_pattern)
+
+            # 3.6. 空きスロットの充填 (2/3): 各種ルールに基づいて埋める
+            with tracer.span('3.6.fill_slots') as span:
+                _fill_junior_slots(pattern, remaining_races, used_races)
+                passes = fill_empty_slots_with_any_races(pattern, remaining_races, used_races, slot_index)
+                span.set(candidates=len(remaining_races), passes=passes)
+
+            # 3.7. 空きスロットの充填 (3/3): 最終的なレースリストと主要な馬場・距離の再計算
+            with tracer.span('3.7.main_conditions'):
+                final_races_in_pattern = _get_all_races_in_pattern(pattern, all_g_races)
+                _calculate_and_set_main_conditions(pattern, final_races_in_pattern)
+
+            # 3.8. 因子構成と合計レース数を計算
+            with tracer.span('3.8.factors'):
+                pattern['factors'] = calculate_factor_composition(umamusume_data, final_races_in_pattern, reinforcement_strategy=strategy, is_larc=is_larc)
+                pattern['totalRaces'] = len(final_races_in_pattern)
+
+            iteration_span.set(added_races=len(used_races) - races_used_before_iteration)
 
         # このイテレーションで新しいレースが追加されたかチェック
         if len(used_races) > races_used_before_iteration or is_larc:
@@ -612,63 +771,64 @@ def get_race_pattern_data(count, user_id, umamusume_id):
             break
     
     # --- 4. シナリオレースの取り扱い ---
-    found_non_conflicting_pattern = False
-
-    if scenario_races:
-        # 4.1 シナリオレースとタイミングが被らないパターン(A)を探す
-        for i, pattern in enumerate(patterns):
-            is_conflicting = any(
-                race_data['race_name']
-                for sr in scenario_races
-                for race_data in pattern[_get_race_grade(sr.race, sr)]
-                if race_data['month'] == sr.race.race_months and race_data['half'] == sr.race.half_flag
-            )
-
-            if not is_conflicting:
-                # 4.2 (A)にシナリオレースをマージし、シナリオを「伝説」として扱う
-                for sr in scenario_races:
-                    race = sr.race
-                    grade = _get_race_grade(race, sr)
-                    for race_data in patterns[i][grade]:
-                        if race_data['month'] == race.race_months and race_data['half'] == race.half_flag and not race_data['race_name']:
-                            race_data['race_name'] = race.race_name
-                            race_data['race_id'] = race.race_id
-                            break
+    with tracer.span('4.scenario_merge', scenario_races=len(scenario_races)) as span:
+        found_non_conflicting_pattern = False
+
+        if scenario_races:
+            # 4.1 シナリオレースとタイミングが被らないパターン(A)を探す
+            for i, pattern in enumerate(patterns):
+                is_conflicting = any(
+                    race_data['race_name']
+                    for sr in scenario_races
+                    for race_data in pattern[_get_race_grade(sr.race, sr)]
+                    if race_data['month'] == sr.race.race_months and race_data['half'] == sr.race.half_flag
+                )
+
+                if not is_conflicting:
+                    # 4.2 (A)にシナリオレースをマージし、シナリオを「伝説」として扱う
+                    for sr in scenario_races:
+                        race = sr.race
+                        grade = _get_race_grade(race, sr)
+                        for race_data in patterns[i][grade]:
+                            if race_data['month'] == race.race_months and race_data['half'] == race.half_flag and not race_data['race_name']:
+                                race_data['race_name'] = race.race_name
+                                race_data['race_id'] = race.race_id
+                                break
                 
-                patterns[i]['scenario'] = "伝説"
-                patterns[i]['strategy'] = None
+                    patterns[i]['scenario'] = "伝説"
+                    patterns[i]['strategy'] = None
                 
-                final_races_in_pattern = _get_all_races_in_pattern(patterns[i], all_g_races)
-                _calculate_and_set_main_conditions(patterns[i], final_races_in_pattern)
-                patterns[i]['factors'] = calculate_factor_composition(umamusume_data, final_races_in_pattern)
-                patterns[i]['totalRaces'] = len(final_races_in_pattern)
+                    final_races_in_pattern = _get_all_races_in_pattern(patterns[i], all_g_races)
+                    _calculate_and_set_main_conditions(patterns[i], final_races_in_pattern)
+                    patterns[i]['factors'] = calculate_factor_composition(umamusume_data, final_races_in_pattern)
+                    patterns[i]['totalRaces'] = len(final_races_in_pattern)
                 
-                found_non_conflicting_pattern = True
-
-    # 4.3 (A)がなければ、従来通り最後にシナリオレース用のパターンを追加
-    if scenario_races and not found_non_conflicting_pattern:
-        scenario_pattern = {"scenario": "伝説", "strategy": None, "junior": [], "classic": [], "senior": []}
-        for grade_name, month_range in [('junior', range(7, 13)), ('classic', range(1, 13)), ('senior', range(1, 13))]:
-            for month in month_range:
-                for half in [0, 1]:
-                    scenario_pattern[grade_name].append({"race_name": "", "race_id": None, "month": month, "half": half})
-
-        for sr in scenario_races:
-            race = sr.race
-            grade = _get_race_grade(race, sr)
-            for race_data in scenario_pattern[grade]:
-                if race_data['month'] == race.race_months and race_data['half'] == race.half_flag:
-                    race_data['race_name'] = race.race_name
-                    race_data['race_id'] = race.race_id
-                    break
+                    found_non_conflicting_pattern = True
+
+        # 4.3 (A)がなければ、従来通り最後にシナリオレース用のパターンを追加
+        if scenario_races and not found_non_conflicting_pattern:
+            scenario_pattern = {"scenario": "伝説", "strategy": None, "junior": [], "classic": [], "senior": []}
+            for grade_name, month_range in [('junior', range(7, 13)), ('classic', range(1, 13)), ('senior', range(1, 13))]:
+                for month in month_range:
+                    for half in [0, 1]:
+                        scenario_pattern[grade_name].append({"race_name": "", "race_id": None, "month": month, "half": half})
+
+            for sr in scenario_races:
+                race = sr.race
+                grade = _get_race_grade(race, sr)
+                for race_data in scenario_pattern[grade]:
+                    if race_data['month'] == race.race_months and race_data['half'] == race.half_flag:
+                        race_data['race_name'] = race.race_name
+                        race_data['race_id'] = race.race_id
+                        break
         
-        fill_empty_slots_with_any_races(scenario_pattern, list(remaining_races_qs), used_races)
+            span.set(passes=fill_empty_slots_with_any_races(scenario_pattern, list(remaining_races_qs), used_races))
 
-        final_races_in_pattern = _get_all_races_in_pattern(scenario_pattern, all_g_races)
-        _calculate_and_set_main_conditions(scenario_pattern, final_races_in_pattern)
-        scenario_pattern['factors'] = calculate_factor_composition(umamusume_data, final_races_in_pattern)
-        scenario_pattern['totalRaces'] = len(final_races_in_pattern)
-        patterns.append(scenario_pattern)
+            final_races_in_pattern = _get_all_races_in_pattern(scenario_pattern, all_g_races)
+            _calculate_and_set_main_conditions(scenario_pattern, final_races_in_pattern)
+            scenario_pattern['factors'] = calculate_factor_composition(umamusume_data, final_races_in_pattern)
+            scenario_pattern['totalRaces'] = len(final_races_in_pattern)
+            patterns.append(scenario_pattern)
 
     return {
         'patterns': patterns
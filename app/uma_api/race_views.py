@@ -2,49 +2,96 @@ from rest_framework import status
 from rest_framework.decorators import api_view, permission_classes
 from rest_framework.permissions import IsAuthenticated, AllowAny
 from rest_framework.response import Response
+from django.conf import settings
 from django.utils import timezone
 from django.db.models import Q, Count
 from .models import *
 from .serializers import *
 from .utils import UmamusumeLog
 from .breedingCount import getbreedingCountData
-from .racePattern import get_race_pattern_data
+from .racePattern import (
+    get_race_pattern_data, load_race_pattern_inputs, build_race_pattern_data, race_pattern_digest, compact_race_pattern,
+)
+from .profiling import RequestProfiler, is_profile_requested, PROFILE_ID_HEADER
+from .tracing import Tracer
+from .authentication import is_staff_user
+from .response_cache import bumps_data_version, cache_user_response, get_data_version
+from .singleflight import pattern_flight
+from .pattern_jobs import get_pattern_job, get_retry_after, submit_pattern_job
+from .admission import admission_control
+from .catalog import default_plan_hash, get_catalog_snapshot, get_default_breeding_counts, get_g_races
+
+def get_race_list_queryset(state, distance):
+    """ジュニア・クラシック・シニアの順に並べたレース一覧のクエリセットを作成する
+    * @param state レース場状態 (-1:全て, その他:指定状態)
+    * @param distance 距離 (-1:全て, その他:指定距離)
+    * @return QuerySet レースのクエリセット
+    """
+    races = Race.objects.extra(
+        select={'custom_order': """
+            CASE
+                WHEN junior_flag = 1 THEN 1
+                WHEN classic_flag = 1 THEN 2
+                WHEN senior_flag = 1 THEN 3
+                ELSE 4
+            END
+        """}
+    ).order_by('custom_order', 'race_months', 'half_flag', 'race_rank')
+    
+    if state != -1:
+        races = races.filter(race_state=state)
+    
+    if distance != -1:
+        races = races.filter(distance=distance)
+    return races
+
+
+# レース一覧で指定できるレース場状態・距離 (-1:全て)
+RACE_LIST_STATES = (-1, 0, 1)
+RACE_LIST_DISTANCES = (-1, 1, 2, 3, 4)
+
+
+def parse_race_list_filters(data):
+    """レース一覧の絞り込み条件を整数に変換する
+    マスタのキャッシュのキーに使うため、型の違う同じ値は同じ値にそろえ、定義済みの値のみ受け付ける。
+    * @param data リクエストデータ
+    * @param data.state レース場状態 (-1:全て, 0:芝, 1:ダート)
+    * @param data.distance 距離 (-1:全て, 1:短距離, 2:マイル, 3:中距離, 4:長距離)
+    * @return tuple (レース場状態, 距離)
+    * @raise ValueError 整数でない場合・定義済みの値でない場合
+    """
+    try:
+        state = int(data.get('state'))
+        distance = int(data.get('distance'))
+    except (TypeError, ValueError):
+        raise ValueError('state・distanceは整数で指定してください。')
+    if state not in RACE_LIST_STATES or distance not in RACE_LIST_DISTANCES:
+        raise ValueError(f'state・distanceの値が正しくありません。 (state:{state}, distance:{distance})')
+    return state, distance
+
 
 @api_view(['POST'])
 @permission_classes([AllowAny])
 def race_list(request):
     """レースのリストをDBから取得するAPI
     * @param request HTTPリクエストオブジェクト
-    * @param request.data.state レース場状態 (-1:全て, その他:指定状態)
-    * @param request.data.distance 距離 (-1:全て, その他:指定距離)
+    * @param request.data.state レース場状態 (-1:全て, 0:芝, 1:ダート)
+    * @param request.data.distance 距離 (-1:全て, 1:短距離, 2:マイル, 3:中距離, 4:長距離)
+    * @param request.query_params.fields 返すフィールド (カンマ区切り、省略時はすべて)
     * @return Response レースリストデータ
     """
     logger = UmamusumeLog(request)
     logger.logwrite('start', 'raceList')
     
     try:
-        races = Race.objects.extra(
-            select={'custom_order': """
-                CASE
-                    WHEN junior_flag = 1 THEN 1
-                    WHEN classic_flag = 1 THEN 2
-                    WHEN senior_flag = 1 THEN 3
-                    ELSE 4
-                END
-            """}
-        ).order_by('custom_order', 'race_months', 'half_flag', 'race_rank')
-        
-        state = request.data.get('state')
-        if state != -1:
-            races = races.filter(race_state=state)
-        
-        distance = request.data.get('distance')
-        if distance != -1:
-            races = races.filter(distance=distance)
-        
-        serializer = RaceSerializer(races, many=True)
-        logger.logwrite('end', f'raceList - 取得件数:{len(serializer.data)} (state:{state}, distance:{distance})')
-        return Response({'data': serializer.data})
+        try:
+            state, distance = parse_race_list_filters(request.data)
+        except ValueError as e:
+            logger.logwrite('error', f'raceList - 不正な絞り込み条件: {e}')
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        data = sparse_rows(get_catalog_snapshot('race_list', state, distance), *parse_sparse_fieldset(request.query_params))
+        logger.logwrite('end', f'raceList - 取得件数:{len(data)} (state:{state}, distance:{distance})')
+        return Response({'data': data})
     except Exception as e:
         logger.logwrite('error', f'raceList:{e}')
         return Response({'error': 'レースリスト取得エラー'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
@@ -55,27 +102,113 @@ def race_list(request):
 def race_regist_list(request):
     """ウマ娘を登録する際のレース情報を加工してDBから取得するAPI
     * @param request HTTPリクエストオブジェクト
+    * @param request.query_params.fields 返すフィールド (カンマ区切り、省略時はすべて)
     * @return Response レース登録用リストデータ
     """
     logger = UmamusumeLog(request)
     logger.logwrite('start', 'raceRegistList')
     
     try:
-        races = Race.objects.filter(race_rank__in=[1, 2, 3]).order_by('race_rank', 'race_months', 'half_flag')
-        serializer = RaceSerializer(races, many=True)
-        logger.logwrite('end', f'raceRegistList - 取得件数:{len(serializer.data)}')
-        return Response({'data': serializer.data})
+        data = sparse_rows(get_catalog_snapshot('race_regist_list'), *parse_sparse_fieldset(request.query_params))
+        logger.logwrite('end', f'raceRegistList - 取得件数:{len(data)}')
+        return Response({'data': data})
     except Exception as e:
         logger.logwrite('error', f'raceRegistList:{e}')
         return Response({'error': 'レース登録リスト取得エラー'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
 
+# 残レース集計のカテゴリ (レスポンスのキー順)
+REMAINING_COUNT_CATEGORIES = [
+    "allCrownRace", "turfSprintRace", "turfMileRace", "turfClassicRace", "turfLongDistanceRace",
+    "dirtSprintDistanceRace", "dirtMileRace", "dirtClassicRace",
+]
+# (馬場, 距離) から集計カテゴリへのマップ
+REMAINING_COUNT_KEYS = {
+    (0, 1): "turfSprintRace", (0, 2): "turfMileRace", (0, 3): "turfClassicRace", (0, 4): "turfLongDistanceRace",
+    (1, 1): "dirtSprintDistanceRace", (1, 2): "dirtMileRace", (1, 3): "dirtClassicRace",
+}
+
+
+def build_remaining_results(regist_umamusumes, run_races, target_races, scenario_races, default_breeding_counts=None,
+                            fields=None, expand=None):
+    """取得済みのデータから、ウマ娘別の残レース情報を作成する (DBアクセスなし)
+    * @param regist_umamusumes 登録ウマ娘のリスト (umamusumeを取得済みのもの)
+    * @param run_races 出走済みレースの辞書 (umamusume_id, race_id) のリスト
+    * @param target_races G1〜G3全レースのリスト
+    * @param scenario_races 登録ウマ娘のシナリオレースのリスト (raceを取得済みのもの)
+    * @param default_breeding_counts 出走済みレースがない場合の目安育成数 {(ウマ娘ID, ハッシュ値): 目安育成数}
+    * @param fields 返すフィールド名のリスト (Noneの場合はすべて。breedingCount を含まない場合は計算しない)
+    * @param expand 展開する入れ子のフィールド名のリスト (umamusume を含まない場合はウマ娘IDのみ。Noneの場合は展開する)
+    * @return list ウマ娘別の残レース情報 (残レース数・ウマ娘名の昇順)
+    """
+    # ウマ娘IDをキー、レースIDのリストを値とする辞書を作成
+    run_races_by_umamusume = {}
+    for item in run_races:
+        umamusume_id = item['umamusume_id']
+        if umamusume_id not in run_races_by_umamusume:
+            run_races_by_umamusume[umamusume_id] = []
+        run_races_by_umamusume[umamusume_id].append(item['race_id'])
+
+    # 目安育成数を返さない場合はシナリオレースを参照しない (遅延評価のクエリセットは実行されない)
+    needs_breeding_count = is_field_requested(fields, 'breedingCount')
+    scenario_races_by_umamusume = {}
+    for scenario_race in scenario_races if needs_breeding_count else []:
+        scenario_races_by_umamusume.setdefault(scenario_race.umamusume_id, []).append(scenario_race)
+    expand_umamusume = is_field_requested(expand, 'umamusume')
+
+    results = []
+    for regist_umamusume in regist_umamusumes:
+        regist_race_ids = set(run_races_by_umamusume.get(regist_umamusume.umamusume_id, []))
+        
+        remaining_races = [race for race in target_races if race.race_id not in regist_race_ids]
+        is_all_crown = not remaining_races
+        
+        umamusume_scenario_races = scenario_races_by_umamusume.get(regist_umamusume.umamusume_id, [])
+        breedingCount = None
+        if is_all_crown:
+            breedingCount = 0
+        elif needs_breeding_count:
+            if default_breeding_counts and len(remaining_races) == len(target_races):
+                # 出走済みレースがない場合は作成済みの目安育成数を使う
+                breedingCount = default_breeding_counts.get(
+                    (regist_umamusume.umamusume_id, default_plan_hash(regist_umamusume.umamusume, umamusume_scenario_races))
+                )
+            if breedingCount is None:
+                breedingCount = getbreedingCountData(regist_umamusume, remaining_races, umamusume_scenario_races)
+        # 各カテゴリのレース数を集計
+        counts = {key: 0 for key in REMAINING_COUNT_CATEGORIES}
+        counts['allCrownRace'] = len(remaining_races)
+        for race in remaining_races:
+            key = REMAINING_COUNT_KEYS.get((race.race_state, race.distance))
+            if key:
+                counts[key] += 1
+        
+        result = {
+            "umamusume": (
+                UmamusumeSerializer(regist_umamusume.umamusume).data if expand_umamusume else regist_umamusume.umamusume_id
+            ),
+            "isAllCrown": is_all_crown,
+            "breedingCount": breedingCount,
+            **counts,
+        }
+        if fields is not None:
+            result = {key: value for key, value in result.items() if key in fields}
+        results.append(((counts['allCrownRace'], regist_umamusume.umamusume.umamusume_name), result))
+    
+    # allCrownRaceの昇順、次にウマ娘名の昇順（五十音順）でソート
+    return [result for _, result in sorted(results, key=lambda item: item[0])]
+
+
 @api_view(['GET'])
 @permission_classes([IsAuthenticated])
+@cache_user_response
+@admission_control
 def remaining(request):
     """ユーザーが登録したウマ娘の未出走データを取得するAPI
     * @param request HTTPリクエストオブジェクト
     * @param request.user.user_id ユーザーID
+    * @param request.query_params.fields 返すフィールド (カンマ区切り、省略時はすべて)
+    * @param request.query_params.expand 展開する入れ子のフィールド (カンマ区切り、指定しないものはIDのみ。省略時はすべて展開)
     * @return Response ウマ娘別の残レース情報
     """
     logger = UmamusumeLog(request)
@@ -83,64 +216,31 @@ def remaining(request):
     
     try:
         user_id = request.user.user_id
-        regist_umamusumes = RegistUmamusume.objects.filter(user_id=user_id).select_related('umamusume')
+        regist_umamusumes = list(RegistUmamusume.objects.filter(user_id=user_id).select_related('umamusume'))
 
         # 登録ウマ娘のIDリストを作成
         regist_umamusume_ids = [ru.umamusume_id for ru in regist_umamusumes]
 
         # 出走済みレースIDをウマ娘ごとにまとめて取得 (N+1問題対策)
-        run_races_qs = RegistUmamusumeRace.objects.filter(
+        run_races = list(RegistUmamusumeRace.objects.filter(
             user_id=user_id,
             umamusume_id__in=regist_umamusume_ids
-        ).values('umamusume_id', 'race_id')
-
-        # ウマ娘IDをキー、レースIDのリストを値とする辞書を作成
-        run_races_by_umamusume = {}
-        for item in run_races_qs:
-            umamusume_id = item['umamusume_id']
-            if umamusume_id not in run_races_by_umamusume:
-                run_races_by_umamusume[umamusume_id] = []
-            run_races_by_umamusume[umamusume_id].append(item['race_id'])
-
-        results = []
-        # G1, G2, G3ランクの全レースを事前に取得
-        target_races = Race.objects.filter(race_rank__in=[1, 2, 3])
-        count_keys = ["allCrownRace", "turfSprintRace", "turfMileRace", "turfClassicRace", "turfLongDistanceRace", "dirtSprintDistanceRace", "dirtMileRace", "dirtClassicRace"]
-
-        for regist_umamusume in regist_umamusumes:
-            regist_race_ids = run_races_by_umamusume.get(regist_umamusume.umamusume_id, [])
-            
-            remaining_races = target_races.exclude(race_id__in=regist_race_ids)
-            is_all_crown = not remaining_races.exists()
-            
-            if not is_all_crown:
-                breedingCount = getbreedingCountData(regist_umamusume, remaining_races)
-                # aggregateを使用して1回のクエリで各カテゴリのレース数を集計
-                counts = remaining_races.aggregate(
-                    allCrownRace=Count('race_id'),
-                    turfSprintRace=Count('race_id', filter=Q(race_state=0, distance=1)),
-                    turfMileRace=Count('race_id', filter=Q(race_state=0, distance=2)),
-                    turfClassicRace=Count('race_id', filter=Q(race_state=0, distance=3)),
-                    turfLongDistanceRace=Count('race_id', filter=Q(race_state=0, distance=4)),
-                    dirtSprintDistanceRace=Count('race_id', filter=Q(race_state=1, distance=1)),
-                    dirtMileRace=Count('race_id', filter=Q(race_state=1, distance=2)),
-                    dirtClassicRace=Count('race_id', filter=Q(race_state=1, distance=3))
-                )
-            else:
-                breedingCount = 0
-                counts = {key: 0 for key in count_keys}
-            
-            result = {
-                "umamusume": UmamusumeSerializer(regist_umamusume.umamusume).data,
-                "isAllCrown": is_all_crown,
-                "breedingCount": breedingCount,
-                **counts,
-            }
-            results.append(result)
-        
-        # allCrownRaceの昇順、次にウマ娘名の昇順（五十音順）でソート
-        sorted_results = sorted(
-            results, key=lambda x: (x['allCrownRace'], x['umamusume']['umamusume_name'])
+        ).values('umamusume_id', 'race_id'))
+
+        # G1, G2, G3ランクの全レースを取得 (プロセス内で共有。ウマ娘ごとの絞り込みはメモリ上で行う)
+        target_races = get_g_races()
+
+        # シナリオレースを登録ウマ娘分まとめて取得 (N+1問題対策)
+        scenario_races = ScenarioRace.objects.filter(umamusume_id__in=regist_umamusume_ids).select_related('race')
+
+        # 出走済みレースがないウマ娘がいる場合のみ、作成済みの目安育成数を取得する
+        fields, expand = parse_sparse_fieldset(request.query_params)
+        has_unrun = set(regist_umamusume_ids) - {item['umamusume_id'] for item in run_races}
+        default_breeding_counts = (
+            get_default_breeding_counts() if has_unrun and is_field_requested(fields, 'breedingCount') else None
+        )
+        sorted_results = build_remaining_results(
+            regist_umamusumes, run_races, target_races, scenario_races, default_breeding_counts, fields, expand
         )
         logger.logwrite('end', f'remaining - 取得ウマ娘数:{len(sorted_results)} (user_id:{user_id})')
         return Response({'data': sorted_results})
@@ -309,6 +409,7 @@ def set_race_forward(regist_race_ids, prop):
 
 @api_view(['POST'])
 @permission_classes([IsAuthenticated])
+@bumps_data_version
 def race_register_one(request):
     """対象のレースを1件出走登録するAPI
     * @param request HTTPリクエストオブジェクト
@@ -357,6 +458,7 @@ def race_register_one(request):
 
 @api_view(['POST'])
 @permission_classes([IsAuthenticated])
+@bumps_data_version
 def race_run(request):
     """対象のレースに対して出走した結果を残すAPI
     * @param request HTTPリクエストオブジェクト
@@ -387,14 +489,67 @@ def race_run(request):
         return Response({'error': 'ウマ娘出走エラー'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
 
+def _get_race_pattern_with_profile(user_id, umamusume_id, count):
+    """プロファイルを取得しながらレースパターンを生成する (スタッフ専用)
+    データ取得と生成を分けて計測し、残レースIDなどの入力スナップショットを保存する。
+    * @param user_id ユーザーID
+    * @param umamusume_id ウマ娘ID
+    * @param count 生成するパターン数
+    * @return Response レースパターンデータ (ヘッダーにプロファイルIDを付与)
+    """
+    profiler = RequestProfiler('get_race_pattern')
+    inputs = profiler.run(load_race_pattern_inputs, user_id, umamusume_id)
+    race_pattern = profiler.run(build_race_pattern_data, *inputs)
+
+    umamusume_data, remaining_races, _, _ = inputs
+    profiler.save({
+        'user_id': user_id,
+        'umamusume_id': umamusume_data.umamusume_id,
+        'count': count,
+        'remaining_race_ids': [race.race_id for race in remaining_races],
+        'result_digest': race_pattern_digest(race_pattern),
+    })
+    response = Response({'data': race_pattern})
+    response[PROFILE_ID_HEADER] = profiler.profile_id
+    return response
+
+
+# レースパターンのリクエストで指定できるカウントの上限
+RACE_PATTERN_MAX_COUNT = 100
+
+
+def parse_race_pattern_params(data):
+    """レースパターンのリクエストのウマ娘ID・カウントを整数に変換する
+    同じ入力のリクエストの処理を共有するキーに使うため、型の違う同じ値は同じ値にそろえる。
+    * @param data リクエストデータ
+    * @param data.umamusumeId ウマ娘ID
+    * @param data.count カウント (省略可、0〜RACE_PATTERN_MAX_COUNT)
+    * @return tuple (ウマ娘ID, カウント (省略時はNone))
+    * @raise ValueError 整数でない場合・カウントが範囲外の場合
+    """
+    try:
+        umamusume_id = int(data.get('umamusumeId'))
+        count = data.get('count')
+        if count is not None:
+            count = int(count)
+    except (TypeError, ValueError):
+        raise ValueError('umamusumeId・countは整数で指定してください。')
+    if count is not None and not 0 <= count <= RACE_PATTERN_MAX_COUNT:
+        raise ValueError(f'countは0〜{RACE_PATTERN_MAX_COUNT}で指定してください。')
+    return umamusume_id, count
+
+
 @api_view(['POST'])
 @permission_classes([IsAuthenticated])
+@admission_control
 def get_race_pattern(request):
     """残レースから計算したレース順序を出力するAPI
     * @param request HTTPリクエストオブジェクト
     * @param request.user.user_id ユーザーID
     * @param request.data.umamusumeId ウマ娘ID
-    * @param request.data.count カウント
+    * @param request.data.count カウント (0〜RACE_PATTERN_MAX_COUNT)
+    * @param request.data.debug Trueの場合、処理内訳をdebugに含める (スタッフのみ)
+    * @param request.data.responseFormat 'compact' の場合、各パターンをスロットごとのレースIDの配列で返す
     * @return Response レースパターンデータ
     """
     logger = UmamusumeLog(request)
@@ -402,26 +557,107 @@ def get_race_pattern(request):
     
     try:
         user_id = request.user.user_id
-        umamusume_id = request.data.get('umamusumeId')
-        count = request.data.get('count')
-        
-        # RegistUmamusumeを取得
-        regist_umamusume = RegistUmamusume.objects.get(user_id=user_id, umamusume_id=umamusume_id)
-        
-        # 出走済みレースIDを取得
-        regist_race_ids = RegistUmamusumeRace.objects.filter(
-            user_id=user_id,
-            umamusume_id=umamusume_id
-        ).values_list('race_id', flat=True)
+        try:
+            umamusume_id, count = parse_race_pattern_params(request.data)
+        except ValueError as e:
+            logger.logwrite('error', f'get_race_pattern - 不正なパラメータ: {e}')
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
         
-        # 残レースを取得
-        remaining_races = Race.objects.exclude(race_id__in=regist_race_ids).filter(race_rank__in=[1, 2, 3])
+        if is_profile_requested(request):
+            return _get_race_pattern_with_profile(user_id, umamusume_id, count)
 
-        # シナリオレースを取得
-        scenario_races = ScenarioRace.objects.filter(umamusume_id=regist_umamusume.umamusume_id)
-        
-        race_pattern = get_race_pattern_data(count, user_id, umamusume_id)
-        return Response({'data': race_pattern})
+        tracer = Tracer('get_race_pattern')
+        # 処理内訳の返却はスタッフのみ (スタッフ以外の指定は無視し、通常どおりキャッシュを使う)
+        debug = bool(request.data.get('debug')) and is_staff_user(request.user)
+        # 同じ入力のリクエストが処理中の場合はその結果を共有する (処理内訳を返す場合は共有しない)
+        key = None if debug else (user_id, umamusume_id, count, get_data_version(user_id))
+        # 処理内訳を返す場合は既定レースパターンのキャッシュを使わない
+        race_pattern = pattern_flight.do(
+            key, get_race_pattern_data, count, user_id, umamusume_id, tracer=tracer, use_cache=not debug
+        )
+        tracer.finish()
+        tracer.record_metrics()
+        logger.log_trace('get_race_pattern', tracer)
+
+        if request.data.get('responseFormat') == 'compact':
+            race_pattern = compact_race_pattern(race_pattern)
+        response_data = {'data': race_pattern}
+        if debug:
+            response_data['debug'] = {'trace': tracer.to_dict()}
+        return Response(response_data)
     except Exception as e:
         logger.logwrite('error', f'get_race_pattern:{e}')
         return Response({'error': '残レース計算エラー'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
+def pattern_job_data(job, compact=False):
+    """ジョブのレスポンスデータを作成する (compact がTrueの場合、結果をコンパクト形式にする)"""
+    data = {'jobId': str(job.job_id), 'status': job.status}
+    if job.status == PatternJob.STATUS_DONE:
+        data['result'] = compact_race_pattern(job.result) if compact else job.result
+    elif job.status == PatternJob.STATUS_FAILED:
+        data['error'] = '残レース計算エラー'
+    return data
+
+
+@api_view(['POST'])
+@permission_classes([IsAuthenticated])
+def pattern_job_submit(request):
+    """レースパターン生成をバックグラウンドのジョブとして登録するAPI
+    生成に時間がかかる場合に使用する。結果は pattern_job_status で取得する。
+    * @param request HTTPリクエストオブジェクト
+    * @param request.user.user_id ユーザーID
+    * @param request.data.umamusumeId ウマ娘ID
+    * @param request.data.count カウント
+    * @return Response ジョブID・状態 (202)
+    """
+    logger = UmamusumeLog(request)
+    logger.logwrite('start', 'patternJobSubmit')
+
+    try:
+        user_id = request.user.user_id
+        umamusume_id = request.data.get('umamusumeId')
+        count = request.data.get('count')
+
+        if not RegistUmamusume.objects.filter(user_id=user_id, umamusume_id=umamusume_id).exists():
+            logger.logwrite('error', f'patternJobSubmit - 対象のウマ娘が登録されていません: user_id={user_id}, umamusume_id={umamusume_id}')
+            return Response({'error': '対象のウマ娘が登録されていません。'}, status=status.HTTP_400_BAD_REQUEST)
+
+        job = submit_pattern_job(user_id, umamusume_id, count)
+        logger.logwrite('end', f'patternJobSubmit - job_id:{job.job_id} (user_id:{user_id}, umamusume_id:{umamusume_id})')
+        return Response({'data': pattern_job_data(job)}, status=status.HTTP_202_ACCEPTED)
+    except Exception as e:
+        logger.logwrite('error', f'patternJobSubmit:{e}')
+        return Response({'error': 'ジョブ登録エラー'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+def pattern_job_status(request, job_id):
+    """レースパターン生成ジョブの状態と結果を取得するAPI
+    ワーカーのスレッドを占有しないよう、完了を待たずにすぐ返す。未完了の場合は Retry-After で再取得までの秒数を返す。
+    完了を待つ場合は非同期版 (/api/async/race/pattern-job) の wait を使用する。
+    * @param request HTTPリクエストオブジェクト
+    * @param request.user.user_id ユーザーID
+    * @param request.query_params.responseFormat 'compact' の場合、結果をコンパクト形式で返す
+    * @param job_id ジョブID
+    * @return Response ジョブID・状態・結果
+    """
+    logger = UmamusumeLog(request)
+    logger.logwrite('start', 'patternJobStatus')
+
+    try:
+        user_id = request.user.user_id
+        job = get_pattern_job(job_id, user_id)
+        if job is None:
+            logger.logwrite('error', f'patternJobStatus - ジョブが見つかりません: job_id={job_id}, user_id={user_id}')
+            return Response({'error': 'ジョブが見つかりません。'}, status=status.HTTP_404_NOT_FOUND)
+
+        logger.logwrite('end', f'patternJobStatus - job_id:{job_id} status:{job.status}')
+        compact = request.query_params.get('responseFormat') == 'compact'
+        retry_after = get_retry_after(job)
+        headers = {'Retry-After': str(retry_after)} if retry_after is not None else None
+        return Response({'data': pattern_job_data(job, compact)}, headers=headers)
+    except Exception as e:
+        logger.logwrite('error', f'patternJobStatus:{e}')
+        return Response({'error': 'ジョブ取得エラー'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
@@ -0,0 +1,44 @@
+import msgpack
+from django.http import HttpResponse
+from rest_framework.exceptions import NotAcceptable
+from rest_framework.negotiation import DefaultContentNegotiation
+from rest_framework.renderers import BaseRenderer
+from rest_framework.request import Request
+from rest_framework.settings import api_settings
+from rest_framework.utils.encoders import JSONEncoder
+
+
+class MessagePackRenderer(BaseRenderer):
+    """レスポンスを MessagePack で返すレンダラー (Accept: application/msgpack または ?format=msgpack)
+    日時・Decimal・UUID などは JSONRenderer と同じ値に変換するため、JSONと同じ内容になる。
+    """
+    media_type = 'application/msgpack'
+    format = 'msgpack'
+    charset = None
+    render_style = 'binary'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        return msgpack.packb(data, default=JSONEncoder().default, use_bin_type=True)
+
+
+_negotiation = DefaultContentNegotiation()
+
+
+def render_response(request, data, status=200, headers=None):
+    """DRFの Response を使わないビュー (非同期ビューなど) で、api_view と同じくAcceptヘッダーに応じた形式のレスポンスを返す
+    対応する形式がない場合は、先頭のレンダラー (JSON) で返す。
+    * @param request HTTPリクエストオブジェクト
+    * @param data レスポンスデータ
+    * @param status ステータスコード
+    * @param headers 追加するレスポンスヘッダー
+    * @return HttpResponse レスポンス
+    """
+    renderers = [renderer() for renderer in api_settings.DEFAULT_RENDERER_CLASSES]
+    try:
+        renderer, media_type = _negotiation.select_renderer(Request(request), renderers)
+    except NotAcceptable:
+        renderer, media_type = renderers[0], renderers[0].media_type
+    content_type = renderer.media_type if renderer.charset is None else f'{renderer.media_type}; charset={renderer.charset}'
+    return HttpResponse(renderer.render(data, media_type), status=status, headers=headers, content_type=content_type)
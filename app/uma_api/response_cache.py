@@ -0,0 +1,171 @@
+import hashlib
+import json
+import secrets
+import time
+from functools import wraps
+
+from django.conf import settings
+from django.core.cache import cache, caches
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
+from django.utils.cache import patch_vary_headers
+from django.utils.http import parse_etags
+from rest_framework.response import Response
+
+from .metrics import REGISTRY
+
+response_cache_lookups = REGISTRY.counter(
+    'uma_api_response_cache_total', 'レスポンスキャッシュの参照回数', ('view', 'result'))
+
+# キャッシュの参照結果を返すレスポンスヘッダー (hit / miss / bypass)
+CACHE_STATUS_HEADER = 'X-Uma-Cache'
+
+
+CATALOG_VERSION_KEY = 'uma_api:catalog_version'
+
+# ワーカー (プロセス) 間で共有されないキャッシュバックエンド
+_PROCESS_LOCAL_CACHES = (LocMemCache, DummyCache)
+
+
+def is_shared_cache():
+    """default のキャッシュがワーカー間で共有されるかを返す
+    locmem はプロセスごと、dummy は保存しないため、別のワーカーでの書き込みやバージョン更新が見えない。
+    * @return bool 共有される場合True
+    """
+    return not isinstance(caches['default'], _PROCESS_LOCAL_CACHES)
+
+
+def _version_key(user_id):
+    return f'uma_api:data_version:{user_id}'
+
+
+def _new_version():
+    """以前に使ったことのないバージョンを作成する (現在時刻 + 乱数)"""
+    return time.time_ns() * 1000 + secrets.randbelow(1000)
+
+
+def _get_version(key):
+    """キャッシュに保存したバージョンを取得する"""
+    version = cache.get(key)
+    if version is None:
+        # キャッシュから破棄された後に以前と同じ値に戻らないよう、新しい値を初期値にする
+        cache.add(key, _new_version(), None)
+        version = cache.get(key)
+    return version
+
+
+def _bump_version(key):
+    """キャッシュに保存したバージョンを新しい値にする
+    incr は file などのバックエンドでは読み込みと書き込みが分かれており、同時に書き込んだ2つのリクエストが
+    同じ値に進めると、間に作成された古いレスポンス・ETagが有効なまま残るため、毎回一意な値を設定する。
+    """
+    version = _new_version()
+    cache.set(key, version, None)
+    return version
+
+
+def get_data_version(user_id):
+    """ユーザー別データのバージョンを取得する (ユーザーが書き込むたびに変わる)
+    * @param user_id ユーザーID
+    * @return int バージョン
+    """
+    return _get_version(_version_key(user_id))
+
+
+def bump_data_version(user_id):
+    """ユーザー別データのバージョンを進め、そのユーザーのキャッシュ済みレスポンスを無効にする
+    * @param user_id ユーザーID
+    * @return int 新しいバージョン
+    """
+    return _bump_version(_version_key(user_id))
+
+
+def get_catalog_version():
+    """マスタ (ウマ娘・レース・ライブなど) のバージョンを取得する (load_data で変わる)
+    * @return int バージョン
+    """
+    return _get_version(CATALOG_VERSION_KEY)
+
+
+def bump_catalog_version():
+    """マスタのバージョンを進め、マスタに依存するキャッシュをすべて無効にする
+    * @return int 新しいバージョン
+    """
+    return _bump_version(CATALOG_VERSION_KEY)
+
+
+def _response_key(view_name, user_id, version, request):
+    """API名・ユーザー・バージョン・マスタのバージョン・リクエストパラメータからキャッシュキーを作成する"""
+    params = json.dumps([request.query_params, request.data], sort_keys=True, default=str)
+    digest = hashlib.sha1(params.encode()).hexdigest()
+    return f'uma_api:response:{view_name}:{user_id}:{version}:{get_catalog_version()}:{digest}'
+
+
+def _is_not_modified(request, etag):
+    """If-None-Match のいずれかがETagと一致するかを返す"""
+    if_none_match = request.headers.get('If-None-Match')
+    if not if_none_match:
+        return False
+    etags = parse_etags(if_none_match)
+    # 弱いETag (W/) も同じものとして比較する
+    return '*' in etags or etag in [value.removeprefix('W/') for value in etags]
+
+
+def cache_user_response(view_func):
+    """ユーザー別データのみに依存するAPIのレスポンスを、ユーザーのデータバージョンごとにキャッシュするデコレータ
+    api_view・permission_classes の内側に付ける。キャッシュするのはステータス200のレスポンスのみ。
+    GETの場合はキャッシュキーから作ったETagを返し、If-None-Match が一致すれば処理を行わずに304を返す。
+    キャッシュがワーカー間で共有されない場合は、別のワーカーでの書き込みが見えないためキャッシュもETagも使わない。
+    * @param view_func ビュー関数
+    * @return ビュー関数
+    """
+    view_name = view_func.__name__
+
+    @wraps(view_func)
+    def wrapper(request, *args, **kwargs):
+        if not is_shared_cache():
+            response_cache_lookups.inc(view=view_name, result='bypass')
+            response = view_func(request, *args, **kwargs)
+            response[CACHE_STATUS_HEADER] = 'bypass'
+            return response
+
+        user_id = request.user.user_id
+        # 処理中に書き込まれた場合は古いバージョンのキーに保存されるため、次回は再計算される
+        key = _response_key(view_name, user_id, get_data_version(user_id), request)
+        # JSON と MessagePack では内容が異なるため、ETagは形式ごとに分ける
+        etag_source = f'{key}:{request.accepted_renderer.format}'
+        etag = f'"{hashlib.sha1(etag_source.encode()).hexdigest()[:20]}"' if request.method == 'GET' else None
+        if etag and _is_not_modified(request, etag):
+            response_cache_lookups.inc(view=view_name, result='not_modified')
+            return Response(status=304, headers={'ETag': etag})
+
+        data = cache.get(key)
+        if data is not None:
+            response_cache_lookups.inc(view=view_name, result='hit')
+            response = Response(data, headers={CACHE_STATUS_HEADER: 'hit'})
+        else:
+            response_cache_lookups.inc(view=view_name, result='miss')
+            response = view_func(request, *args, **kwargs)
+            if response.status_code == 200:
+                cache.set(key, response.data, getattr(settings, 'UMA_RESPONSE_CACHE_SECONDS', 300))
+            response[CACHE_STATUS_HEADER] = 'miss'
+        if etag and response.status_code == 200:
+            response['ETag'] = etag
+            patch_vary_headers(response, ['Accept'])
+        return response
+    return wrapper
+
+
+def bumps_data_version(view_func):
+    """書き込みに成功した場合に、ユーザーのデータバージョンを進めるデコレータ
+    ユーザー別データを変更するAPIの api_view・permission_classes の内側に付ける。
+    * @param view_func ビュー関数
+    * @return ビュー関数
+    """
+    @wraps(view_func)
+    def wrapper(request, *args, **kwargs):
+        response = view_func(request, *args, **kwargs)
+        if response.status_code < 400:
+            bump_data_version(request.user.user_id)
+        return response
+    return wrapper
@@ -0,0 +1,177 @@
+import contextvars
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+from django.db import DEFAULT_DB_ALIAS, connections
+
+from .metrics import get_view_name
+from .response_cache import is_shared_cache
+from .sharding import SHARDED_MODEL_NAMES, get_shard_user, get_shards, shard_for_user
+from .slowQuery import _get_user_id
+
+# 参照のみのAPI (URL名)。これらのAPIの読み込みはレプリカに振り分ける
+READ_ONLY_VIEWS = frozenset({
+    'acter_list', 'jewel_list', 'live_list', 'umamusume_list_by_live',
+    'race_list', 'race_regist_list', 'remaining', 'remaining_to_race', 'get_race_pattern',
+    'umamusume_regist_list', 'user_regist_umamusume', 'umamusume_list',
+    'calculate_parent_factors', 'calculate_parent_factors_batch', 'search_lineage',
+    'async_race_list', 'async_remaining', 'async_get_race_pattern', 'async_umamusume_list', 'async_live_list',
+})
+
+_routing_state = contextvars.ContextVar('uma_api_db_routing', default=None)
+
+
+class RoutingState:
+    """リクエスト単位の振り分け状態
+    * @param request HTTPリクエストオブジェクト
+    """
+    def __init__(self, request):
+        self.request = request
+        # 参照のみのAPIか (process_view で判定する)
+        self.read_only = False
+        # このリクエストで書き込みを行ったか
+        self.wrote = False
+        # ユーザーがプライマリに固定されているか (未判定の場合はNone)
+        self.pinned = None
+
+
+def get_replica_alias():
+    """レプリカのDBエイリアスを取得する
+    * @return str レプリカのエイリアス (DATABASES に定義されていない場合はNone)
+    """
+    alias = getattr(settings, 'UMA_DB_REPLICA', 'replica')
+    return alias if alias in connections.settings else None
+
+
+def _pin_key(user_id):
+    return f'uma_api:db_pin:{user_id}'
+
+
+def pin_to_primary(user_id):
+    """書き込みを行ったユーザーの読み込みを、UMA_DB_STICKY_SECONDS の間プライマリに固定する
+    レプリカの遅延で、書き込んだ直後のデータが見えなくなるのを防ぐ。
+    * @param user_id ユーザーID
+    * @return None
+    """
+    cache.set(_pin_key(user_id), True, getattr(settings, 'UMA_DB_STICKY_SECONDS', 5))
+
+
+def is_pinned(user_id):
+    """ユーザーの読み込みがプライマリに固定されているかを返す
+    * @param user_id ユーザーID
+    * @return bool 固定されている場合True
+    """
+    return cache.get(_pin_key(user_id), False)
+
+
+def get_current_user_id():
+    """ユーザー別データの振り分けに使うユーザーIDを取得する
+    user_shard で指定したユーザー、なければリクエストの認証済みユーザーを返す。
+    * @return ユーザーID (どちらもない場合はNone)
+    """
+    user_id = get_shard_user()
+    if user_id is None:
+        state = _routing_state.get()
+        if state is not None:
+            user_id = _get_user_id(state.request)
+    return user_id
+
+
+class ShardRouter:
+    """ユーザー別データ (SHARDED_MODELS) を、ユーザーIDから決まるシャードに振り分けるDBルーター
+    ユーザーIDは保存するインスタンス、user_shard の指定、リクエストの認証済みユーザーの順に参照する。
+    シャードが1つの場合やユーザーが特定できない場合は、後続のルーターに任せる。
+    """
+    def _db_for_user_data(self, model, **hints):
+        if model._meta.model_name not in SHARDED_MODEL_NAMES or len(get_shards()) == 1:
+            return None
+        user_id = getattr(hints.get('instance'), 'user_id', None)
+        if user_id is None:
+            user_id = get_current_user_id()
+        return None if user_id is None else shard_for_user(user_id)
+
+    db_for_read = _db_for_user_data
+    db_for_write = _db_for_user_data
+
+
+class ReplicaRouter:
+    """参照のみのAPIの読み込みをレプリカに、それ以外をプライマリ (default) に振り分けるDBルーター
+    リクエストの外 (管理コマンドなど) や、書き込みを行ったリクエスト・ユーザーはプライマリを使用する。
+    """
+    def db_for_read(self, model, **hints):
+        state = _routing_state.get()
+        if state is None or not state.read_only or state.wrote:
+            return None
+        alias = get_replica_alias()
+        if alias is None:
+            return None
+        if state.pinned is None:
+            user_id = _get_user_id(state.request)
+            if user_id is None:
+                # 認証前 (ユーザー取得のクエリなど) はレプリカから読み込む
+                return alias
+            state.pinned = is_pinned(user_id)
+        return None if state.pinned else alias
+
+    def db_for_write(self, model, **hints):
+        state = _routing_state.get()
+        if state is not None:
+            state.wrote = True
+        # レプリカから読み込んだインスタンスの保存もプライマリに書き込む
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # プライマリとレプリカは同じデータを持つため、DBをまたいだ関連付けを許可する
+        return True
+
+
+class DatabaseRoutingMiddleware:
+    """リクエストごとに ShardRouter・ReplicaRouter の振り分け状態を設定するミドルウェア
+    書き込みを行ったユーザーは、応答後に一定時間プライマリに固定する。同期・非同期の両方に対応する。
+    固定はキャッシュに保存するため、レプリカを使用する場合はワーカー間で共有されるキャッシュが必要になる。
+    * @param get_response 次の処理
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        if get_replica_alias() is not None and not is_shared_cache():
+            # 書き込んだワーカー以外では固定が見えず、書き込み直後の読み込みがレプリカに振り分けられるため起動しない
+            raise ImproperlyConfigured(
+                'レプリカを使用する場合は、UMA_CACHE_BACKEND にワーカー間で共有されるキャッシュ (file など) を指定してください。'
+            )
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        state = RoutingState(request)
+        token = _routing_state.set(state)
+        try:
+            return self.get_response(request)
+        finally:
+            _routing_state.reset(token)
+            user_id = _get_user_id(request) if state.wrote else None
+            if user_id is not None:
+                pin_to_primary(user_id)
+
+    async def __acall__(self, request):
+        state = RoutingState(request)
+        token = _routing_state.set(state)
+        try:
+            return await self.get_response(request)
+        finally:
+            _routing_state.reset(token)
+            user_id = _get_user_id(request) if state.wrote else None
+            if user_id is not None:
+                await cache.aset(_pin_key(user_id), True, getattr(settings, 'UMA_DB_STICKY_SECONDS', 5))
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        state = _routing_state.get()
+        if state is not None:
+            state.read_only = get_view_name(request) in READ_ONLY_VIEWS
+        return None
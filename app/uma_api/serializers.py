@@ -2,13 +2,69 @@ from rest_framework import serializers
 from .models import *
 
 
-class UmamusumeSerializer(serializers.ModelSerializer):
+def parse_sparse_fieldset(query_params):
+    """クエリパラメータの fields (返すフィールド)・expand (展開する入れ子のフィールド) を取得する
+    どちらもカンマ区切りで指定する。expand= のように空で指定した場合は、入れ子をすべてIDのみにする。
+    * @param query_params クエリパラメータ (request.query_params または request.GET)
+    * @return tuple (fields, expand) 指定がないものはNone
+    """
+    def parse(name):
+        value = query_params.get(name)
+        if value is None:
+            return None
+        return [field.strip() for field in value.split(',') if field.strip()]
+    return parse('fields'), parse('expand')
+
+
+def is_field_requested(fields, name):
+    """fields の指定でフィールドを返すかどうか (未指定の場合はすべて返す)"""
+    return fields is None or name in fields
+
+
+def sparse_rows(rows, fields=None, expand=None):
+    """シリアライズ済みのデータに fields・expand を適用する (キャッシュ済みのデータ用。元のデータは変更しない)
+    expand に含まれない入れ子のオブジェクトは、そのIDのみにする (IDのキーは「フィールド名_id」)。
+    * @param rows シリアライズ済みのデータのリスト
+    * @param fields 返すフィールド名のリスト (Noneの場合はすべて)
+    * @param expand 展開する入れ子のフィールド名のリスト (Noneの場合はすべて展開する)
+    * @return list 適用後のデータのリスト
+    """
+    if fields is None and expand is None:
+        return rows
+    results = []
+    for row in rows:
+        row = {key: value for key, value in row.items() if is_field_requested(fields, key)}
+        if expand is not None:
+            for key, value in row.items():
+                if isinstance(value, dict) and key not in expand:
+                    row[key] = value.get(f'{key}_id')
+        results.append(row)
+    return results
+
+
+class SparseFieldsMixin:
+    """返すフィールドと入れ子の展開を指定できるシリアライザ
+    fields を指定するとそのフィールドのみを返す (存在しない名前は無視する)。
+    expand を指定すると、含まれない入れ子のシリアライザはIDのみを返す。どちらも省略時はすべて返す。
+    """
+    def __init__(self, *args, fields=None, expand=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        if fields is not None:
+            for name in set(self.fields) - set(fields):
+                self.fields.pop(name)
+        if expand is not None:
+            for name, field in list(self.fields.items()):
+                if isinstance(field, serializers.BaseSerializer) and name not in expand:
+                    self.fields[name] = serializers.PrimaryKeyRelatedField(read_only=True)
+
+
+class UmamusumeSerializer(SparseFieldsMixin, serializers.ModelSerializer):
     class Meta:
         model = Umamusume
         fields = '__all__'
 
 
-class UmamusumeActerSerializer(serializers.ModelSerializer):
+class UmamusumeActerSerializer(SparseFieldsMixin, serializers.ModelSerializer):
     umamusume = UmamusumeSerializer(read_only=True)
     
     class Meta:
@@ -16,13 +72,13 @@ class UmamusumeActerSerializer(serializers.ModelSerializer):
         fields = '__all__'
 
 
-class LiveSerializer(serializers.ModelSerializer):
+class LiveSerializer(SparseFieldsMixin, serializers.ModelSerializer):
     class Meta:
         model = Live
         fields = '__all__'
 
 
-class VocalUmamusumeSerializer(serializers.ModelSerializer):
+class VocalUmamusumeSerializer(SparseFieldsMixin, serializers.ModelSerializer):
     umamusume = UmamusumeSerializer(read_only=True)
     
     class Meta:
@@ -30,13 +86,13 @@ class VocalUmamusumeSerializer(serializers.ModelSerializer):
         fields = '__all__'
 
 
-class RaceSerializer(serializers.ModelSerializer):
+class RaceSerializer(SparseFieldsMixin, serializers.ModelSerializer):
     class Meta:
         model = Race
         fields = '__all__'
 
 
-class RegistUmamusumeSerializer(serializers.ModelSerializer):
+class RegistUmamusumeSerializer(SparseFieldsMixin, serializers.ModelSerializer):
     umamusume = UmamusumeSerializer(read_only=True)
     
     class Meta:
@@ -44,7 +100,7 @@ class RegistUmamusumeSerializer(serializers.ModelSerializer):
         fields = '__all__'
 
 
-class JewelSerializer(serializers.ModelSerializer):
+class JewelSerializer(SparseFieldsMixin, serializers.ModelSerializer):
     class Meta:
         model = Jewel
         fields = '__all__'
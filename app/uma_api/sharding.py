@@ -0,0 +1,141 @@
+import contextvars
+import hashlib
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .models import (
+    Jewel, Live, Race, RegistUmamusume, RegistUmamusumeRace, ScenarioRace, Umamusume, UmamusumeActer,
+    UserPersonal, VocalUmamusume,
+)
+
+# ユーザーIDで振り分けるモデル (ユーザー数 × ウマ娘数 × レース数で増える)
+SHARDED_MODELS = (RegistUmamusume, RegistUmamusumeRace, Jewel)
+SHARDED_MODEL_NAMES = frozenset(model._meta.model_name for model in SHARDED_MODELS)
+
+# 全シャードに複製するマスタ (外部キーの参照先の順に並べる)
+CATALOG_MODELS = (Umamusume, UmamusumeActer, Live, VocalUmamusume, Race, ScenarioRace)
+
+_shard_user = contextvars.ContextVar('uma_api_shard_user', default=None)
+
+
+def get_shards():
+    """シャードのDBエイリアスのリストを取得する
+    * @return list シャードのエイリアス (未設定の場合は ['default'])
+    """
+    return getattr(settings, 'UMA_SHARDS', None) or [DEFAULT_DB_ALIAS]
+
+
+def shard_for_user(user_id, shards=None):
+    """ユーザーのデータを保存するシャードを決める (Rendezvous hashing)
+    シャードを追加・削除しても、移動するのはそのシャードに割り当たるユーザーのみになる。
+    * @param user_id ユーザーID
+    * @param shards シャードのエイリアスのリスト (省略時は UMA_SHARDS)
+    * @return str シャードのエイリアス
+    """
+    shards = shards or get_shards()
+    if len(shards) == 1:
+        return shards[0]
+    return max(shards, key=lambda alias: hashlib.sha1(f'{alias}:{user_id}'.encode()).digest())
+
+
+def get_shard_user():
+    """user_shard で指定したユーザーIDを取得する (指定していない場合はNone)"""
+    return _shard_user.get()
+
+
+@contextmanager
+def user_shard(user_id):
+    """リクエストの外 (管理コマンドなど) で、ユーザー別データの操作を指定ユーザーのシャードに振り分ける
+    * @param user_id ユーザーID
+    * @return str シャードのエイリアス
+    """
+    token = _shard_user.set(user_id)
+    try:
+        yield shard_for_user(user_id)
+    finally:
+        _shard_user.reset(token)
+
+
+def copy_user_to_shard(user, alias):
+    """ユーザー別データの外部キーの参照先として、ユーザーの行をシャードに複製する
+    * @param user ユーザーオブジェクト (default のもの)
+    * @param alias 複製先のエイリアス
+    * @return None
+    """
+    if alias == DEFAULT_DB_ALIAS:
+        return
+    defaults = {field.attname: getattr(user, field.attname) for field in UserPersonal._meta.concrete_fields if not field.primary_key}
+    UserPersonal._base_manager.using(alias).update_or_create(pk=user.pk, defaults=defaults)
+
+
+@receiver(post_save, sender=UserPersonal)
+def _replicate_user(sender, instance, using, **kwargs):
+    """default のユーザーの登録・更新を、ユーザーのシャードに反映する"""
+    if using == DEFAULT_DB_ALIAS:
+        copy_user_to_shard(instance, shard_for_user(instance.pk))
+
+
+@receiver(post_delete, sender=UserPersonal)
+def _delete_replicated_user(sender, instance, using, **kwargs):
+    """default のユーザーの削除を、ユーザーのシャードに反映する (シャード側のユーザー別データも削除される)"""
+    alias = shard_for_user(instance.pk)
+    if using == DEFAULT_DB_ALIAS and alias != DEFAULT_DB_ALIAS:
+        UserPersonal._base_manager.using(alias).filter(pk=instance.pk).delete()
+
+
+def sync_catalog(alias):
+    """default のマスタをシャードに複製する (既存の行は上書きする)
+    * @param alias 複製先のエイリアス
+    * @return dict モデル名ごとの件数
+    """
+    counts = {}
+    with transaction.atomic(using=alias):
+        for model in CATALOG_MODELS:
+            rows = list(model._base_manager.using(DEFAULT_DB_ALIAS).all())
+            if rows:
+                model._base_manager.using(alias).bulk_create(
+                    rows, batch_size=500, update_conflicts=True, unique_fields=[model._meta.pk.name],
+                    update_fields=[field.name for field in model._meta.concrete_fields if not field.primary_key],
+                )
+            counts[model.__name__] = len(rows)
+    return counts
+
+
+def find_user_ids(alias):
+    """指定したDBにユーザー別データを持つユーザーIDを取得する
+    * @param alias DBエイリアス
+    * @return set ユーザーIDの集合
+    """
+    user_ids = set()
+    for model in SHARDED_MODELS:
+        user_ids.update(model._base_manager.using(alias).values_list('user_id', flat=True).distinct())
+    return user_ids
+
+
+def move_user(user_id, source, target):
+    """ユーザー別データを別のシャードに移動する
+    移動先に書き込んでから移動元を削除する (途中で失敗した場合は両方に残るため、再実行すればよい)。
+    * @param user_id ユーザーID
+    * @param source 移動元のエイリアス
+    * @param target 移動先のエイリアス
+    * @return dict モデル名ごとの移動件数
+    """
+    copy_user_to_shard(UserPersonal._base_manager.using(DEFAULT_DB_ALIAS).get(pk=user_id), target)
+    counts = {}
+    with transaction.atomic(using=source):
+        with transaction.atomic(using=target):
+            for model in SHARDED_MODELS:
+                rows = list(model._base_manager.using(source).filter(user_id=user_id))
+                for row in rows:
+                    # 主キーはシャードごとの連番のため、移動先で採番し直す
+                    row.pk = None
+                model._base_manager.using(target).bulk_create(rows, ignore_conflicts=True)
+                model._base_manager.using(source).filter(user_id=user_id).delete()
+                counts[model.__name__] = len(rows)
+        if source != DEFAULT_DB_ALIAS:
+            UserPersonal._base_manager.using(source).filter(pk=user_id).delete()
+    return counts
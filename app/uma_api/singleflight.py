@@ -0,0 +1,143 @@
+import asyncio
+import os
+import threading
+
+from django.conf import settings
+
+from .metrics import REGISTRY
+
+singleflight_calls = REGISTRY.counter(
+    'uma_api_singleflight_total', '重複排除した処理の呼び出し回数 (leader: 実行 / shared: 実行中の結果を共有)', ('name', 'result'))
+singleflight_in_flight = REGISTRY.gauge('uma_api_singleflight_in_flight', '実行中の処理数', ('name',))
+singleflight_queued = REGISTRY.gauge('uma_api_singleflight_queued', '同時実行数の上限で待っている処理数', ('name',))
+
+
+class _Call:
+    """実行中の処理 (同じキーの呼び出し元が結果を待つ)"""
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """同じキーの処理を同時に1つだけ実行し、実行中に呼ばれた場合はその結果を共有する (プロセス内)
+    結果は呼び出し元で共有するため、受け取った値は変更しないこと。
+    キーによらず同時に実行する処理数は UMA_PATTERN_MAX_CONCURRENCY (未設定の場合はCPU数) までに制限する。
+    * @param name メトリクスに記録する名前
+    """
+    def __init__(self, name):
+        self.name = name
+        self._lock = threading.Lock()
+        self._calls = {}
+        self._futures = {}
+        self._semaphore = None
+        self._queued = 0
+
+    def _get_semaphore(self):
+        if self._semaphore is None:
+            with self._lock:
+                if self._semaphore is None:
+                    limit = getattr(settings, 'UMA_PATTERN_MAX_CONCURRENCY', None) or os.cpu_count()
+                    self._semaphore = threading.BoundedSemaphore(limit)
+        return self._semaphore
+
+    def _update_in_flight(self):
+        singleflight_in_flight.set(len(self._calls) + len(self._futures), name=self.name)
+
+    def _set_queued(self, delta):
+        with self._lock:
+            self._queued += delta
+            singleflight_queued.set(self._queued, name=self.name)
+
+    def _run(self, func, args, kwargs):
+        """同時実行数の上限内で処理を実行する"""
+        semaphore = self._get_semaphore()
+        if not semaphore.acquire(blocking=False):
+            self._set_queued(1)
+            try:
+                semaphore.acquire()
+            finally:
+                self._set_queued(-1)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            semaphore.release()
+
+    def do(self, key, func, *args, **kwargs):
+        """同じキーの処理が実行中であれば完了を待ってその結果を返し、なければ実行する
+        * @param key 入力を表すキー (Noneの場合は共有せず、同時実行数の制限のみ行う)
+        * @param func 実行する関数
+        * @param args 関数の引数
+        * @param kwargs 関数のキーワード引数
+        * @return 関数の戻り値 (実行中の処理が例外で終了した場合は同じ例外を送出する)
+        """
+        if key is None:
+            return self._run(func, args, kwargs)
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+                self._update_in_flight()
+
+        if not leader:
+            singleflight_calls.inc(name=self.name, result='shared')
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        singleflight_calls.inc(name=self.name, result='leader')
+        try:
+            call.result = self._run(func, args, kwargs)
+            return call.result
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+                self._update_in_flight()
+            call.done.set()
+
+    async def ado(self, key, func, *args, **kwargs):
+        """do の非同期版 (func はコルーチン関数)
+        同じイベントループ内の呼び出しのみ共有する。同時実行数はパターン生成のプールのワーカー数で制限されるため、ここでは制限しない。
+        * @param key 入力を表すキー (Noneの場合は共有しない)
+        * @param func 実行するコルーチン関数
+        * @param args 関数の引数
+        * @param kwargs 関数のキーワード引数
+        * @return 関数の戻り値
+        """
+        if key is None:
+            return await func(*args, **kwargs)
+        future = self._futures.get(key)
+        if future is not None:
+            singleflight_calls.inc(name=self.name, result='shared')
+            # 待っている呼び出し元がキャンセルされても、実行中の処理は止めない
+            return await asyncio.shield(future)
+
+        singleflight_calls.inc(name=self.name, result='leader')
+        future = self._futures[key] = asyncio.get_running_loop().create_future()
+        self._update_in_flight()
+        try:
+            result = await func(*args, **kwargs)
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            # 待っている呼び出し元がいない場合に未取得の例外として警告されないようにする
+            future.exception()
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            del self._futures[key]
+            self._update_in_flight()
+
+
+# レースパターン生成 (キー: ユーザーID・ウマ娘ID・カウント・ユーザーのデータバージョン)
+pattern_flight = SingleFlight('race_pattern')
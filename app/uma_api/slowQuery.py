@@ -0,0 +1,203 @@
+import logging
+import re
+import threading
+import time
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.utils.functional import SimpleLazyObject, empty
+from rest_framework.decorators import api_view, permission_classes
+from rest_framework.response import Response
+
+from .authentication import IsStaffUser
+from .metrics import REGISTRY, get_view_name, observe_queries
+
+logger = logging.getLogger('uma_api.slow_query')
+
+slow_query_count = REGISTRY.counter(
+    'uma_api_slow_queries_total', '閾値を超えたSQLの件数', ('view',))
+
+# ログに出力するSQLの最大文字数
+SQL_LOG_MAX_LENGTH = 2000
+
+_STRING_LITERAL = re.compile(r"'(?:[^']|'')*'")
+_NUMBER_LITERAL = re.compile(r'\b\d+(?:\.\d+)?\b')
+_PLACEHOLDER = re.compile(r'%s|\?')
+_IN_LIST = re.compile(r'\bIN\s*\(\s*\?(?:\s*,\s*\?)*\s*\)', re.IGNORECASE)
+_WHITESPACE = re.compile(r'\s+')
+
+
+def fingerprint_sql(sql):
+    """SQLを正規化し、同じ形のクエリを同一視するためのフィンガープリントにする
+    リテラルとプレースホルダーを ? に置き換え、IN句のリストは件数によらず IN (...) にまとめる。
+    * @param sql SQL文
+    * @return str フィンガープリント
+    """
+    normalized = _STRING_LITERAL.sub('?', sql)
+    normalized = _NUMBER_LITERAL.sub('?', normalized)
+    normalized = _PLACEHOLDER.sub('?', normalized)
+    normalized = _IN_LIST.sub('IN (...)', normalized)
+    return _WHITESPACE.sub(' ', normalized).strip()
+
+
+class SlowQueryLog:
+    """閾値を超えたSQLをフィンガープリント単位で集計し、合計時間の上位を保持するクラス
+    * @param max_entries 保持するフィンガープリント数の上限 (超えた場合は合計時間の短いものから破棄)
+    """
+    def __init__(self, max_entries=200):
+        self.max_entries = max_entries
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def record(self, sql, params, duration, view_name, user_id):
+        """低速なSQLを記録する
+        * @param sql SQL文
+        * @param params パラメータ
+        * @param duration 処理時間(秒)
+        * @param view_name 呼び出し元のAPI名
+        * @param user_id ユーザーID (未認証の場合はNone)
+        * @return str フィンガープリント
+        """
+        fingerprint = fingerprint_sql(sql)
+        param_count = len(params) if isinstance(params, (list, tuple)) else 0
+        with self._lock:
+            entry = self._entries.get(fingerprint)
+            if entry is None:
+                if len(self._entries) >= self.max_entries:
+                    smallest = min(self._entries, key=lambda key: self._entries[key]['total_ms'])
+                    del self._entries[smallest]
+                entry = self._entries[fingerprint] = {
+                    'fingerprint': fingerprint, 'count': 0, 'total_ms': 0.0, 'max_ms': 0.0,
+                    'max_params': 0, 'views': {}, 'sample_sql': sql[:SQL_LOG_MAX_LENGTH], 'last_user_id': None,
+                }
+            duration_ms = duration * 1000
+            entry['count'] += 1
+            entry['total_ms'] += duration_ms
+            if duration_ms >= entry['max_ms']:
+                entry['max_ms'] = duration_ms
+                entry['sample_sql'] = sql[:SQL_LOG_MAX_LENGTH]
+            entry['max_params'] = max(entry['max_params'], param_count)
+            entry['views'][view_name] = entry['views'].get(view_name, 0) + 1
+            entry['last_user_id'] = user_id
+        return fingerprint
+
+    def top(self, limit=None):
+        """合計時間の長い順にフィンガープリントを返す
+        * @param limit 返却件数 (省略時は UMA_SLOW_QUERY_TOP_N)
+        * @return list 集計結果のリスト
+        """
+        if limit is None:
+            limit = getattr(settings, 'UMA_SLOW_QUERY_TOP_N', 20)
+        with self._lock:
+            entries = sorted(self._entries.values(), key=lambda entry: entry['total_ms'], reverse=True)[:limit]
+            return [
+                {**entry, 'total_ms': round(entry['total_ms'], 3), 'max_ms': round(entry['max_ms'], 3),
+                 'views': dict(entry['views'])}
+                for entry in entries
+            ]
+
+    def clear(self):
+        """集計結果を削除する"""
+        with self._lock:
+            self._entries.clear()
+
+
+SLOW_QUERIES = SlowQueryLog()
+
+
+def _get_user_id(request):
+    """認証済みユーザーのIDを取得する
+    SQL実行中に呼ばれるため、未評価の遅延ユーザーは評価しない (再帰的なクエリを避ける)。
+    """
+    user = request.__dict__.get('user')
+    if user is None or (isinstance(user, SimpleLazyObject) and user._wrapped is empty):
+        return None
+    return getattr(user, 'user_id', None)
+
+
+class SlowQueryWrapper:
+    """observe_queries に渡し、閾値を超えたSQLをログと集計に記録するクラス
+    * @param request HTTPリクエストオブジェクト
+    * @param threshold 閾値(秒)
+    """
+    def __init__(self, request, threshold):
+        self.request = request
+        self.threshold = threshold
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            duration = time.perf_counter() - start
+            if duration >= self.threshold:
+                self._record(sql, params, duration)
+
+    def _record(self, sql, params, duration):
+        view_name = get_view_name(self.request)
+        user_id = _get_user_id(self.request)
+        fingerprint = SLOW_QUERIES.record(sql, params, duration, view_name, user_id)
+        slow_query_count.inc(view=view_name)
+        logger.warning(
+            '%sで低速なSQLを検出しました。%.1fms | user_id:%s | fingerprint:%s',
+            view_name, duration * 1000, user_id, fingerprint,
+            extra={'event': 'slow_query', 'attribute': view_name, 'request_info': {'user_id': user_id},
+                   'query': {'fingerprint': fingerprint, 'duration_ms': round(duration * 1000, 3),
+                             'sql': sql[:SQL_LOG_MAX_LENGTH]}},
+        )
+
+
+class SlowQueryMiddleware:
+    """UMA_SLOW_QUERY_MS を超えたSQLを、呼び出し元のAPI名・ユーザーIDとともに記録するミドルウェア
+    UMA_SLOW_QUERY_MS が負の値の場合は記録しない。同期・非同期の両方に対応する。
+    * @param get_response 次の処理
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def _get_threshold(self):
+        """閾値(秒)を取得する (無効の場合はNone)"""
+        threshold_ms = getattr(settings, 'UMA_SLOW_QUERY_MS', 100)
+        return None if threshold_ms < 0 else threshold_ms / 1000
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        threshold = self._get_threshold()
+        if threshold is None:
+            return self.get_response(request)
+
+        with observe_queries(SlowQueryWrapper(request, threshold)):
+            return self.get_response(request)
+
+    async def __acall__(self, request):
+        threshold = self._get_threshold()
+        if threshold is None:
+            return await self.get_response(request)
+
+        with observe_queries(SlowQueryWrapper(request, threshold)):
+            return await self.get_response(request)
+
+
+@api_view(['GET'])
+@permission_classes([IsStaffUser])
+def slow_query_list(request):
+    """低速なSQLの集計結果を合計時間の長い順に返すAPI (スタッフ専用)
+    * @param request HTTPリクエストオブジェクト
+    * @param request.GET.limit 返却件数 (省略時は UMA_SLOW_QUERY_TOP_N)
+    * @return Response 低速SQLの集計結果
+    """
+    limit = request.GET.get('limit')
+    try:
+        limit = int(limit) if limit else None
+    except ValueError:
+        return Response({'error': 'limitは数値で指定してください'}, status=400)
+    return Response({
+        'threshold_ms': getattr(settings, 'UMA_SLOW_QUERY_MS', 100),
+        'data': SLOW_QUERIES.top(limit),
+    })
@@ -1,3 +1,2062 @@
-from django.test import TestCase
+import asyncio
+import gc
+import importlib
+import json
+import logging
+import os
+import runpy
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+import unittest
+import weakref
+from io import StringIO
+from unittest import mock
 
-# Create your tests here.
\ No newline at end of file
+import msgpack
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import call_command
+from django.db import connection, connections, transaction
+from django.db.backends.postgresql import base as postgresql_base
+from django.test import RequestFactory, SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import AccessToken
+
+from config import settings as project_settings
+
+from .admission import admission_count, limiter, token_bucket
+from .authentication import issue_tokens
+from .calculations import (
+    FACTOR_STYLE_MAP, FACTOR_SURFACE_MAP, build_factor_patterns, calculate_aptitude_factors, get_aptitude_profile,
+)
+from .catalog import (
+    build_default_race_plan, default_plan_hash, get_default_race_pattern, get_g_races, refresh_default_race_plans,
+)
+from .models import *
+from .db.backends.postgresql_pool.base import DatabaseWrapper as PoolDatabaseWrapper, close_pools
+from .db.pool import ConnectionPool, PoolTimeout
+from .lineageSearch import FACTOR_CATEGORIES, build_aptitude_matrix, vectorized_aptitude_factors
+from .metrics import LATENCY_BUCKETS, REGISTRY, MetricsRegistry, request_count, request_db_queries
+from .pattern_jobs import claim_next_job, purge_expired_jobs, submit_pattern_job, work
+from .profiling import PROFILE_ID_HEADER, RequestProfiler
+from .racePattern import COMPACT_SLOTS, build_race_pattern_data, compact_race_pattern, load_race_pattern_inputs_by_race_ids
+from .race_views import RACE_PATTERN_MAX_COUNT, get_race_list_queryset
+from .serializers import LiveSerializer, RaceSerializer, UmamusumeSerializer
+from .routers import DatabaseRoutingMiddleware, ReplicaRouter, is_pinned
+from .response_cache import CACHE_STATUS_HEADER, bump_data_version, get_data_version
+from .sharding import copy_user_to_shard, shard_for_user
+from .singleflight import SingleFlight, pattern_flight, singleflight_calls, singleflight_queued
+from .slowQuery import SLOW_QUERIES, fingerprint_sql, slow_query_count
+from .tracing import phase_loop_passes
+from .urls import urlpatterns
+from .utils import JsonLineFormatter, QueueListenerHandler, RequestInfo, UmamusumeLog
+from .views import FACTOR_BATCH_MAX_SIZE, LINEAGE_SEARCH_MAX_LIMIT
+
+
+class QueryBudgetTest(TestCase):
+    """全APIのクエリ数が宣言した上限以内で、所持ウマ娘数に比例して増えないことを検証するテスト"""
+
+    # 検証する所持ウマ娘数
+    ROSTER_SIZES = (1, 4, 12)
+    # 所持ウマ娘1体あたりの出走済みレース数
+    RUN_RACES_PER_UMAMUSUME = 10
+    PASSWORD = 'budget-password'
+
+    # URL名: (HTTPメソッド, リクエスト生成関数, 最大クエリ数)
+    # リクエスト生成関数はテストケースとユーザーを受け取り、リクエストパラメータを返す
+    BUDGETS = {
+        'acter_list': ('get', lambda t, u: {}, 1),
+        'jewel_list': ('post', lambda t, u: {'year': 2024, 'month': 1}, 1),
+        'jewel_regist': ('post', lambda t, u: {'jewel': 1000}, 1),
+        'live_list': ('get', lambda t, u: {}, 1),
+        'umamusume_list_by_live': ('post', lambda t, u: {'liveId': t.live.live_id}, 1),
+        'race_list': ('post', lambda t, u: {'state': -1, 'distance': -1}, 1),
+        'race_regist_list': ('get', lambda t, u: {}, 1),
+        'remaining': ('get', lambda t, u: {}, 4),
+        'remaining_to_race': ('post', lambda t, u: {
+            'umamusumeId': t.first_umamusume_id(u), 'season': 2, 'month': 5, 'half': 1}, 3),
+        'race_run': ('post', lambda t, u: {
+            'umamusumeId': t.first_umamusume_id(u), 'raceId': t.unrun_race_ids[0]}, 1),
+        'get_race_pattern': ('post', lambda t, u: {'umamusumeId': t.first_umamusume_id(u), 'count': 1}, 4),
+        'register_race_pattern': ('post', lambda t, u: {
+            'umamusumeId': t.first_umamusume_id(u),
+            'races': [{'race_id': race_id} for race_id in t.unrun_race_ids[:3]]}, 3),
+        'race_register_one': ('post', lambda t, u: {
+            'umamusumeId': t.first_umamusume_id(u),
+            'race': {'race_id': t.unrun_race_ids[0], 'race_name': 'テスト'}}, 4),
+        'umamusume_regist_list': ('get', lambda t, u: {}, 1),
+        'umamusume_regist': ('post', lambda t, u: {
+            'umamusumeId': t.unregistered_umamusume_id, 'raceIdArray': t.unrun_race_ids[:3], 'fans': 0}, 2),
+        'user_regist_umamusume': ('get', lambda t, u: {}, 1),
+        'fan_up': ('post', lambda t, u: {'umamusumeId': t.first_umamusume_id(u), 'fans': 100}, 1),
+        'umamusume_list': ('get', lambda t, u: {}, 1),
+        'calculate_parent_factors': ('get', lambda t, u: {
+            'grandparent_umamusume_id': 2, 'grandmother_umamusume_id': 3}, 1),
+        'calculate_parent_factors_batch': ('post', lambda t, u: {'lineages': [
+            {'grandparent_umamusume_id': i, 'grandmother_umamusume_id': i + 1} for i in range(1, 11)]}, 1),
+        'search_lineage': ('post', lambda t, u: {
+            'umamusumeId': t.unregistered_umamusume_id, 'distanceId': 3, 'surfaceId': 1, 'styleId': 3}, 2),
+        'user_register': ('post', lambda t, u: {
+            'user_name': f'new_{u.user_name}', 'password': 'new-password', 'email': ''}, 2),
+        'user_login': ('post', lambda t, u: {'userName': u.user_name, 'password': t.PASSWORD}, 1),
+        'user_logout': ('post', lambda t, u: {}, 0),
+        'get_user_data': ('get', lambda t, u: {}, 1),
+        'async_race_list': ('post', lambda t, u: {'state': -1, 'distance': -1}, 1),
+        'async_remaining': ('get', lambda t, u: {}, 4),
+        'async_get_race_pattern': ('post', lambda t, u: {'umamusumeId': t.first_umamusume_id(u), 'count': 1}, 4),
+        'async_umamusume_list': ('get', lambda t, u: {}, 1),
+        'async_live_list': ('get', lambda t, u: {}, 1),
+        'async_pattern_job_status': ('get', lambda t, u: {}, 1),
+        'pattern_job_submit': ('post', lambda t, u: {'umamusumeId': t.first_umamusume_id(u), 'count': 1}, 3),
+        'pattern_job_status': ('get', lambda t, u: {}, 1),
+        'metrics': ('get', lambda t, u: {}, 0),
+        'slow_query_list': ('get', lambda t, u: {}, 1),
+    }
+
+    # 200以外を返すAPIの期待するステータスコード (URL名: ステータスコード)
+    EXPECTED_STATUS = {
+        'jewel_regist': 201,
+        'race_run': 201,
+        'register_race_pattern': 201,
+        'race_register_one': 201,
+        'umamusume_regist': 201,
+        'fan_up': 201,
+        'user_register': 201,
+        'pattern_job_submit': 202,
+    }
+
+    # スタッフのみ利用できるAPI (対象ユーザーをスタッフにして呼び出す)
+    STAFF_ONLY = {'slow_query_list'}
+
+    # URLのパラメータ生成関数 (URL名: テストケースとユーザーを受け取り、URLのパラメータを返す関数)
+    URL_KWARGS = {
+        'pattern_job_status': lambda t, u: {'job_id': submit_pattern_job(u.user_id, t.first_umamusume_id(u), 1).job_id},
+        'async_pattern_job_status': lambda t, u: {'job_id': submit_pattern_job(u.user_id, t.first_umamusume_id(u), 1).job_id},
+    }
+
+    @classmethod
+    def setUpTestData(cls):
+        call_command('load_data', stdout=StringIO())
+        cls.live = Live.objects.order_by('live_id').first()
+
+        g_race_ids = list(Race.objects.filter(race_rank__in=[1, 2, 3]).order_by('race_id').values_list('race_id', flat=True))
+        run_race_ids = g_race_ids[:cls.RUN_RACES_PER_UMAMUSUME]
+        cls.unrun_race_ids = g_race_ids[cls.RUN_RACES_PER_UMAMUSUME:]
+
+        umamusume_ids = list(Umamusume.objects.order_by('umamusume_id').values_list('umamusume_id', flat=True))
+        cls.unregistered_umamusume_id = umamusume_ids[-1]
+
+        now = timezone.now()
+        cls.users = []
+        for size in cls.ROSTER_SIZES:
+            user = UserPersonal.objects.create_user(f'budget_{size}', cls.PASSWORD)
+            for umamusume_id in umamusume_ids[:size]:
+                RegistUmamusume.objects.create(user=user, umamusume_id=umamusume_id, regist_date=now, fans=0)
+                RegistUmamusumeRace.objects.bulk_create([
+                    RegistUmamusumeRace(user=user, umamusume_id=umamusume_id, race_id=race_id, regist_date=now)
+                    for race_id in run_race_ids
+                ])
+            Jewel.objects.create(user=user, year=2024, month=1, day=1, jewel_amount=100)
+            cls.users.append(user)
+
+    def first_umamusume_id(self, user):
+        return RegistUmamusume.objects.filter(user=user).order_by('umamusume_id').values_list('umamusume_id', flat=True)[0]
+
+    def _count_queries(self, url_name, user):
+        """対象ユーザーでAPIを1回呼び出し、実行されたクエリ数を返す (変更はロールバックする)"""
+        method, build_params, _ = self.BUDGETS[url_name]
+        path = reverse(url_name, kwargs=self.URL_KWARGS[url_name](self, user) if url_name in self.URL_KWARGS else None)
+        params = build_params(self, user)
+
+        # キャッシュ済みのレスポンスではなく、DBから取得する場合のクエリ数を計測する
+        cache.clear()
+        with transaction.atomic():
+            if url_name in self.STAFF_ONLY:
+                user = UserPersonal.objects.get(pk=user.pk)
+                user.is_staff = True
+                user.save(update_fields=['is_staff'])
+            client = APIClient()
+            client.credentials(HTTP_AUTHORIZATION=f'Bearer {issue_tokens(user).access_token}')
+            with CaptureQueriesContext(connections['default']) as queries:
+                if method == 'get':
+                    response = client.get(path, params)
+                else:
+                    response = client.post(path, params, format='json')
+            transaction.set_rollback(True)
+
+        self.assertEqual(response.status_code, self.EXPECTED_STATUS.get(url_name, 200),
+                         f'{url_name}: {getattr(response, "data", response.content)}')
+        return len(queries)
+
+    def test_every_endpoint_has_budget(self):
+        """urls.py の全エンドポイントにクエリ数の上限が宣言されていること"""
+        names = {pattern.name for pattern in urlpatterns}
+        self.assertEqual(names - set(self.BUDGETS), set())
+
+    def test_query_count_within_budget_and_constant(self):
+        """各APIのクエリ数が上限以内で、所持ウマ娘数によらず一定であること"""
+        for url_name, (_, _, budget) in self.BUDGETS.items():
+            with self.subTest(url_name=url_name):
+                counts = [self._count_queries(url_name, user) for user in self.users]
+                self.assertLessEqual(max(counts), budget, f'{url_name}: {dict(zip(self.ROSTER_SIZES, counts))}')
+                self.assertEqual(len(set(counts)), 1, f'{url_name}: {dict(zip(self.ROSTER_SIZES, counts))}')
+
+
+def _legacy_factor_patterns(grandparent, grandmother, surface, style):
+    """メモ化前の calculate_parent_factors と同じ手順で因子パターンを生成する (比較用)"""
+    from itertools import permutations
+
+    factor_a_1, factor_a_2 = calculate_aptitude_factors(grandparent, surface, style)
+    factor_b_1, factor_b_2 = calculate_aptitude_factors(grandmother, surface, style)
+
+    def main_pool(factor_1, factor_2):
+        if factor_1 == "差し" and factor_2 == "差し":
+            return ("芝", "芝")
+        if factor_1 == "芝" and factor_2 == "芝":
+            return ("差し", "差し")
+        return (surface, style)
+
+    main_a_perms = sorted(list(set(permutations(main_pool(factor_a_1, factor_a_2)))))
+    sub_a_perms = sorted(list(set(permutations((factor_a_1, factor_a_2)))))
+    main_b_perms = sorted(list(set(permutations(main_pool(factor_b_1, factor_b_2)))))
+    sub_b_perms = sorted(list(set(permutations((factor_b_1, factor_b_2)))))
+
+    all_patterns = []
+    for p_main_a in main_a_perms:
+        for p_sub_a in sub_a_perms:
+            for p_main_b in main_b_perms:
+                for p_sub_b in sub_b_perms:
+                    for main_a, main_b in ((p_main_a, p_main_b), (p_main_b, p_main_a)):
+                        all_patterns.append({"factors": {
+                            "grandparent_a": {"aaa": main_a[0], "aba": main_a[1], "aab": p_sub_a[0], "abb": p_sub_a[1],
+                                              "aa": factor_a_1, "ab": factor_a_2},
+                            "grandparent_b": {"baa": main_b[0], "bba": main_b[1], "bab": p_sub_b[0], "bbb": p_sub_b[1],
+                                              "ba": factor_b_1, "bb": factor_b_2},
+                        }})
+
+    unique_patterns = []
+    seen_factors_str = set()
+    for pattern in all_patterns:
+        factors_str = json.dumps(pattern['factors'], sort_keys=True)
+        if factors_str not in seen_factors_str:
+            pattern["name"] = f"{len(unique_patterns) + 1}"
+            unique_patterns.append(pattern)
+            seen_factors_str.add(factors_str)
+    return unique_patterns
+
+
+class FactorPatternTest(TestCase):
+    """メモ化した因子パターン生成が、メモ化前の実装と同じ結果を返すことを検証するテスト"""
+
+    @classmethod
+    def setUpTestData(cls):
+        call_command('load_data', stdout=StringIO())
+
+    def test_same_patterns_as_legacy_implementation(self):
+        """適性の異なるウマ娘の組み合わせ・全ての馬場と脚質で、パターンが一致すること"""
+        # 補強する因子 (ダート・E適性・D適性・補強なし) ごとに代表のウマ娘を選ぶ
+        representatives = {}
+        for umamusume in Umamusume.objects.order_by('umamusume_id'):
+            representatives.setdefault(calculate_aptitude_factors(umamusume, '芝', '差し'), umamusume)
+        umamusumes = list(representatives.values())[:6] + [None]
+        self.assertGreater(len(umamusumes), 2)
+
+        for grandparent in umamusumes:
+            for grandmother in umamusumes:
+                for surface in ('芝', 'ダート'):
+                    for style in ('逃げ', '先行', '差し', '追込'):
+                        with self.subTest(grandparent=grandparent, grandmother=grandmother, surface=surface, style=style):
+                            patterns = build_factor_patterns(
+                                get_aptitude_profile(grandparent), get_aptitude_profile(grandmother), surface, style)
+                            self.assertEqual(list(patterns), _legacy_factor_patterns(grandparent, grandmother, surface, style))
+
+
+class FactorBatchTest(TestCase):
+    """一括因子計算APIの結果と入力チェックを検証するテスト"""
+
+    @classmethod
+    def setUpTestData(cls):
+        call_command('load_data', stdout=StringIO())
+
+    def setUp(self):
+        token_bucket.clear()
+        self.client = APIClient()
+
+    def _post(self, lineages):
+        return self.client.post('/api/factor/calculate-batch', {'lineages': lineages}, format='json')
+
+    def test_same_patterns_as_single_api(self):
+        """各血統候補の結果が、リクエストと同じ順序で単体APIと一致すること"""
+        lineages = [
+            {'grandparent_umamusume_id': 2, 'grandmother_umamusume_id': 3, 'surface_id': 1, 'style_id': 1},
+            {'grandparent_umamusume_id': 5, 'grandmother_umamusume_id': 8, 'surface_id': 2, 'style_id': 3},
+            {},
+        ]
+        response = self._post(lineages)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.data['data']), len(lineages))
+        for result in response.data['data']:
+            single = self.client.get('/api/factor/calculate', {
+                key: result[key] for key in ('parent_umamusume_id', 'grandparent_umamusume_id', 'grandmother_umamusume_id',
+                                             'distance_id', 'surface_id', 'style_id')
+            })
+            self.assertEqual(result['patterns'], single.data['data']['patterns'])
+
+    def test_invalid_item_returns_index(self):
+        """整数でない項目・オブジェクトでない要素は、その位置を付けて400を返すこと"""
+        for lineages, index in (
+            ([{}, {'surface_id': 'abc'}], 1),
+            ([{'style_id': None}], 0),
+            ([{}, {}, 'not-a-dict'], 2),
+        ):
+            with self.subTest(lineages=lineages):
+                response = self._post(lineages)
+                self.assertEqual(response.status_code, 400)
+                self.assertEqual(response.data['index'], index)
+
+    def test_batch_size_limit(self):
+        """上限件数までは受け付け、超えた場合と空の場合は400を返すこと"""
+        self.assertEqual(self._post([{}] * FACTOR_BATCH_MAX_SIZE).status_code, 200)
+        self.assertEqual(self._post([{}] * (FACTOR_BATCH_MAX_SIZE + 1)).status_code, 400)
+        self.assertEqual(self._post([]).status_code, 400)
+
+
+class LineageSearchTest(TestCase):
+    """血統検索のベクトル化した因子計算と、検索APIの入力チェックを検証するテスト"""
+
+    @classmethod
+    def setUpTestData(cls):
+        call_command('load_data', stdout=StringIO())
+        cls.user = UserPersonal.objects.create_user('lineage_user', 'password')
+        now = timezone.now()
+        umamusume_ids = list(Umamusume.objects.order_by('umamusume_id').values_list('umamusume_id', flat=True))
+        cls.target_umamusume_id = umamusume_ids[0]
+        RegistUmamusume.objects.bulk_create([
+            RegistUmamusume(user=cls.user, umamusume_id=umamusume_id, regist_date=now, fans=0)
+            for umamusume_id in umamusume_ids[:20]
+        ])
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {issue_tokens(self.user).access_token}')
+
+    def _search(self, **data):
+        return self.client.post('/api/factor/lineage-search', {
+            'umamusumeId': self.target_umamusume_id, 'distanceId': 3, 'surfaceId': 1, 'styleId': 3, **data,
+        }, format='json')
+
+    def test_vectorized_factors_match_scalar(self):
+        """全ウマ娘・全ての馬場と脚質で、一括計算の因子が calculate_aptitude_factors と一致すること"""
+        umamusumes = list(Umamusume.objects.order_by('umamusume_id'))
+        aptitudes = build_aptitude_matrix(umamusumes)
+        for surface in FACTOR_SURFACE_MAP.values():
+            for style in FACTOR_STYLE_MAP.values():
+                factor_one, factor_two = vectorized_aptitude_factors(
+                    aptitudes, FACTOR_CATEGORIES.index(surface), FACTOR_CATEGORIES.index(style))
+                for row, umamusume in enumerate(umamusumes):
+                    with self.subTest(umamusume=umamusume.umamusume_id, surface=surface, style=style):
+                        self.assertEqual(
+                            (FACTOR_CATEGORIES[factor_one[row]], FACTOR_CATEGORIES[factor_two[row]]),
+                            calculate_aptitude_factors(umamusume, surface, style))
+
+    def test_limit_is_clamped(self):
+        """取得件数は上限で切り詰められ、1未満は400を返すこと"""
+        response = self._search(limit=LINEAGE_SEARCH_MAX_LIMIT + 100)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.data['data']), LINEAGE_SEARCH_MAX_LIMIT)
+        self.assertEqual(len(self._search(limit=3).data['data']), 3)
+        self.assertEqual(self._search(limit=0).status_code, 400)
+
+    def test_non_integer_inputs(self):
+        """数値でない検索条件は500ではなく400を返すこと"""
+        for data in ({'limit': 'ten'}, {'distanceId': 'abc'}, {'styleId': None}, {'umamusumeId': 'abc'}):
+            with self.subTest(data=data):
+                self.assertEqual(self._search(**data).status_code, 400)
+
+
+class JsonLogTest(SimpleTestCase):
+    """JSON Lines形式のログ出力と、キュー経由の書き込みを検証するテスト"""
+
+    def _error_record(self):
+        try:
+            raise ValueError('json log failure')
+        except ValueError:
+            record = logging.getLogger('uma_api.test').makeRecord(
+                'uma_api.test', logging.ERROR, __file__, 0, '失敗しました', (), sys.exc_info())
+        return record
+
+    def test_format_event_record(self):
+        """logwrite のレコードは event・attribute・request を持つ1行のJSONになること"""
+        record = logging.getLogger('uma_api.test').makeRecord(
+            'uma_api.test', logging.INFO, __file__, 0, '%sの処理を開始します。%s', ('race_list', ''), None,
+            extra={'event': 'start', 'attribute': 'race_list', 'request_info': {'method': 'GET'}})
+        line = JsonLineFormatter().format(record)
+        self.assertNotIn('\n', line)
+        payload = json.loads(line)
+        self.assertEqual(payload['level'], 'INFO')
+        self.assertEqual(payload['event'], 'start')
+        self.assertEqual(payload['attribute'], 'race_list')
+        self.assertEqual(payload['request'], {'method': 'GET'})
+        self.assertNotIn('exception', payload)
+
+    def test_format_exception(self):
+        """exc_info を持つレコードも、文字列化済みの exc_text のみのレコードもトレースバックを出力すること"""
+        record = self._error_record()
+        self.assertIn('json log failure', json.loads(JsonLineFormatter().format(record))['exception'])
+
+        record = self._error_record()
+        record.exc_text = logging.Formatter().formatException(record.exc_info)
+        record.exc_info = None
+        self.assertIn('json log failure', json.loads(JsonLineFormatter().format(record))['exception'])
+
+    def test_queue_mode_keeps_traceback(self):
+        """キュー経由で書き込んだ例外ログにもトレースバックが残ること"""
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, 'uma_api.log')
+            handler = QueueListenerHandler(filename)
+            test_logger = logging.getLogger('uma_api.test.queue')
+            test_logger.addHandler(handler)
+            try:
+                try:
+                    raise ValueError('queued failure')
+                except ValueError:
+                    test_logger.exception('キュー経由のエラー')
+            finally:
+                test_logger.removeHandler(handler)
+                handler.close()
+            with open(filename, encoding='utf-8') as f:
+                payloads = [json.loads(line) for line in f]
+
+        self.assertEqual(len(payloads), 1)
+        self.assertEqual(payloads[0]['message'], 'キュー経由のエラー')
+        self.assertIn('Traceback', payloads[0]['exception'])
+        self.assertIn('queued failure', payloads[0]['exception'])
+
+
+    @override_settings(UMA_LOG_MODE='queue', UMA_LOG_PRINT=True)
+    def test_queue_mode_formats_on_listener_thread(self):
+        """queueモードでは、リクエスト情報の整形とコンソール出力をリクエストのスレッドで行わないこと"""
+        request = RequestFactory().get('/api/race/list', {'fields': 'race_name'})
+        request.data = {'umamusumeId': 1, 'password': 'secret-value'}
+        format_threads = []
+        to_dict = RequestInfo.to_dict
+
+        def record_thread(info):
+            format_threads.append(threading.current_thread())
+            return to_dict(info)
+
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, 'uma_api.log')
+            console = StringIO()
+            with mock.patch('sys.stdout', console):
+                handler = QueueListenerHandler(filename, console=True)
+            test_logger = logging.getLogger('uma_api.test.request_info')
+            test_logger.setLevel(logging.INFO)
+            # 上位の uma_api ロガー (テスト設定では同期のハンドラ) には渡さない
+            test_logger.propagate = False
+            test_logger.addHandler(handler)
+            with mock.patch('uma_api.utils.logger', test_logger), \
+                    mock.patch.object(RequestInfo, 'to_dict', record_thread), \
+                    mock.patch('builtins.print') as print_mock:
+                try:
+                    UmamusumeLog(request).logwrite('start', 'raceList')
+                    print_mock.assert_not_called()
+                finally:
+                    # 残りのログを書き出してから閉じる
+                    test_logger.removeHandler(handler)
+                    handler.close()
+            with open(filename, encoding='utf-8') as f:
+                payloads = [json.loads(line) for line in f]
+
+        self.assertTrue(format_threads)
+        self.assertNotIn(threading.current_thread(), format_threads)
+        self.assertEqual(payloads[0]['request'], {
+            'method': 'GET', 'data': {'umamusumeId': 1}, 'params': {'fields': ['race_name']}, 'ip': '127.0.0.1'})
+        self.assertIn('[INFO] raceListの処理を開始します。 | method:GET', console.getvalue())
+        self.assertNotIn('secret-value', console.getvalue())
+
+    def test_print_defaults_off_in_queue_mode(self):
+        """UMA_LOG_PRINT の既定値は、syncモードでは出力し、queueモードでは出力しないこと"""
+        environ = {key: val for key, val in os.environ.items() if key not in ('UMA_LOG_PRINT', 'UMA_LOG_MODE')}
+        try:
+            for mode, expected in (('sync', True), ('queue', False)):
+                with self.subTest(mode=mode), mock.patch.dict(os.environ, {**environ, 'UMA_LOG_MODE': mode}, clear=True):
+                    reloaded = importlib.reload(project_settings)
+                    self.assertIs(reloaded.UMA_LOG_PRINT, expected)
+                    if mode == 'queue':
+                        self.assertIs(reloaded.LOGGING['handlers']['file']['console'], False)
+        finally:
+            importlib.reload(project_settings)
+
+class MetricsViewTest(TestCase):
+    """/metrics の出力形式とアクセス制限を検証するテスト"""
+
+    def test_exposition_format(self):
+        """Prometheusテキスト形式で、リクエストのメトリクスが出力されること"""
+        self.client.get('/api/live/list')
+        response = self.client.get('/metrics')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'text/plain; version=0.0.4; charset=utf-8')
+        output = response.content.decode()
+        self.assertTrue(output.endswith('\n'))
+        self.assertIn('# TYPE uma_api_requests_total counter', output)
+        self.assertIn('# TYPE uma_api_request_duration_seconds histogram', output)
+        self.assertIn('uma_api_requests_total{view="live_list",method="GET",status="200"}', output)
+
+        # ヒストグラムのバケットは累積値で、+Inf の件数と _count が一致すること
+        buckets = [int(line.rsplit(' ', 1)[1]) for line in output.splitlines()
+                   if line.startswith('uma_api_request_duration_seconds_bucket{view="live_list",method="GET",')]
+        self.assertEqual(len(buckets), len(LATENCY_BUCKETS) + 1)
+        self.assertEqual(buckets, sorted(buckets))
+        self.assertIn(f'uma_api_request_duration_seconds_count{{view="live_list",method="GET"}} {buckets[-1]}', output)
+
+    def test_label_values_are_escaped(self):
+        """ラベル値の引用符・バックスラッシュ・改行がエスケープされること"""
+        registry = MetricsRegistry()
+        registry.counter('uma_api_test_total', 'テスト', ('name',)).inc(name='a"b\\c\nd')
+        self.assertIn('uma_api_test_total{name="a\\"b\\\\c\\nd"} 1', registry.render())
+
+    def test_only_localhost_by_default(self):
+        """既定ではローカルホストのみ許可し、それ以外のIPは403を返すこと"""
+        self.assertEqual(self.client.get('/metrics').status_code, 200)
+        self.assertEqual(self.client.get('/metrics', REMOTE_ADDR='::1').status_code, 200)
+        self.assertEqual(self.client.get('/metrics', REMOTE_ADDR='10.0.0.5').status_code, 403)
+
+    def test_allowed_ips(self):
+        """UMA_METRICS_ALLOWED_IPS のIPのみ許可し、空の場合は全て拒否すること"""
+        with override_settings(UMA_METRICS_ALLOWED_IPS=['10.0.0.5']):
+            self.assertEqual(self.client.get('/metrics', REMOTE_ADDR='10.0.0.5').status_code, 200)
+            self.assertEqual(self.client.get('/metrics').status_code, 403)
+        with override_settings(UMA_METRICS_ALLOWED_IPS=[]):
+            self.assertEqual(self.client.get('/metrics').status_code, 403)
+
+
+class ProfileCaptureTest(TestCase):
+    """スタッフ向けプロファイル取得と、スナップショットからの再現を検証するテスト"""
+
+    @classmethod
+    def setUpTestData(cls):
+        call_command('load_data', stdout=StringIO())
+        cls.umamusume_id = Umamusume.objects.order_by('umamusume_id').values_list('umamusume_id', flat=True)[0]
+        cls.run_race_id = Race.objects.filter(race_rank=1).order_by('race_id').values_list('race_id', flat=True)[0]
+        now = timezone.now()
+        cls.staff = UserPersonal.objects.create_user('profile_staff', 'password', is_staff=True)
+        cls.user = UserPersonal.objects.create_user('profile_user', 'password')
+        for user in (cls.staff, cls.user):
+            RegistUmamusume.objects.create(user=user, umamusume_id=cls.umamusume_id, regist_date=now, fans=0)
+            RegistUmamusumeRace.objects.create(user=user, umamusume_id=cls.umamusume_id, race_id=cls.run_race_id, regist_date=now)
+
+    def setUp(self):
+        self.profile_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.profile_dir.cleanup)
+        override = override_settings(UMA_PROFILE_DIR=self.profile_dir.name)
+        override.enable()
+        self.addCleanup(override.disable)
+
+    def _post_pattern(self, user, **headers):
+        client = APIClient()
+        client.force_authenticate(user)
+        return client.post('/api/race/pattern', {'umamusumeId': self.umamusume_id, 'count': 1}, format='json', **headers)
+
+    def test_profile_saved_only_for_staff_with_header(self):
+        """ヘッダーを付与したスタッフのリクエストのみプロファイルが保存されること"""
+        self._post_pattern(self.user, HTTP_X_UMA_PROFILE='1')
+        self._post_pattern(self.staff)
+        self.assertEqual(os.listdir(self.profile_dir.name), [])
+
+        response = self._post_pattern(self.staff, HTTP_X_UMA_PROFILE='1')
+        self.assertEqual(response.status_code, 200)
+        profile_id = response['X-Uma-Profile-Id']
+        self.assertEqual(sorted(os.listdir(self.profile_dir.name)), [f'{profile_id}.json', f'{profile_id}.prof'])
+
+    def test_profile_records_queries(self):
+        """保存したプロファイルに、実行したSQLが接続先のDBとともに記録されること"""
+        response = self._post_pattern(self.staff, HTTP_X_UMA_PROFILE='1')
+        with open(os.path.join(self.profile_dir.name, f"{response['X-Uma-Profile-Id']}.json"), encoding='utf-8') as f:
+            queries = json.load(f)['queries']
+        self.assertTrue(queries)
+        self.assertEqual({query['alias'] for query in queries}, {'default'})
+        # パラメータを埋め込んだSQLを記録する
+        self.assertTrue(any(str(self.staff.user_id) in query['sql'] for query in queries))
+
+    def test_replay_reproduces_captured_result(self):
+        """保存したスナップショットから同じ結果を再現できること"""
+        response = self._post_pattern(self.staff, HTTP_X_UMA_PROFILE='1')
+        stdout = StringIO()
+        call_command('replay_race_pattern', response['X-Uma-Profile-Id'], stdout=stdout)
+        self.assertIn('取得時と同じ結果を再現しました', stdout.getvalue())
+
+
+class RacePatternTraceTest(TestCase):
+    """レースパターン生成の処理内訳トレースを検証するテスト"""
+
+    @classmethod
+    def setUpTestData(cls):
+        call_command('load_data', stdout=StringIO())
+        cls.umamusume_id = Umamusume.objects.order_by('umamusume_id').values_list('umamusume_id', flat=True)[0]
+        now = timezone.now()
+        cls.staff = UserPersonal.objects.create_user('trace_staff', 'password', is_staff=True)
+        cls.user = UserPersonal.objects.create_user('trace_user', 'password')
+        for user in (cls.staff, cls.user):
+            RegistUmamusume.objects.create(user=user, umamusume_id=cls.umamusume_id, regist_date=now, fans=0)
+
+    def _post_pattern(self, user, **data):
+        client = APIClient()
+        client.force_authenticate(user)
+        return client.post('/api/race/pattern', {'umamusumeId': self.umamusume_id, 'count': 1, **data}, format='json')
+
+    def test_debug_trace_contains_phases(self):
+        """スタッフがdebugを指定すると、各フェーズと戦略ごとの内訳が返ること"""
+        passes_before = phase_loop_passes.snapshot(trace='get_race_pattern', phase='3.6.fill_slots')[0]
+        response = self._post_pattern(self.staff, debug=True)
+        self.assertEqual(response.status_code, 200)
+
+        trace = response.data['debug']['trace']
+        top_level = [span['name'] for span in trace['children']]
+        self.assertEqual(top_level[:2], ['1.load', '2.prepare'])
+        iterations = [span for span in trace['children'] if span['name'] == '3.iteration']
+        self.assertGreaterEqual(len(iterations), len(response.data['data']['patterns']) - 1)
+        phases = [span['name'] for span in iterations[0]['children']]
+        self.assertEqual(phases, [
+            '3.0.filter', '3.1.preferred_conditions', '3.2.base_pattern', '3.3.larc', '3.4.scenario',
+            '3.5.main_conditions', '3.6.fill_slots', '3.7.main_conditions', '3.8.factors',
+        ])
+        fill_slots = iterations[0]['children'][6]['attributes']
+        self.assertGreaterEqual(fill_slots['passes'], 1)
+        self.assertIn('candidates', fill_slots)
+
+        passes_after = phase_loop_passes.snapshot(trace='get_race_pattern', phase='3.6.fill_slots')[0]
+        self.assertEqual(passes_after - passes_before, len(iterations))
+
+    def test_debug_trace_hidden_for_non_staff(self):
+        """DEBUG=True (リポジトリの設定) でも、スタッフ以外にはdebugを返さないこと"""
+        # テストランナーは DEBUG=False で実行するため、config/settings.py の値に戻して検証する
+        self.assertTrue(project_settings.DEBUG)
+        with override_settings(DEBUG=project_settings.DEBUG):
+            response = self._post_pattern(self.user, debug=True)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('debug', response.data)
+
+
+class SlowQueryLogTest(TestCase):
+    """低速SQLログの正規化・集計・API別の記録を検証するテスト"""
+
+    @classmethod
+    def setUpTestData(cls):
+        call_command('load_data', stdout=StringIO())
+        cls.staff = UserPersonal.objects.create_user('slow_staff', 'password', is_staff=True)
+        cls.user = UserPersonal.objects.create_user('slow_user', 'password')
+
+    def setUp(self):
+        # レースリストはキャッシュされるため、毎回DBを参照するよう空にしておく
+        cache.clear()
+        SLOW_QUERIES.clear()
+        self.addCleanup(SLOW_QUERIES.clear)
+
+    def test_fingerprint_collapses_literals_and_in_lists(self):
+        """リテラルとIN句のリストが件数によらず同じフィンガープリントになること"""
+        short = fingerprint_sql('SELECT * FROM "race" WHERE NOT ("race_id" IN (%s, %s)) AND "race_rank" = 1')
+        long = fingerprint_sql('SELECT *  FROM "race" WHERE NOT ("race_id" IN (%s, %s, %s, %s))\n AND "race_rank" = 3')
+        self.assertEqual(short, long)
+        self.assertEqual(short, 'SELECT * FROM "race" WHERE NOT ("race_id" IN (...)) AND "race_rank" = ?')
+        self.assertEqual(fingerprint_sql("SELECT 1 WHERE name = 'it''s'"), 'SELECT ? WHERE name = ?')
+
+    @override_settings(UMA_SLOW_QUERY_MS=0)
+    def test_slow_queries_attributed_to_view(self):
+        """閾値を超えたSQLが呼び出し元のAPI名・ユーザーIDとともに集計されること"""
+        client = APIClient()
+        client.force_authenticate(self.user)
+        # 同じ条件はキャッシュから返すため、フィンガープリントが同じになる別の条件で呼び出す
+        for state in (0, 1):
+            client.post('/api/race/list', {'state': state, 'distance': -1}, format='json')
+
+        race_queries = [entry for entry in SLOW_QUERIES.top(100) if 'race_list' in entry['views']]
+        self.assertEqual(len(race_queries), 1)
+        self.assertEqual(race_queries[0]['count'], 2)
+        self.assertEqual(race_queries[0]['last_user_id'], self.user.user_id)
+        self.assertIn('CASE', race_queries[0]['fingerprint'])
+
+    @override_settings(UMA_SLOW_QUERY_MS=-1)
+    def test_disabled_with_negative_threshold(self):
+        """閾値が負の値の場合は記録しないこと"""
+        APIClient().post('/api/race/list', {'state': -1, 'distance': -1}, format='json')
+        self.assertEqual(SLOW_QUERIES.top(100), [])
+
+    def test_list_requires_staff(self):
+        """集計結果のAPIはスタッフのみ参照できること"""
+        client = APIClient()
+        client.force_authenticate(self.user)
+        self.assertEqual(client.get('/api/monitor/slow-queries').status_code, 403)
+        client.force_authenticate(self.staff)
+        response = client.get('/api/monitor/slow-queries')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('threshold_ms', response.data)
+
+
+class IndexUsageTest(TestCase):
+    """ホットパスのクエリがインデックスを使用することを実行計画で検証するテスト"""
+
+    def _explain(self, queryset):
+        """クエリセットの実行計画を取得する
+        PostgreSQLは件数の少ないテーブルでは順次走査を選ぶため、順次走査を無効にして使用可能なインデックスを確認する。
+        * @param queryset クエリセット
+        * @return str 実行計画
+        """
+        if connection.vendor != 'postgresql':
+            return queryset.explain()
+        with connection.cursor() as cursor:
+            cursor.execute('SET enable_seqscan = off')
+            try:
+                return queryset.explain()
+            finally:
+                cursor.execute('RESET enable_seqscan')
+
+    def _index_name(self, model, columns):
+        """指定したカラム構成のインデックス名を取得する (unique_together で作成されたものを含む)"""
+        with connection.cursor() as cursor:
+            constraints = connection.introspection.get_constraints(cursor, model._meta.db_table)
+        for name, constraint in constraints.items():
+            if constraint['index'] and constraint['columns'] == columns:
+                return name
+        self.fail(f'{model._meta.db_table}に{columns}のインデックスがありません')
+
+    def test_run_races_use_unique_index(self):
+        """出走済みレースの取得が (user, umamusume, race) のインデックスだけで完結すること"""
+        index_name = self._index_name(RegistUmamusumeRace, ['user_id', 'umamusume_id', 'race_id'])
+        querysets = [
+            RegistUmamusumeRace.objects.filter(user_id=1, umamusume_id=1).values_list('race_id', flat=True),
+            RegistUmamusumeRace.objects.filter(user_id=1, umamusume_id__in=[1, 2]).values('umamusume_id', 'race_id'),
+        ]
+        for queryset in querysets:
+            plan = self._explain(queryset)
+            self.assertIn(index_name, plan)
+            self.assertRegex(plan, '(?i)covering index|index only scan')
+
+    def test_jewel_list_uses_unique_index(self):
+        """月別のジュエル取得が (user, year, month, day) のインデックスを使用すること"""
+        index_name = self._index_name(Jewel, ['user_id', 'year', 'month', 'day'])
+        plan = self._explain(Jewel.objects.filter(user_id=1, year=2024, month=1).order_by('day'))
+        self.assertIn(index_name, plan)
+
+    @unittest.skipUnless(connection.vendor == 'postgresql', 'SQLiteはパラメータ化したIN句で部分インデックスを使用しないため')
+    def test_remaining_race_uses_partial_index(self):
+        """時期指定の残レース検索がG1〜G3の部分インデックスを使用すること"""
+        remaining_races = Race.objects.exclude(race_id__in=[1, 2]).filter(race_rank__in=[1, 2, 3])
+        querysets = [
+            remaining_races.filter(half_flag=1, race_months=5, classic_flag=1),
+            remaining_races.filter(race_months__lt=5, classic_flag=1),
+        ]
+        for queryset in querysets:
+            self.assertIn('race_g_timing_idx', self._explain(queryset))
+
+
+def _has_replica():
+    """プライマリと別のDBをレプリカとして設定しているか (テストミラーは除く)"""
+    replica = settings.DATABASES.get('replica')
+    return replica is not None and not replica.get('TEST', {}).get('MIRROR')
+
+
+# レプリカを設定している場合は、振り分けを検証するテストでレプリカへのクエリも許可する
+ROUTED_DATABASES = {'default', 'replica'} if _has_replica() else {'default'}
+
+
+class ReplicaRouterTest(TestCase):
+    """レプリカへの振り分けと、書き込み後のプライマリ固定を検証するテスト"""
+    databases = ROUTED_DATABASES
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.writer = UserPersonal.objects.create_user('router_writer', 'password')
+        cls.reader = UserPersonal.objects.create_user('router_reader', 'password')
+
+    def setUp(self):
+        cache.clear()
+
+    def _client(self, user):
+        client = APIClient()
+        client.credentials(HTTP_AUTHORIZATION=f'Bearer {issue_tokens(user).access_token}')
+        return client
+
+    def test_outside_request_uses_primary(self):
+        """リクエストの外では読み込み・書き込みともプライマリを使用すること"""
+        router = ReplicaRouter()
+        self.assertIsNone(router.db_for_read(Race))
+        self.assertEqual(router.db_for_write(Race), 'default')
+
+    def test_write_pins_user_to_primary(self):
+        """書き込みを行ったユーザーのみプライマリに固定されること"""
+        self.assertEqual(self._client(self.writer).post('/api/jewel/regist', {'jewel': 500}, format='json').status_code, 201)
+        now = timezone.now()
+        self.assertEqual(self._client(self.reader).post(
+            '/api/jewel/list', {'year': now.year, 'month': now.month}, format='json').status_code, 200)
+        self.assertTrue(is_pinned(self.writer.user_id))
+        self.assertFalse(is_pinned(self.reader.user_id))
+
+    def test_replica_requires_shared_cache(self):
+        """レプリカを使用する場合、プライマリへの固定を共有できないプロセス内のキャッシュでは起動しないこと"""
+        with mock.patch('uma_api.routers.get_replica_alias', return_value='replica'):
+            with override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}):
+                with self.assertRaises(ImproperlyConfigured):
+                    DatabaseRoutingMiddleware(lambda request: None)
+            with tempfile.TemporaryDirectory() as directory, override_settings(CACHES={'default': {
+                    'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache', 'LOCATION': directory}}):
+                DatabaseRoutingMiddleware(lambda request: None)
+
+
+@unittest.skipUnless(_has_replica(), 'レプリカ (DATABASES["replica"]) が設定されていないため')
+class ReplicaRoutingTest(TestCase):
+    """プライマリとレプリカを別のDBにして、実際の振り分け先を検証するテスト
+    ローカルではSQLiteのDBを2つ用意し、DATABASES に default と replica を設定して実行する。
+    """
+    databases = ROUTED_DATABASES
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = UserPersonal.objects.create_user('replica_user', 'password')
+
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {issue_tokens(self.user).access_token}')
+
+    def test_read_only_view_reads_replica(self):
+        """参照のみのAPIはレプリカから読み込むこと"""
+        Race.objects.using('replica').create(
+            race_name='レプリカ記念', race_state=0, distance=2, race_months=5, half_flag=0,
+            race_rank=1, junior_flag=0, classic_flag=1, senior_flag=0,
+        )
+        response = self.client.post('/api/race/list', {'state': -1, 'distance': -1}, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([race['race_name'] for race in response.data['data']], ['レプリカ記念'])
+
+    def test_reads_after_write_use_primary(self):
+        """書き込み直後の読み込みはプライマリから行い、固定が切れるとレプリカに戻ること"""
+        self.assertEqual(self.client.post('/api/jewel/regist', {'jewel': 500}, format='json').status_code, 201)
+        self.assertEqual(Jewel.objects.using('replica').count(), 0)
+
+        now = timezone.now()
+        params = {'year': now.year, 'month': now.month}
+        response = self.client.post('/api/jewel/list', params, format='json')
+        self.assertEqual(len(response.data['data']), 1)
+
+        cache.clear()
+        response = self.client.post('/api/jewel/list', params, format='json')
+        self.assertEqual(response.data['data'], [])
+
+
+class ShardHashTest(SimpleTestCase):
+    """ユーザーIDからシャードを決めるハッシュを検証するテスト"""
+
+    def test_assignment_is_deterministic_and_spread(self):
+        """同じユーザーは常に同じシャードに割り当てられ、全シャードに分散すること"""
+        shards = ['shard0', 'shard1', 'shard2']
+        assignments = [shard_for_user(user_id, shards) for user_id in range(1, 301)]
+        self.assertEqual(assignments, [shard_for_user(user_id, shards) for user_id in range(1, 301)])
+        for alias in shards:
+            self.assertGreater(assignments.count(alias), 60)
+
+    def test_adding_shard_moves_only_to_new_shard(self):
+        """シャードを追加しても、移動するのは追加したシャードに割り当たるユーザーのみであること"""
+        before = ['shard0', 'shard1', 'shard2']
+        after = before + ['shard3']
+        for user_id in range(1, 301):
+            moved_to = shard_for_user(user_id, after)
+            if moved_to != shard_for_user(user_id, before):
+                self.assertEqual(moved_to, 'shard3')
+
+
+# シャードを設定している場合は、シャードを含む全DBへのクエリを許可する
+SHARDED_DATABASES = set(settings.DATABASES) if len(settings.UMA_SHARDS) > 1 else {'default'}
+
+
+@unittest.skipUnless(len(settings.UMA_SHARDS) > 1, 'シャード (UMA_SHARDS) が複数設定されていないため')
+class ShardRoutingTest(TestCase):
+    """ユーザー別データのシャードへの振り分けを、実際に複数のDBを使って検証するテスト
+    ローカルではSQLiteのDBを複数用意し、DATABASES と UMA_SHARDS に設定して実行する。
+    """
+    databases = SHARDED_DATABASES
+
+    @classmethod
+    def setUpTestData(cls):
+        call_command('load_data', stdout=StringIO())
+        call_command('rebalance_shards', stdout=StringIO())
+        cls.umamusume_id = Umamusume.objects.order_by('umamusume_id').values_list('umamusume_id', flat=True)[0]
+        cls.race_ids = list(Race.objects.filter(race_rank=1).order_by('race_id').values_list('race_id', flat=True)[:3])
+
+        # 別々のシャードに割り当たるユーザーを2人用意する
+        cls.users = {}
+        index = 0
+        while len(cls.users) < 2:
+            index += 1
+            user = UserPersonal.objects.create_user(f'shard_user_{index}', 'password')
+            cls.users.setdefault(shard_for_user(user.user_id), user)
+
+    def setUp(self):
+        cache.clear()
+
+    def _client(self, user):
+        client = APIClient()
+        client.credentials(HTTP_AUTHORIZATION=f'Bearer {issue_tokens(user).access_token}')
+        return client
+
+    def test_user_replicated_to_home_shard(self):
+        """ユーザーの行が割り当てられたシャードに複製されること"""
+        for alias, user in self.users.items():
+            self.assertTrue(UserPersonal.objects.using(alias).filter(pk=user.pk).exists())
+
+    def test_views_read_and_write_home_shard(self):
+        """既存のAPIがユーザーのシャードに書き込み、そこから読み込むこと"""
+        for alias, user in self.users.items():
+            other = next(shard for shard in self.users if shard != alias)
+            client = self._client(user)
+            response = client.post('/api/umamusume/regist', {
+                'umamusumeId': self.umamusume_id, 'raceIdArray': self.race_ids, 'fans': 0}, format='json')
+            self.assertLess(response.status_code, 300, response.data)
+
+            self.assertEqual(RegistUmamusumeRace.objects.using(alias).filter(user_id=user.pk).count(), len(self.race_ids))
+            self.assertFalse(RegistUmamusume.objects.using(other).filter(user_id=user.pk).exists())
+            self.assertFalse(RegistUmamusume.objects.using('default').filter(user_id=user.pk).exists())
+
+            self.assertEqual(len(client.get('/api/umamusume/user-regist').data['data']), 1)
+            self.assertEqual(len(client.get('/api/race/remaining').data['data']), 1)
+            response = client.post('/api/race/pattern', {'umamusumeId': self.umamusume_id, 'count': 1}, format='json')
+            self.assertEqual(response.status_code, 200)
+
+    def test_load_data_syncs_catalog_to_shards(self):
+        """load_data で追加したマスタが全シャードに複製されること"""
+        race = Race.objects.create(
+            race_name='シャード記念', race_state=0, distance=2, race_months=5, half_flag=0,
+            race_rank=1, junior_flag=0, classic_flag=1, senior_flag=0,
+        )
+        call_command('load_data', stdout=StringIO())
+        for alias in self.users:
+            self.assertEqual(Race.objects.using(alias).get(pk=race.pk).race_name, 'シャード記念')
+
+    def test_profiler_records_queries_on_every_alias(self):
+        """プロファイルには、シャードへのクエリも接続先のDBとともに記録されること"""
+        profiler = RequestProfiler('test_profile')
+        counts = profiler.run(lambda: [RegistUmamusume.objects.using(alias).count() for alias in ('default', *self.users)])
+        self.assertEqual(len(counts), 1 + len(self.users))
+        self.assertEqual([query['alias'] for query in profiler.queries], ['default', *self.users])
+
+    def test_rebalance_moves_misplaced_rows(self):
+        """割り当てと異なるDBにあるユーザー別データが、rebalance_shards で移動されること"""
+        alias, user = next(iter(self.users.items()))
+        wrong = next(shard for shard in self.users if shard != alias)
+        copy_user_to_shard(user, wrong)
+        now = timezone.now()
+        RegistUmamusume.objects.using(wrong).create(user=user, umamusume_id=self.umamusume_id, regist_date=now, fans=10)
+        Jewel.objects.using('default').create(user=user, year=2024, month=1, day=1, jewel_amount=100)
+
+        call_command('rebalance_shards', '--skip-catalog', stdout=StringIO())
+
+        self.assertEqual(RegistUmamusume.objects.using(alias).get(user_id=user.pk).fans, 10)
+        self.assertTrue(Jewel.objects.using(alias).filter(user_id=user.pk).exists())
+        self.assertFalse(RegistUmamusume.objects.using(wrong).filter(user_id=user.pk).exists())
+        self.assertFalse(Jewel.objects.using('default').filter(user_id=user.pk).exists())
+
+
+class ResponseCacheTest(TestCase):
+    """ユーザー別データのレスポンスキャッシュと、書き込みによる無効化を検証するテスト"""
+
+    @classmethod
+    def setUpTestData(cls):
+        call_command('load_data', stdout=StringIO())
+        cls.umamusume_ids = list(Umamusume.objects.order_by('umamusume_id').values_list('umamusume_id', flat=True)[:2])
+        cls.user = UserPersonal.objects.create_user('cache_user', 'password')
+        cls.other = UserPersonal.objects.create_user('cache_other', 'password')
+        now = timezone.now()
+        for user in (cls.user, cls.other):
+            RegistUmamusume.objects.create(user=user, umamusume_id=cls.umamusume_ids[0], regist_date=now, fans=0)
+
+    def setUp(self):
+        cache.clear()
+
+    def _client(self, user):
+        client = APIClient()
+        client.credentials(HTTP_AUTHORIZATION=f'Bearer {issue_tokens(user).access_token}')
+        return client
+
+    def test_repeat_load_skips_database(self):
+        """2回目以降はDBを参照せずにキャッシュから同じレスポンスを返すこと"""
+        client = self._client(self.user)
+        cases = [
+            ('get', '/api/race/remaining', None),
+            ('get', '/api/umamusume/user-regist', None),
+            ('get', '/api/umamusume/regist-list', None),
+            ('post', '/api/jewel/list', {'year': 2024, 'month': 1}),
+        ]
+        for method, path, data in cases:
+            with self.subTest(path=path):
+                call = getattr(client, method)
+                first = call(path, data, format='json')
+                self.assertEqual(first[CACHE_STATUS_HEADER], 'miss')
+                with CaptureQueriesContext(connections['default']) as queries:
+                    second = call(path, data, format='json')
+                self.assertEqual(second[CACHE_STATUS_HEADER], 'hit')
+                self.assertEqual(len(queries), 0)
+                self.assertEqual(second.json(), first.json())
+
+    def test_write_invalidates_only_writer(self):
+        """書き込んだユーザーのキャッシュのみ無効になること"""
+        client = self._client(self.user)
+        other_client = self._client(self.other)
+        self.assertEqual(len(client.get('/api/umamusume/user-regist').data['data']), 1)
+        other_client.get('/api/umamusume/user-regist')
+
+        response = client.post('/api/umamusume/regist', {
+            'umamusumeId': self.umamusume_ids[1], 'raceIdArray': [], 'fans': 0}, format='json')
+        self.assertLess(response.status_code, 300)
+
+        response = client.get('/api/umamusume/user-regist')
+        self.assertEqual(response[CACHE_STATUS_HEADER], 'miss')
+        self.assertEqual(len(response.data['data']), 2)
+        self.assertEqual(other_client.get('/api/umamusume/user-regist')[CACHE_STATUS_HEADER], 'hit')
+
+    def test_conditional_get_returns_not_modified(self):
+        """If-None-Match がETagと一致する場合は、DBを参照せずに304を返すこと"""
+        client = self._client(self.user)
+        for path in ('/api/race/remaining', '/api/umamusume/user-regist'):
+            with self.subTest(path=path):
+                etag = client.get(path)['ETag']
+                with CaptureQueriesContext(connections['default']) as queries:
+                    response = client.get(path, headers={'If-None-Match': etag})
+                self.assertEqual(response.status_code, 304)
+                self.assertEqual(response.content, b'')
+                self.assertEqual(len(queries), 0)
+                self.assertEqual(client.get(path, headers={'If-None-Match': f'W/{etag}'}).status_code, 304)
+
+    def test_etag_changes_after_write(self):
+        """書き込み後は古いETagでは304にならず、新しいETagを返すこと"""
+        client = self._client(self.user)
+        etag = client.get('/api/race/remaining')['ETag']
+        client.post('/api/umamusume/fan-up', {'umamusumeId': self.umamusume_ids[0], 'fans': 100}, format='json')
+        response = client.get('/api/race/remaining', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_version_never_repeats(self):
+        """バージョンは書き込みのたびに一意な値になり、破棄された後も以前の値に戻らないこと"""
+        versions = [get_data_version(self.user.user_id)]
+        versions += [bump_data_version(self.user.user_id) for _ in range(5)]
+        cache.delete(f'uma_api:data_version:{self.user.user_id}')
+        versions.append(get_data_version(self.user.user_id))
+        self.assertEqual(len(set(versions)), len(versions))
+
+    def test_old_etag_invalid_after_version_evicted(self):
+        """バージョンがキャッシュから破棄された場合は、古いETagでは304にならないこと"""
+        client = self._client(self.user)
+        etag = client.get('/api/race/remaining')['ETag']
+        cache.delete(f'uma_api:data_version:{self.user.user_id}')
+        response = client.get('/api/race/remaining', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+    @override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+    def test_bypassed_without_shared_cache(self):
+        """ワーカー間で共有されないキャッシュでは、キャッシュ・ETagを使わずに毎回DBから返すこと"""
+        client = self._client(self.user)
+        for _ in range(2):
+            response = client.get('/api/umamusume/user-regist')
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response[CACHE_STATUS_HEADER], 'bypass')
+            self.assertNotIn('ETag', response)
+        self.assertEqual(client.get('/api/umamusume/user-regist', headers={'If-None-Match': '*'}).status_code, 200)
+
+    def test_params_are_part_of_key(self):
+        """リクエストパラメータが異なる場合は別のキャッシュになること"""
+        client = self._client(self.user)
+        Jewel.objects.create(user=self.user, year=2024, month=2, day=1, jewel_amount=100)
+        self.assertEqual(client.post('/api/jewel/list', {'year': 2024, 'month': 1}, format='json').data['data'], [])
+        response = client.post('/api/jewel/list', {'year': 2024, 'month': 2}, format='json')
+        self.assertEqual(response[CACHE_STATUS_HEADER], 'miss')
+        self.assertEqual(len(response.data['data']), 1)
+
+
+class CatalogCacheTest(TestCase):
+    """warm_caches コマンドで作成したマスタのキャッシュ・既定レースパターンを検証するテスト"""
+
+    @classmethod
+    def setUpTestData(cls):
+        call_command('load_data', stdout=StringIO())
+        cls.umamusume_id = Umamusume.objects.order_by('umamusume_id').values_list('umamusume_id', flat=True).first()
+        cls.user = UserPersonal.objects.create_user('catalog_user', 'password')
+        RegistUmamusume.objects.create(user=cls.user, umamusume_id=cls.umamusume_id, regist_date=timezone.now(), fans=0)
+
+    def setUp(self):
+        cache.clear()
+        # テスト用のインメモリDBは子プロセスから参照できないため、同じプロセスで作成する
+        self.output = StringIO()
+        call_command('warm_caches', workers=1, stdout=self.output)
+
+    def _client(self):
+        client = APIClient()
+        client.credentials(HTTP_AUTHORIZATION=f'Bearer {issue_tokens(self.user).access_token}')
+        return client
+
+    def test_command_reports_each_part(self):
+        """作成した対象ごとに件数と処理時間を出力すること"""
+        output = self.output.getvalue()
+        # load_data で作成済みのため、作り直さない
+        self.assertIn('default_plans: 0件', output)
+        self.assertIn(f'default_patterns: {Umamusume.objects.count()}件', output)
+        self.assertIn(f'g_races: {Race.objects.filter(race_rank__in=[1, 2, 3]).count()}件', output)
+        self.assertIn('catalog_snapshots:', output)
+
+    def test_catalog_views_skip_database(self):
+        """作成後はマスタのAPIがDBを参照せずに同じデータを返すこと"""
+        client = APIClient()
+        cases = [
+            ('get', '/api/umamusume/list', None, UmamusumeSerializer(Umamusume.objects.order_by('umamusume_name'), many=True)),
+            ('get', '/api/live/list', None, LiveSerializer(Live.objects.all(), many=True)),
+            ('post', '/api/race/list', {'state': 0, 'distance': 2}, RaceSerializer(get_race_list_queryset(0, 2), many=True)),
+        ]
+        for method, path, data, serializer in cases:
+            with self.subTest(path=path):
+                with CaptureQueriesContext(connections['default']) as queries:
+                    response = getattr(client, method)(path, data, format='json')
+                self.assertEqual(len(queries), 0)
+                self.assertEqual(response.json()['data'], json.loads(json.dumps(serializer.data, default=str)))
+
+    def test_race_list_validates_filters(self):
+        """レース一覧の絞り込み条件は整数にそろえてキャッシュし、定義済みでない値には400を返すこと"""
+        client = APIClient()
+        expected = client.post('/api/race/list', {'state': -1, 'distance': 2}, format='json').json()['data']
+        self.assertEqual(len(expected), get_race_list_queryset(-1, 2).count())
+        for path in ('/api/race/list', '/api/async/race/list'):
+            with self.subTest(path=path):
+                response = client.post(path, {'state': '-1', 'distance': '2'}, format='json')
+                self.assertEqual(response.status_code, 200)
+                self.assertEqual(response.json()['data'], expected)
+                for data in ({'state': 5, 'distance': -1}, {'state': -1, 'distance': 'long'},
+                             {'state': [-1], 'distance': -1}, {'distance': -1}):
+                    self.assertEqual(client.post(path, data, format='json').status_code, 400, data)
+
+    def test_default_pattern_matches_generated(self):
+        """出走済みレースがない場合は、作成済みの既定レースパターンと同じ結果を返すこと"""
+        umamusume, _, scenario_races, _ = load_race_pattern_inputs_by_race_ids(self.umamusume_id)
+        expected = json.loads(json.dumps(
+            build_race_pattern_data(*load_race_pattern_inputs_by_race_ids(self.umamusume_id)), default=str))
+        self.assertEqual(get_default_race_pattern(umamusume, scenario_races), expected)
+        response = self._client().post(
+            '/api/race/pattern', {'umamusumeId': self.umamusume_id, 'count': 1}, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['data'], expected)
+
+    def test_refresh_ignores_plans_created_concurrently(self):
+        """別のプロセスが同時に作成した既定レースパターンがあっても、エラーにならずに作成済みのものを使うこと"""
+        plan = DefaultRacePlan.objects.get(umamusume_id=self.umamusume_id)
+        plan.delete()
+
+        def build_while_other_worker_inserts(umamusume_id):
+            result = build_default_race_plan(umamusume_id)
+            if not DefaultRacePlan.objects.filter(umamusume_id=umamusume_id).exists():
+                plan.pk = None
+                plan.save()
+            return result
+
+        with mock.patch('uma_api.catalog.build_default_race_plan', side_effect=build_while_other_worker_inserts):
+            refresh_default_race_plans(workers=1)
+        self.assertEqual(DefaultRacePlan.objects.filter(umamusume_id=self.umamusume_id).count(), 1)
+
+    def test_gunicorn_builds_plans_once_in_master(self):
+        """gunicornの起動時は、マスタで1回だけ warm_caches を実行し、ワーカーではプロセス内のデータのみ作成すること"""
+        with mock.patch.dict(os.environ, {'UMA_WARM_CACHES_ON_STARTUP': 'true'}):
+            config = runpy.run_path(os.path.join(project_settings.BASE_DIR, 'gunicorn.conf.py'))
+        with mock.patch('uma_api.catalog.warm_caches', return_value=[]) as warm, \
+                mock.patch.object(connections, 'close_all'):
+            config['on_starting'](mock.Mock())
+        warm.assert_called_once_with()
+
+        worker = mock.Mock()
+        with mock.patch('uma_api.catalog.refresh_default_race_plans') as refresh:
+            config['post_worker_init'](worker)
+        refresh.assert_not_called()
+        logged = [call.args[1] for call in worker.log.info.call_args_list]
+        self.assertEqual(logged, ['g_races', 'default_breeding_counts'])
+
+    def test_load_data_invalidates_catalog(self):
+        """load_data の実行後は作成済みのキャッシュを使わないこと"""
+        call_command('load_data', stdout=StringIO())
+        with CaptureQueriesContext(connections['default']) as queries:
+            APIClient().get('/api/umamusume/list')
+        self.assertGreater(len(queries), 0)
+
+    def test_catalog_not_cached_without_shared_cache(self):
+        """ワーカー間で共有されないキャッシュでは、マスタの変更が別プロセスのバージョン更新なしで直ちに反映されること"""
+        umamusume = Umamusume.objects.order_by('umamusume_id').first()
+        with override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}):
+            client = APIClient()
+            client.get('/api/umamusume/list')
+            get_g_races()
+            Umamusume.objects.filter(pk=umamusume.pk).update(umamusume_name='別プロセスで更新')
+            Race.objects.filter(race_rank=1).update(race_name='別プロセスで更新')
+
+            names = [row['umamusume_name'] for row in client.get('/api/umamusume/list').json()['data']]
+            self.assertIn('別プロセスで更新', names)
+            self.assertTrue(all(race.race_name == '別プロセスで更新' for race in get_g_races() if race.race_rank == 1))
+
+
+class DefaultRacePlanTest(TestCase):
+    """load_data で作成する DefaultRacePlan と、出走済みレースがないウマ娘への返却を検証するテスト"""
+
+    @classmethod
+    def setUpTestData(cls):
+        call_command('load_data', stdout=StringIO())
+        cls.umamusume = Umamusume.objects.order_by('umamusume_id').first()
+        cls.user = UserPersonal.objects.create_user('plan_user', 'password')
+        RegistUmamusume.objects.create(user=cls.user, umamusume=cls.umamusume, regist_date=timezone.now(), fans=0)
+
+    def setUp(self):
+        cache.clear()
+
+    def _client(self):
+        client = APIClient()
+        client.credentials(HTTP_AUTHORIZATION=f'Bearer {issue_tokens(self.user).access_token}')
+        return client
+
+    def test_load_data_builds_plan_for_every_umamusume(self):
+        """全ウマ娘の既定レースパターン・目安育成数が作成され、再実行しても作り直さないこと"""
+        self.assertEqual(DefaultRacePlan.objects.count(), Umamusume.objects.count())
+        self.assertEqual(refresh_default_race_plans(workers=1), (0, Umamusume.objects.count()))
+
+    def test_pattern_served_from_plan(self):
+        """出走済みレースがない場合は、パターンを生成せずに作成済みのものを返すこと"""
+        plan = DefaultRacePlan.objects.get(umamusume=self.umamusume)
+        with mock.patch('uma_api.racePattern.build_race_pattern_data') as build:
+            response = self._client().post(
+                '/api/race/pattern', {'umamusumeId': self.umamusume.umamusume_id, 'count': 1}, format='json')
+        build.assert_not_called()
+        self.assertEqual(response.json()['data'], plan.race_pattern)
+
+    def test_remaining_uses_plan_breeding_count(self):
+        """出走済みレースがない場合の目安育成数が、作成済みのものと一致すること"""
+        plan = DefaultRacePlan.objects.get(umamusume=self.umamusume)
+        with mock.patch('uma_api.race_views.getbreedingCountData') as calculate:
+            response = self._client().get('/api/race/remaining')
+        calculate.assert_not_called()
+        self.assertEqual(response.data['data'][0]['breedingCount'], plan.breeding_count)
+
+    def test_catalog_change_rebuilds_only_changed_umamusume(self):
+        """入力のマスタが変わったウマ娘のみ作り直し、古いハッシュのものを削除すること"""
+        Umamusume.objects.filter(pk=self.umamusume.pk).update(turf_aptitude='G')
+        self.assertEqual(refresh_default_race_plans(workers=1), (1, Umamusume.objects.count()))
+        umamusume = Umamusume.objects.get(pk=self.umamusume.pk)
+        scenario_races = list(ScenarioRace.objects.filter(umamusume=umamusume).select_related('race'))
+        self.assertEqual(
+            list(DefaultRacePlan.objects.filter(umamusume=umamusume).values_list('catalog_hash', flat=True)),
+            [default_plan_hash(umamusume, scenario_races)],
+        )
+
+
+class PatternJobTest(TestCase):
+    """レースパターン生成ジョブの登録・ワーカーでの実行・結果の取得を検証するテスト"""
+
+    @classmethod
+    def setUpTestData(cls):
+        call_command('load_data', stdout=StringIO())
+        cls.umamusume_id = Umamusume.objects.order_by('umamusume_id').values_list('umamusume_id', flat=True).first()
+        cls.user = UserPersonal.objects.create_user('job_user', 'password')
+        cls.other = UserPersonal.objects.create_user('job_other', 'password')
+        RegistUmamusume.objects.create(user=cls.user, umamusume_id=cls.umamusume_id, regist_date=timezone.now(), fans=0)
+
+    def _client(self, user):
+        client = APIClient()
+        client.credentials(HTTP_AUTHORIZATION=f'Bearer {issue_tokens(user).access_token}')
+        return client
+
+    def _submit(self):
+        response = self._client(self.user).post(
+            '/api/race/pattern-job', {'umamusumeId': self.umamusume_id, 'count': 1}, format='json')
+        self.assertEqual(response.status_code, 202)
+        return response.data['data']['jobId']
+
+    def test_submit_run_and_poll(self):
+        """登録したジョブがワーカーで実行され、同期APIと同じ結果を取得できること"""
+        client = self._client(self.user)
+        job_id = self._submit()
+        self.assertEqual(client.get(f'/api/race/pattern-job/{job_id}').data['data']['status'], 'pending')
+        # 実行前の同じ内容の登録は、同じジョブを返す
+        self.assertEqual(self._submit(), job_id)
+
+        call_command('run_pattern_jobs', once=True, stdout=StringIO())
+
+        data = client.get(f'/api/race/pattern-job/{job_id}').data['data']
+        self.assertEqual(data['status'], 'done')
+        expected = client.post('/api/race/pattern', {'umamusumeId': self.umamusume_id, 'count': 1}, format='json')
+        self.assertEqual(data['result'], expected.json()['data'])
+        compact = client.get(f'/api/race/pattern-job/{job_id}', {'responseFormat': 'compact'}).json()['data']
+        self.assertEqual(compact['result'], compact_race_pattern(expected.json()['data']))
+
+    def test_other_user_cannot_read_job(self):
+        """他のユーザーのジョブは取得できないこと"""
+        job_id = self._submit()
+        self.assertEqual(self._client(self.other).get(f'/api/race/pattern-job/{job_id}').status_code, 404)
+
+    def test_submit_requires_registered_umamusume(self):
+        """登録していないウマ娘のジョブは登録できないこと"""
+        response = self._client(self.other).post(
+            '/api/race/pattern-job', {'umamusumeId': self.umamusume_id, 'count': 1}, format='json')
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(PatternJob.objects.exists())
+
+    def test_status_returns_without_waiting(self):
+        """同期APIは完了を待たずにすぐ返し、未完了の場合のみ Retry-After を返すこと"""
+        client = self._client(self.user)
+        job_id = self._submit()
+        start = time.monotonic()
+        response = client.get(f'/api/race/pattern-job/{job_id}', {'wait': 60})
+        self.assertLess(time.monotonic() - start, 1)
+        self.assertEqual(response.data['data']['status'], 'pending')
+        self.assertEqual(response['Retry-After'], str(project_settings.UMA_PATTERN_JOB_RETRY_AFTER_SECONDS))
+
+        call_command('run_pattern_jobs', once=True, stdout=StringIO())
+        self.assertNotIn('Retry-After', client.get(f'/api/race/pattern-job/{job_id}'))
+
+    def test_async_status_ignores_wait_on_wsgi(self):
+        """WSGIで呼び出された非同期APIは、wait を指定してもスレッドを占有せずにすぐ返すこと"""
+        job_id = self._submit()
+        start = time.monotonic()
+        response = self._client(self.user).get(f'/api/async/race/pattern-job/{job_id}', {'wait': 60})
+        self.assertLess(time.monotonic() - start, 1)
+        self.assertEqual(response.json()['data']['status'], 'pending')
+        self.assertIn('Retry-After', response)
+
+    async def test_async_status_rejects_invalid_wait(self):
+        """wait が数値でない場合・nan や inf の場合は、待たずに400を返すこと"""
+        job = await sync_to_async(submit_pattern_job)(self.user.user_id, self.umamusume_id, 1)
+        token = await sync_to_async(issue_tokens)(self.user)
+        for wait in ('abc', 'nan', 'inf', '-inf'):
+            with self.subTest(wait=wait):
+                response = await self.async_client.get(
+                    f'/api/async/race/pattern-job/{job.job_id}', {'wait': wait},
+                    headers={'Authorization': f'Bearer {token.access_token}'})
+                self.assertEqual(response.status_code, 400)
+
+    @override_settings(UMA_PATTERN_JOB_MAX_WAIT_SECONDS=0.5)
+    async def test_async_long_poll_serves_other_requests(self):
+        """ASGIのロングポーリングは上限秒数まで待ち、待機中も他のリクエストを処理できること"""
+        job = await sync_to_async(submit_pattern_job)(self.user.user_id, self.umamusume_id, 1)
+        token = await sync_to_async(issue_tokens)(self.user)
+        headers = {'Authorization': f'Bearer {token.access_token}'}
+        finished = []
+
+        async def long_poll():
+            response = await self.async_client.get(
+                f'/api/async/race/pattern-job/{job.job_id}', {'wait': 60}, headers=headers)
+            finished.append('poll')
+            return response
+
+        async def other_request():
+            # ロングポーリングが待機を始めてから呼び出す
+            await asyncio.sleep(0.1)
+            response = await self.async_client.get('/api/async/live/list')
+            finished.append('other')
+            return response
+
+        start = time.monotonic()
+        poll_response, other_response = await asyncio.gather(long_poll(), other_request())
+        self.assertGreaterEqual(time.monotonic() - start, 0.5)
+        self.assertEqual(finished, ['other', 'poll'])
+        self.assertEqual(other_response.status_code, 200)
+        self.assertEqual(poll_response.json()['data']['status'], 'pending')
+        self.assertIn('Retry-After', poll_response)
+
+    async def test_async_long_poll_returns_when_done(self):
+        """ASGIのロングポーリングは、待機中にジョブが完了すると上限秒数を待たずに結果を返すこと"""
+        job = await sync_to_async(submit_pattern_job)(self.user.user_id, self.umamusume_id, 1)
+        token = await sync_to_async(issue_tokens)(self.user)
+
+        async def complete_job():
+            await asyncio.sleep(0.2)
+            await PatternJob.objects.filter(job_id=job.job_id).aupdate(status=PatternJob.STATUS_DONE, result=[])
+
+        start = time.monotonic()
+        response, _ = await asyncio.gather(
+            self.async_client.get(f'/api/async/race/pattern-job/{job.job_id}', {'wait': 30},
+                                  headers={'Authorization': f'Bearer {token.access_token}'}),
+            complete_job(),
+        )
+        self.assertLess(time.monotonic() - start, 5)
+        self.assertEqual(response.json()['data'], {'jobId': str(job.job_id), 'status': 'done', 'result': []})
+        self.assertNotIn('Retry-After', response)
+
+    def test_failed_job_hides_error_detail(self):
+        """生成に失敗したジョブは失敗の状態を返し、例外の内容はDBにのみ保存すること"""
+        job_id = self._submit()
+        with mock.patch('uma_api.pattern_jobs.get_race_pattern_data', side_effect=ValueError('boom')):
+            work('test-worker', once=True)
+        data = self._client(self.user).get(f'/api/race/pattern-job/{job_id}').data['data']
+        self.assertEqual(data['status'], 'failed')
+        self.assertNotIn('boom', data['error'])
+        self.assertEqual(PatternJob.objects.get(job_id=job_id).error, 'boom')
+
+    def test_stale_running_job_is_reclaimed(self):
+        """タイムアウトを過ぎた実行中のジョブは別のワーカーが再実行し、実行中のジョブは取得しないこと"""
+        job_id = self._submit()
+        self.assertEqual(str(claim_next_job('worker-1').job_id), job_id)
+        self.assertIsNone(claim_next_job('worker-2'))
+        with override_settings(UMA_PATTERN_JOB_TIMEOUT_SECONDS=0):
+            self.assertEqual(claim_next_job('worker-2').worker, 'worker-2')
+
+    def test_expired_job_is_purged(self):
+        """保持期間を過ぎたジョブは取得できず、削除されること"""
+        job_id = self._submit()
+        PatternJob.objects.filter(job_id=job_id).update(expire_date=timezone.now())
+        self.assertEqual(self._client(self.user).get(f'/api/race/pattern-job/{job_id}').status_code, 404)
+        self.assertEqual(purge_expired_jobs(), 1)
+
+
+class StatelessJWTAuthenticationTest(TestCase):
+    """ステートレスなJWT認証を検証するテスト"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = UserPersonal.objects.create_user('token_user', 'password', email='token@example.com')
+        cls.staff = UserPersonal.objects.create_user('token_staff', 'password', is_staff=True)
+
+    def _client(self, user):
+        client = APIClient()
+        client.credentials(HTTP_AUTHORIZATION=f'Bearer {issue_tokens(user).access_token}')
+        return client
+
+    def test_authenticates_without_user_lookup(self):
+        """認証時にユーザーをDBから取得しないこと"""
+        with CaptureQueriesContext(connections['default']) as queries:
+            response = self._client(self.user).post('/api/user/logout')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(queries), 0)
+
+    def test_staff_claim_grants_staff_endpoints(self):
+        """スタッフのクレームを持つトークンでスタッフ専用APIを利用できること"""
+        self.assertEqual(self._client(self.user).get('/api/monitor/slow-queries').status_code, 403)
+        self.assertEqual(self._client(self.staff).get('/api/monitor/slow-queries').status_code, 200)
+
+    def test_staff_claim_rechecked_against_db(self):
+        """スタッフ権限を外した・無効化したユーザーは、発行済みのトークンでもスタッフ専用機能を使えないこと"""
+        call_command('load_data', stdout=StringIO())
+        umamusume_id = Umamusume.objects.order_by('umamusume_id').values_list('umamusume_id', flat=True)[0]
+        RegistUmamusume.objects.create(user=self.staff, umamusume_id=umamusume_id, regist_date=timezone.now(), fans=0)
+
+        for field in ('is_staff', 'is_active'):
+            with self.subTest(field=field):
+                client = self._client(self.staff)
+                UserPersonal.objects.filter(pk=self.staff.pk).update(**{field: False})
+                try:
+                    self.assertEqual(client.get('/api/monitor/slow-queries').status_code, 403)
+                    response = client.post('/api/race/pattern', {'umamusumeId': umamusume_id, 'count': 1, 'debug': True},
+                                           format='json', HTTP_X_UMA_PROFILE='1')
+                    self.assertEqual(response.status_code, 200)
+                    self.assertNotIn('debug', response.data)
+                    self.assertNotIn(PROFILE_ID_HEADER, response)
+                finally:
+                    UserPersonal.objects.filter(pk=self.staff.pk).update(is_staff=True, is_active=True)
+
+    def test_user_data_loads_full_user(self):
+        """ユーザー情報APIはDBから取得したユーザーを返すこと"""
+        response = self._client(self.user).get('/api/user/data')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['data']['user_name'], 'token_user')
+        self.assertEqual(response.data['data']['email'], 'token@example.com')
+
+    def test_login_token_contains_user_claims(self):
+        """ログインで発行したトークンにユーザー名とスタッフ権限が含まれること"""
+        response = APIClient().post('/api/user/login', {'userName': 'token_staff', 'password': 'password'}, format='json')
+        token = AccessToken(response.data['token'])
+        self.assertEqual(token['user_id'], self.staff.user_id)
+        self.assertEqual(token['user_name'], 'token_staff')
+        self.assertTrue(token['is_staff'])
+
+
+class CompactRacePatternTest(TestCase):
+    """レースパターンのコンパクト形式を検証するテスト"""
+
+    @classmethod
+    def setUpTestData(cls):
+        call_command('load_data', stdout=StringIO())
+        cls.user = UserPersonal.objects.create_user('compact_user', 'password')
+        cls.umamusume_id = Umamusume.objects.order_by('umamusume_id').values_list('umamusume_id', flat=True).first()
+        RegistUmamusume.objects.create(user=cls.user, umamusume_id=cls.umamusume_id, regist_date=timezone.now(), fans=0)
+
+    def setUp(self):
+        cache.clear()
+        token_bucket.clear()
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {issue_tokens(self.user).access_token}')
+
+    def test_compact_matches_full_response(self):
+        """各パターンのレースIDがスロット位置に並び、レースID以外の項目は通常形式と同じであること"""
+        data = {'umamusumeId': self.umamusume_id, 'count': 0}
+        full = self.client.post('/api/race/pattern', data, format='json').json()['data']
+        compact = self.client.post('/api/race/pattern', {**data, 'responseFormat': 'compact'}, format='json').json()['data']
+
+        self.assertEqual(compact['format'], 'compact')
+        self.assertEqual(len(compact['patterns']), len({
+            tuple(race['race_id'] for grade in ('junior', 'classic', 'senior') for race in pattern[grade])
+            for pattern in full['patterns']
+        }))
+        for pattern in compact['patterns']:
+            self.assertEqual(len(pattern['races']), len(COMPACT_SLOTS))
+        first = full['patterns'][0]
+        slots = {(grade, race['month'], race['half']): race['race_id'] for grade in ('junior', 'classic', 'senior') for race in first[grade]}
+        self.assertEqual(compact['patterns'][0]['races'], [slots[slot] for slot in COMPACT_SLOTS])
+        self.assertEqual(compact['patterns'][0]['factors'], first['factors'])
+        self.assertNotIn('junior', compact['patterns'][0])
+
+    def test_deduplicates_without_mutating(self):
+        """レースIDが同じパターンは1つにまとめ、元のデータは変更しないこと"""
+        slots = {'junior': [], 'classic': [], 'senior': []}
+        for grade, month, half in COMPACT_SLOTS:
+            slots[grade].append({'race_name': '', 'race_id': None, 'month': month, 'half': half})
+        slots['classic'][0] = {'race_name': 'テスト', 'race_id': 10, 'month': 1, 'half': 0}
+        race_pattern = {'patterns': [
+            {'scenario': 'メイクラ', 'strategy': 'a', **slots},
+            {'scenario': 'メイクラ', 'strategy': 'b', **slots},
+        ]}
+        before = json.dumps(race_pattern, sort_keys=True)
+
+        compact = compact_race_pattern(race_pattern)
+        self.assertEqual(len(compact['patterns']), 1)
+        self.assertEqual(compact['patterns'][0]['strategy'], 'a')
+        self.assertEqual(compact['patterns'][0]['races'][12], 10)
+        self.assertEqual(json.dumps(race_pattern, sort_keys=True), before)
+
+
+class SparseFieldsetTest(TestCase):
+    """一覧APIの ?fields= (返すフィールド)・?expand= (入れ子の展開) を検証するテスト"""
+
+    @classmethod
+    def setUpTestData(cls):
+        call_command('load_data', stdout=StringIO())
+        cls.user = UserPersonal.objects.create_user('sparse_user', 'password')
+        now = timezone.now()
+        umamusume_ids = Umamusume.objects.order_by('umamusume_id').values_list('umamusume_id', flat=True)[:3]
+        race_id = Race.objects.filter(race_rank=1).order_by('race_id').values_list('race_id', flat=True).first()
+        for umamusume_id in umamusume_ids:
+            RegistUmamusume.objects.create(user=cls.user, umamusume_id=umamusume_id, regist_date=now, fans=0)
+        RegistUmamusumeRace.objects.create(user=cls.user, umamusume_id=umamusume_ids[0], race_id=race_id, regist_date=now)
+
+    def setUp(self):
+        cache.clear()
+        token_bucket.clear()
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {issue_tokens(self.user).access_token}')
+
+    def test_remaining_ids_and_counts_only(self):
+        """残レースをウマ娘IDと件数のみで取得でき、目安育成数は計算しないこと"""
+        full = self.client.get('/api/race/remaining').json()['data']
+        params = {'fields': 'umamusume,allCrownRace', 'expand': ''}
+        with mock.patch('uma_api.race_views.getbreedingCountData') as breeding_count:
+            for path in ('/api/race/remaining', '/api/async/race/remaining'):
+                with self.subTest(path=path):
+                    sparse = self.client.get(path, params).json()['data']
+                    self.assertEqual(sparse, [
+                        {'umamusume': row['umamusume']['umamusume_id'], 'allCrownRace': row['allCrownRace']} for row in full
+                    ])
+        breeding_count.assert_not_called()
+
+    def test_nested_umamusume_as_id(self):
+        """expand に含まない入れ子のウマ娘はIDのみを返し、fields で項目を絞り込めること"""
+        full = self.client.get('/api/umamusume/user-regist').json()['data']
+        sparse = self.client.get('/api/umamusume/user-regist', {'fields': 'umamusume,fans', 'expand': ''}).json()['data']
+        self.assertEqual(sparse, [{'umamusume': row['umamusume']['umamusume_id'], 'fans': row['fans']} for row in full])
+        # expand に指定した場合は展開する
+        expanded = self.client.get('/api/umamusume/user-regist', {'fields': 'umamusume', 'expand': 'umamusume'}).json()['data']
+        self.assertEqual(expanded, [{'umamusume': row['umamusume']} for row in full])
+
+    def test_cached_catalog_lists(self):
+        """キャッシュ済みのマスタ一覧にも適用され、キャッシュしたデータは変更しないこと"""
+        acters = self.client.get('/api/acter/list', {'fields': 'acter_name,umamusume', 'expand': ''}).json()['data']
+        self.assertTrue(acters)
+        self.assertEqual(set(acters[0]), {'acter_name', 'umamusume'})
+        self.assertIsInstance(acters[0]['umamusume'], int)
+        self.assertIsInstance(self.client.get('/api/acter/list').json()['data'][0]['umamusume'], dict)
+
+        for path in ('/api/umamusume/list', '/api/async/umamusume/list'):
+            with self.subTest(path=path):
+                data = self.client.get(path, {'fields': 'umamusume_id,umamusume_name'}).json()['data']
+                self.assertEqual(set(data[0]), {'umamusume_id', 'umamusume_name'})
+
+
+class MessagePackTest(TestCase):
+    """Accept・Content-Type による MessagePack の送受信を検証するテスト"""
+
+    MSGPACK = 'application/msgpack'
+
+    @classmethod
+    def setUpTestData(cls):
+        call_command('load_data', stdout=StringIO())
+        cls.user = UserPersonal.objects.create_user('msgpack_user', 'password')
+        cls.umamusume_id = Umamusume.objects.order_by('umamusume_id').values_list('umamusume_id', flat=True).first()
+        RegistUmamusume.objects.create(user=cls.user, umamusume_id=cls.umamusume_id, regist_date=timezone.now(), fans=0)
+
+    def setUp(self):
+        cache.clear()
+        token_bucket.clear()
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {issue_tokens(self.user).access_token}')
+
+    def _post_msgpack(self, path, data):
+        return self.client.generic('POST', path, msgpack.packb(data), content_type=self.MSGPACK, HTTP_ACCEPT=self.MSGPACK)
+
+    def test_same_content_as_json(self):
+        """同期・非同期APIとも、MessagePack でJSONと同じ内容を送受信できること"""
+        data = {'umamusumeId': self.umamusume_id, 'count': 0}
+        for path in ('/api/race/pattern', '/api/async/race/pattern'):
+            with self.subTest(path=path):
+                expected = self.client.post(path, data, format='json').json()
+                response = self._post_msgpack(path, data)
+                self.assertEqual(response.status_code, 200)
+                self.assertEqual(response['Content-Type'], self.MSGPACK)
+                self.assertEqual(msgpack.unpackb(response.content), expected)
+
+        for path in ('/api/race/remaining', '/api/async/race/remaining', '/api/acter/list'):
+            with self.subTest(path=path):
+                response = self.client.get(path, HTTP_ACCEPT=self.MSGPACK)
+                self.assertEqual(response['Content-Type'], self.MSGPACK)
+                self.assertEqual(msgpack.unpackb(response.content), self.client.get(path).json())
+
+    def test_etag_differs_by_format(self):
+        """キャッシュしたレスポンスのETagは形式ごとに異なること"""
+        json_response = self.client.get('/api/race/remaining')
+        msgpack_response = self.client.get('/api/race/remaining', HTTP_ACCEPT=self.MSGPACK)
+        self.assertNotEqual(json_response['ETag'], msgpack_response['ETag'])
+        self.assertIn('Accept', msgpack_response['Vary'])
+
+    def test_invalid_body(self):
+        """MessagePack の形式が正しくない場合は400を返すこと"""
+        for path in ('/api/race/pattern', '/api/async/race/pattern'):
+            with self.subTest(path=path):
+                response = self.client.generic('POST', path, b'\xc1', content_type=self.MSGPACK)
+                self.assertEqual(response.status_code, 400)
+
+
+class AsyncViewTest(TestCase):
+    """非同期APIが同期APIと同じ結果を返すことを検証するテスト"""
+
+    @classmethod
+    def setUpTestData(cls):
+        call_command('load_data', stdout=StringIO())
+        cls.user = UserPersonal.objects.create_user('async_user', 'password')
+        now = timezone.now()
+        umamusume_ids = Umamusume.objects.order_by('umamusume_id').values_list('umamusume_id', flat=True)[:3]
+        run_race_ids = Race.objects.filter(race_rank=1).order_by('race_id').values_list('race_id', flat=True)[:5]
+        for umamusume_id in umamusume_ids:
+            RegistUmamusume.objects.create(user=cls.user, umamusume_id=umamusume_id, regist_date=now, fans=0)
+            for race_id in run_race_ids:
+                RegistUmamusumeRace.objects.create(user=cls.user, umamusume_id=umamusume_id, race_id=race_id, regist_date=now)
+        cls.umamusume_id = umamusume_ids[0]
+
+    def setUp(self):
+        cache.clear()
+        # 他のテストと同じユーザーIDになる場合があるため、トークンバケットを空にする
+        token_bucket.clear()
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {issue_tokens(self.user).access_token}')
+
+    def _assert_same_response(self, method, sync_path, async_path, data=None):
+        call = getattr(self.client, method)
+        sync_response = call(sync_path, data, format='json') if method == 'post' else call(sync_path)
+        async_response = call(async_path, data, format='json') if method == 'post' else call(async_path)
+        self.assertEqual(sync_response.status_code, 200)
+        self.assertEqual(async_response.status_code, 200)
+        self.assertEqual(async_response.json(), sync_response.json())
+
+    def test_same_response_as_sync_views(self):
+        """各非同期APIが同期APIと同じレスポンスを返すこと"""
+        cases = [
+            ('post', 'race/list', {'state': 1, 'distance': -1}),
+            ('get', 'race/remaining', None),
+            ('post', 'race/pattern', {'umamusumeId': self.umamusume_id, 'count': 1}),
+            ('post', 'race/pattern', {'umamusumeId': self.umamusume_id, 'count': 1, 'responseFormat': 'compact'}),
+            ('get', 'umamusume/list', None),
+            ('get', 'live/list', None),
+        ]
+        for method, path, data in cases:
+            with self.subTest(path=path):
+                self._assert_same_response(method, f'/api/{path}', f'/api/async/{path}', data)
+
+    def test_requires_authentication(self):
+        """認証が必要なAPIはトークンがない場合・不正な場合に401を返すこと"""
+        self.assertEqual(APIClient().get('/api/async/race/remaining').status_code, 401)
+        client = APIClient()
+        client.credentials(HTTP_AUTHORIZATION='Bearer invalid')
+        self.assertEqual(client.get('/api/async/race/remaining').status_code, 401)
+        self.assertEqual(APIClient().get('/api/async/live/list').status_code, 200)
+
+    def test_rejects_other_methods(self):
+        """許可していないメソッドは405を返すこと"""
+        self.assertEqual(self.client.post('/api/async/race/remaining').status_code, 405)
+
+    def test_race_pattern_rejects_invalid_params(self):
+        """同期・非同期のレースパターンAPIは、整数でない・範囲外のウマ娘ID・カウントに400を返すこと"""
+        cases = [
+            {'count': [1]}, {'count': {'value': 1}}, {'count': 'abc'}, {'count': -1}, {'count': RACE_PATTERN_MAX_COUNT + 1},
+            {'umamusumeId': [self.umamusume_id]}, {'umamusumeId': None},
+        ]
+        for path in ('/api/race/pattern', '/api/async/race/pattern'):
+            for data in cases:
+                with self.subTest(path=path, data=data):
+                    # 受付制限 (バースト) に達しないよう、毎回トークンバケットを空にする
+                    token_bucket.clear()
+                    response = self.client.post(path, {'umamusumeId': self.umamusume_id, 'count': 1, **data}, format='json')
+                    self.assertEqual(response.status_code, 400)
+
+    def test_race_pattern_normalizes_flight_key(self):
+        """文字列と数値で指定した同じウマ娘ID・カウントは、同じキーで処理を共有すること"""
+        for path, method in (('/api/race/pattern', 'do'), ('/api/async/race/pattern', 'ado')):
+            with self.subTest(path=path), mock.patch.object(pattern_flight, method, return_value={}) as flight:
+                self.client.post(path, {'umamusumeId': self.umamusume_id, 'count': 1}, format='json')
+                self.client.post(path, {'umamusumeId': str(self.umamusume_id), 'count': '1'}, format='json')
+                keys = [call.args[0] for call in flight.call_args_list]
+                self.assertEqual(len(keys), 2)
+                self.assertEqual(keys[0], keys[1])
+                self.assertEqual(keys[0][1:3], (self.umamusume_id, 1))
+
+    async def test_asgi_request_records_metrics(self):
+        """ASGI経由 (非同期ミドルウェア) でも処理でき、メトリクスが記録されること"""
+        before = request_count.value(view='async_remaining', method='GET', status=200)
+        token = await sync_to_async(issue_tokens)(self.user)
+        response = await self.async_client.get('/api/async/race/remaining', headers={'Authorization': f'Bearer {token.access_token}'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.json()['data']), 3)
+        self.assertEqual(request_count.value(view='async_remaining', method='GET', status=200), before + 1)
+
+    async def test_asgi_sync_view_records_queries(self):
+        """ASGIで別スレッドの同期ビューが実行したクエリも、メトリクスと低速SQLに記録されること"""
+        await sync_to_async(cache.clear)()
+        count_before, queries_before = request_db_queries.snapshot(view='live_list', method='GET')
+        slow_before = slow_query_count.value(view='live_list')
+        with override_settings(UMA_SLOW_QUERY_MS=0):
+            response = await self.async_client.get('/api/live/list')
+        self.assertEqual(response.status_code, 200)
+
+        count_after, queries_after = request_db_queries.snapshot(view='live_list', method='GET')
+        self.assertEqual(count_after, count_before + 1)
+        self.assertGreater(queries_after, queries_before)
+        self.assertGreater(slow_query_count.value(view='live_list'), slow_before)
+
+
+class SingleFlightTest(SimpleTestCase):
+    """同じ入力の処理の共有と、同時実行数の制限を検証するテスト"""
+
+    def _run_concurrently(self, flight, keys, func):
+        """キーごとにスレッドから flight.do を呼び出し、戻り値のリストを返す"""
+        results = [None] * len(keys)
+        errors = []
+
+        def call(index, key):
+            try:
+                results[index] = flight.do(key, func, key)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=call, args=(index, key)) for index, key in enumerate(keys)]
+        for thread in threads:
+            thread.start()
+        return threads, results, errors
+
+    def _wait_for_shared(self, name, count):
+        """実行中の処理を待つ呼び出し元が count 件になるまで待つ"""
+        for _ in range(500):
+            if singleflight_calls.value(name=name, result='shared') >= count:
+                return
+            threading.Event().wait(0.01)
+        self.fail(f'{name}: 実行中の処理を待つ呼び出し元が{count}件になりませんでした')
+
+    def test_concurrent_calls_share_one_execution(self):
+        """同じキーの処理が実行中の場合は実行せずに、その結果を共有すること"""
+        flight = SingleFlight('test_share')
+        release = threading.Event()
+        calls = []
+
+        def compute(key):
+            calls.append(key)
+            release.wait(5)
+            return {'key': key}
+
+        threads, results, errors = self._run_concurrently(flight, ['a'] * 4, compute)
+        # 全スレッドが実行中の処理を待つまで完了させない
+        self._wait_for_shared('test_share', 3)
+        release.set()
+        for thread in threads:
+            thread.join(5)
+        self.assertEqual(errors, [])
+        self.assertEqual(calls, ['a'])
+        self.assertEqual(results, [{'key': 'a'}] * 4)
+        self.assertTrue(all(result is results[0] for result in results))
+
+        # 完了後の呼び出しは再度実行する
+        self.assertEqual(flight.do('a', compute, 'a'), {'key': 'a'})
+        self.assertEqual(len(calls), 2)
+
+    def test_error_is_raised_to_every_caller(self):
+        """実行中の処理が例外で終了した場合は、待っていた呼び出し元にも同じ例外を送出すること"""
+        flight = SingleFlight('test_error')
+        release = threading.Event()
+
+        def compute(key):
+            release.wait(5)
+            raise ValueError(key)
+
+        threads, _, errors = self._run_concurrently(flight, ['a'] * 3, compute)
+        self._wait_for_shared('test_error', 2)
+        release.set()
+        for thread in threads:
+            thread.join(5)
+        self.assertEqual([str(e) for e in errors], ['a'] * 3)
+
+    @override_settings(UMA_PATTERN_MAX_CONCURRENCY=1)
+    def test_concurrency_is_limited(self):
+        """キーが異なる処理も、同時実行数の上限を超えて実行しないこと"""
+        flight = SingleFlight('test_limit')
+        lock = threading.Lock()
+        running = []
+        peak = []
+
+        def compute(key):
+            with lock:
+                running.append(key)
+                peak.append(len(running))
+            threading.Event().wait(0.05)
+            with lock:
+                running.remove(key)
+            return key
+
+        threads, results, errors = self._run_concurrently(flight, ['a', 'b', None], compute)
+        for thread in threads:
+            thread.join(5)
+        self.assertEqual(errors, [])
+        self.assertEqual(results, ['a', 'b', None])
+        self.assertEqual(max(peak), 1)
+        self.assertEqual(singleflight_queued.value(name='test_limit'), 0)
+
+    def test_async_calls_share_one_execution(self):
+        """非同期版も、同じキーの処理が実行中の場合はその結果を共有すること"""
+        flight = SingleFlight('test_async')
+        calls = []
+
+        async def compute(key):
+            calls.append(key)
+            await asyncio.sleep(0.01)
+            return [key]
+
+        async def main():
+            return await asyncio.gather(
+                flight.ado('a', compute, 'a'), flight.ado('a', compute, 'a'), flight.ado('b', compute, 'b'))
+
+        self.assertEqual(asyncio.run(main()), [['a'], ['a'], ['b']])
+        self.assertEqual(calls, ['a', 'b'])
+
+
+class AdmissionControlTest(TestCase):
+    """CPU負荷の高いAPIの受付制限 (429・503) を検証するテスト"""
+
+    @classmethod
+    def setUpTestData(cls):
+        call_command('load_data', stdout=StringIO())
+        cls.user = UserPersonal.objects.create_user('admission_user', 'password')
+
+    def setUp(self):
+        cache.clear()
+        token_bucket.clear()
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {issue_tokens(self.user).access_token}')
+
+    @override_settings(UMA_ADMISSION_BURST=2, UMA_ADMISSION_RATE=0.01)
+    def test_rate_limited_after_burst(self):
+        """トークンを使い切ると Retry-After 付きの429を返し、他のユーザーは影響を受けないこと"""
+        before = admission_count.value(view='remaining', result='rate_limited')
+        # レスポンスキャッシュに当たらないよう、毎回異なるパラメータで呼び出す
+        statuses = [self.client.get('/api/race/remaining', {'n': n}).status_code for n in range(3)]
+        self.assertEqual(statuses, [200, 200, 429])
+
+        response = self.client.post('/api/race/pattern', {'umamusumeId': 1, 'count': 0}, format='json')
+        self.assertEqual(response.status_code, 429)
+        self.assertGreaterEqual(int(response['Retry-After']), 1)
+        self.assertEqual(admission_count.value(view='remaining', result='rate_limited'), before + 1)
+
+        other = UserPersonal.objects.create_user('admission_other', 'password')
+        client = APIClient()
+        client.credentials(HTTP_AUTHORIZATION=f'Bearer {issue_tokens(other).access_token}')
+        self.assertEqual(client.get('/api/race/remaining').status_code, 200)
+
+    @override_settings(UMA_ADMISSION_BURST=1, UMA_ADMISSION_RATE=0.01)
+    def test_anonymous_clients_behind_proxy(self):
+        """プロキシの段数を指定した場合、未認証のリクエストは X-Forwarded-For のクライアントIPごとに制限すること"""
+        client = APIClient(REMOTE_ADDR='10.0.0.1')
+        params = {'grandparent_umamusume_id': 2, 'grandmother_umamusume_id': 3}
+
+        def call(n, forwarded_for):
+            # レスポンスキャッシュに当たらないよう、毎回異なるパラメータで呼び出す
+            return client.get('/api/factor/calculate', {**params, 'n': n}, HTTP_X_FORWARDED_FOR=forwarded_for).status_code
+
+        with override_settings(UMA_TRUSTED_PROXY_COUNT=1):
+            self.assertEqual(call(0, '203.0.113.1'), 200)
+            self.assertEqual(call(1, '203.0.113.1'), 429)
+            # 左側の値はクライアントが偽装できるため、キーに使わない
+            self.assertEqual(call(2, '198.51.100.9, 203.0.113.1'), 429)
+            self.assertEqual(call(3, '203.0.113.2'), 200)
+
+        # 段数を指定しない場合は、接続元 (プロキシ) のアドレスごとに制限する
+        token_bucket.clear()
+        self.assertEqual(call(4, '203.0.113.1'), 200)
+        self.assertEqual(call(5, '203.0.113.2'), 429)
+
+    @override_settings(UMA_ADMISSION_BURST=1, UMA_ADMISSION_RATE=0.01)
+    def test_cached_response_is_not_limited(self):
+        """キャッシュ済みのレスポンスはトークンを消費しないこと"""
+        self.assertEqual(self.client.get('/api/race/remaining').status_code, 200)
+        response = self.client.get('/api/race/remaining')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response[CACHE_STATUS_HEADER], 'hit')
+
+    @override_settings(UMA_ADMISSION_MAX_CONCURRENCY=1, UMA_ADMISSION_QUEUE_SECONDS=0, UMA_ADMISSION_RETRY_AFTER=3)
+    def test_overloaded_when_no_slot(self):
+        """同時実行数の上限に達して空きを待てない場合は、同期・非同期APIとも Retry-After 付きの503を返すこと"""
+        semaphore, _ = limiter.acquire()
+        try:
+            for path in ('/api/race/remaining', '/api/async/race/remaining'):
+                with self.subTest(path=path):
+                    response = self.client.get(path)
+                    self.assertEqual(response.status_code, 503)
+                    self.assertEqual(response['Retry-After'], '3')
+        finally:
+            limiter.release(semaphore)
+        self.assertEqual(self.client.get('/api/async/race/remaining').status_code, 200)
+
+    @override_settings(UMA_ADMISSION_MAX_CONCURRENCY=1, UMA_ADMISSION_QUEUE_SECONDS=5)
+    def test_queued_until_slot_is_released(self):
+        """空きを待っている間に実行枠が返されれば、待った後に処理すること"""
+        before = admission_count.value(view='calculate_parent_factors_batch', result='queued')
+        semaphore, _ = limiter.acquire()
+        threading.Timer(0.1, limiter.release, (semaphore,)).start()
+        response = APIClient().post('/api/factor/calculate-batch', {'lineages': [{}]}, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(admission_count.value(view='calculate_parent_factors_batch', result='queued'), before + 1)
+
+
+class ConnectionPoolTest(SimpleTestCase):
+    """SQLiteの接続でコネクションプールの動作を検証するテスト"""
+
+    def setUp(self):
+        self.db_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.db_dir.cleanup)
+        self.db_path = os.path.join(self.db_dir.name, 'pool.sqlite3')
+        self.connect_count = 0
+
+    def _connect(self):
+        self.connect_count += 1
+        return sqlite3.connect(self.db_path, check_same_thread=False)
+
+    def _pool(self, **options):
+        pool = ConnectionPool(self._connect, name=f'test_{self._testMethodName}', **options)
+        self.addCleanup(pool.close)
+        return pool
+
+    def test_reuses_released_connection(self):
+        """返却した接続が再利用されること"""
+        pool = self._pool(max_size=2)
+        connection = pool.acquire()
+        self.assertEqual(pool.stats()['in_use'], 1)
+        pool.release(connection)
+        self.assertIs(pool.acquire(), connection)
+        self.assertEqual(self.connect_count, 1)
+
+    def test_times_out_when_saturated(self):
+        """最大接続数に達した場合、タイムアウトまで待って例外になること"""
+        pool = self._pool(max_size=2, timeout=0.05)
+        pool.acquire()
+        pool.acquire()
+        with self.assertRaises(PoolTimeout):
+            pool.acquire()
+        self.assertEqual(pool.stats(), {
+            'name': pool.name, 'size': 2, 'max_size': 2, 'in_use': 2, 'idle': 0, 'waiting': 0})
+
+    def test_waiter_receives_released_connection(self):
+        """接続待ちのスレッドが返却された接続を受け取れること"""
+        pool = self._pool(max_size=1, timeout=5)
+        connection = pool.acquire()
+        acquired = []
+        waiter = threading.Thread(target=lambda: acquired.append(pool.acquire()))
+        waiter.start()
+        pool.release(connection)
+        waiter.join(5)
+        self.assertEqual(acquired, [connection])
+
+    def test_health_check_replaces_broken_connection(self):
+        """ヘルスチェックに失敗した接続は破棄され、新しい接続が貸し出されること"""
+        pool = self._pool(max_size=1, check_interval=0)
+        connection = pool.acquire()
+        pool.release(connection)
+        connection.close()
+        replacement = pool.acquire()
+        self.assertIsNot(replacement, connection)
+        replacement.execute('SELECT 1')
+        self.assertEqual(pool.stats()['size'], 1)
+
+    def test_discards_expired_and_unresettable_connections(self):
+        """寿命を超えた接続・初期化に失敗した接続は返却時に破棄されること"""
+        pool = self._pool(max_lifetime=0)
+        pool.release(pool.acquire())
+        self.assertEqual(pool.stats()['size'], 0)
+
+        def fail_reset(connection):
+            raise sqlite3.OperationalError('reset failed')
+        pool = self._pool(reset=fail_reset)
+        pool.release(pool.acquire())
+        self.assertEqual(pool.stats()['size'], 0)
+
+    def test_stats_exposed_as_metrics(self):
+        """プールの利用状況が /metrics に出力されること"""
+        pool = self._pool(max_size=3)
+        pool.acquire()
+        output = REGISTRY.render()
+        self.assertIn(f'uma_api_db_pool_in_use{{pool="{pool.name}"}} 1', output)
+        self.assertIn(f'uma_api_db_pool_max_size{{pool="{pool.name}"}} 3', output)
+
+    def test_pool_factory_does_not_keep_wrapper(self):
+        """プールの新規接続は最初に接続したDatabaseWrapperを保持せず、接続パラメータのみで作成されること"""
+        settings_dict = {**connections['default'].settings_dict, 'ENGINE': 'uma_api.db.backends.postgresql_pool'}
+        wrapper = PoolDatabaseWrapper(settings_dict, 'pool_factory_test')
+        self.addCleanup(close_pools, 'pool_factory_test')
+        pool = wrapper.get_pool({'dbname': 'uma', 'host': 'db-primary'})
+        wrapper_ref = weakref.ref(wrapper)
+        del wrapper
+        gc.collect()
+        self.assertIsNone(wrapper_ref())
+
+        new_connection = mock.Mock()
+        with mock.patch.object(postgresql_base.Database, 'connect', return_value=new_connection) as connect, \
+                mock.patch('psycopg2.extras.register_default_jsonb'):
+            self.assertIs(pool.connect(), new_connection)
+        connect.assert_called_once_with(dbname='uma', host='db-primary')
+
+
+class ConnMaxAgeSettingTest(SimpleTestCase):
+    """DB_CONN_MAX_AGE の解釈を検証するテスト"""
+
+    def _conn_max_age(self, value):
+        environ = {key: val for key, val in os.environ.items() if key != 'DB_CONN_MAX_AGE'}
+        if value is not None:
+            environ['DB_CONN_MAX_AGE'] = value
+        with mock.patch.dict(os.environ, environ, clear=True):
+            return importlib.reload(project_settings).DATABASES['default']['CONN_MAX_AGE']
+
+    def tearDown(self):
+        importlib.reload(project_settings)
+
+    def test_values(self):
+        """未設定は0、数値は秒数、空文字と none は無期限 (None) になること"""
+        for value, expected in ((None, 0), ('60', 60), ('', None), ('none', None), ('None', None)):
+            with self.subTest(value=value):
+                self.assertEqual(self._conn_max_age(value), expected)
@@ -0,0 +1,134 @@
+import time
+from contextlib import contextmanager, nullcontext
+
+from .metrics import REGISTRY, LATENCY_BUCKETS
+
+# 候補レース数・ループ回数用のバケット境界
+CANDIDATE_COUNT_BUCKETS = (0, 5, 10, 20, 40, 80, 160)
+LOOP_PASS_BUCKETS = (1, 2, 3, 4, 6, 8, 12, 16)
+
+phase_duration = REGISTRY.histogram(
+    'uma_api_trace_phase_duration_seconds', 'トレース区間ごとの処理時間(秒)', LATENCY_BUCKETS, ('trace', 'phase'))
+phase_candidates = REGISTRY.histogram(
+    'uma_api_trace_phase_candidates', 'トレース区間ごとの候補数', CANDIDATE_COUNT_BUCKETS, ('trace', 'phase'))
+phase_loop_passes = REGISTRY.histogram(
+    'uma_api_trace_phase_loop_passes', 'トレース区間ごとのループ回数', LOOP_PASS_BUCKETS, ('trace', 'phase'))
+
+
+class Span:
+    """トレースの1区間
+    * @param name 区間名
+    * @param attributes 候補数などの付加情報
+    """
+    __slots__ = ('name', 'attributes', 'children', 'duration')
+
+    def __init__(self, name, attributes=None):
+        self.name = name
+        self.attributes = attributes or {}
+        self.children = []
+        self.duration = 0.0
+
+    def set(self, **attributes):
+        """付加情報を設定する"""
+        self.attributes.update(attributes)
+
+    def to_dict(self):
+        """レスポンスやログに出力できる辞書に変換する"""
+        data = {'name': self.name, 'duration_ms': round(self.duration * 1000, 3)}
+        if self.attributes:
+            data['attributes'] = self.attributes
+        if self.children:
+            data['children'] = [child.to_dict() for child in self.children]
+        return data
+
+
+class _NullSpan:
+    """トレースしない場合の区間 (何も記録しない)"""
+    __slots__ = ()
+
+    def set(self, **attributes):
+        pass
+
+
+_NULL_SPAN_CONTEXT = nullcontext(_NullSpan())
+
+
+class NullTracer:
+    """トレースしない場合に使用する何もしないトレーサー"""
+    def span(self, name, **attributes):
+        return _NULL_SPAN_CONTEXT
+
+
+NULL_TRACER = NullTracer()
+
+
+class Tracer:
+    """処理区間ごとの時間と付加情報を記録する軽量トレーサー
+    * @param name トレース名 (メトリクスのラベルに使用)
+    """
+    def __init__(self, name):
+        self.name = name
+        self.root = Span(name)
+        self._stack = [self.root]
+        self._start = time.perf_counter()
+
+    @contextmanager
+    def span(self, name, **attributes):
+        """区間を計測するコンテキストマネージャ (入れ子にできる)
+        * @param name 区間名
+        * @param attributes 付加情報
+        * @return Span 計測中の区間 (set で付加情報を追加できる)
+        """
+        span = Span(name, attributes)
+        self._stack[-1].children.append(span)
+        self._stack.append(span)
+        start = time.perf_counter()
+        try:
+            yield span
+        finally:
+            span.duration = time.perf_counter() - start
+            self._stack.pop()
+
+    def finish(self):
+        """トレースを終了し、全体の処理時間を確定する
+        * @return Span ルート区間
+        """
+        self.root.duration = time.perf_counter() - self._start
+        return self.root
+
+    def iter_spans(self):
+        """ルートを除く全区間を深さ優先で返す"""
+        stack = list(reversed(self.root.children))
+        while stack:
+            span = stack.pop()
+            yield span
+            stack.extend(reversed(span.children))
+
+    def summary(self):
+        """区間名ごとに処理時間を集計した文字列を返す (ログ出力用)
+        * @return str 例: "total=12.3ms | 3.6.fill_slots=4.1ms(x5)"
+        """
+        totals = {}
+        for span in self.iter_spans():
+            count, duration = totals.get(span.name, (0, 0.0))
+            totals[span.name] = (count + 1, duration + span.duration)
+        parts = [f'total={self.root.duration * 1000:.1f}ms']
+        parts.extend(
+            f'{name}={duration * 1000:.1f}ms' + (f'(x{count})' if count > 1 else '')
+            for name, (count, duration) in totals.items()
+        )
+        return ' | '.join(parts)
+
+    def record_metrics(self):
+        """各区間の処理時間・候補数・ループ回数をメトリクスに記録する"""
+        phase_duration.observe(self.root.duration, trace=self.name, phase='total')
+        for span in self.iter_spans():
+            phase_duration.observe(span.duration, trace=self.name, phase=span.name)
+            if 'candidates' in span.attributes:
+                phase_candidates.observe(span.attributes['candidates'], trace=self.name, phase=span.name)
+            if 'passes' in span.attributes:
+                phase_loop_passes.observe(span.attributes['passes'], trace=self.name, phase=span.name)
+
+    def to_dict(self):
+        """トレース全体を辞書に変換する"""
+        return self.root.to_dict()
@@ -1,5 +1,5 @@
 from django.urls import path
-from . import views, race_views
+from . import views, race_views, async_views, metrics, slowQuery
 
 urlpatterns = [
     # 声優関連
@@ -22,6 +22,8 @@ urlpatterns = [
     path('api/race/pattern', race_views.get_race_pattern, name='get_race_pattern'),
     path('api/race/register-pattern', views.register_race_pattern, name='register_race_pattern'),
     path('api/race/register-one', race_views.race_register_one, name='race_register_one'),
+    path('api/race/pattern-job', race_views.pattern_job_submit, name='pattern_job_submit'),
+    path('api/race/pattern-job/<uuid:job_id>', race_views.pattern_job_status, name='pattern_job_status'),
     
     # ウマ娘関連
     path('api/umamusume/regist-list', views.umamusume_regist_list, name='umamusume_regist_list'),
@@ -32,10 +34,24 @@ urlpatterns = [
 
     #　因子関連
     path('api/factor/calculate', views.calculate_parent_factors, name='calculate_parent_factors'),
+    path('api/factor/calculate-batch', views.calculate_parent_factors_batch, name='calculate_parent_factors_batch'),
+    path('api/factor/lineage-search', views.search_lineage, name='search_lineage'),
     
     # ユーザー関連
     path('api/user/register', views.user_register, name='user_register'),
     path('api/user/login', views.user_login, name='user_login'),
     path('api/user/logout', views.user_logout, name='user_logout'),
     path('api/user/data', views.get_user_data, name='get_user_data'),
+
+    # 非同期API (ASGIサーバーで使用)
+    path('api/async/race/list', async_views.race_list, name='async_race_list'),
+    path('api/async/race/remaining', async_views.remaining, name='async_remaining'),
+    path('api/async/race/pattern', async_views.get_race_pattern, name='async_get_race_pattern'),
+    path('api/async/race/pattern-job/<uuid:job_id>', async_views.pattern_job_status, name='async_pattern_job_status'),
+    path('api/async/umamusume/list', async_views.umamusume_list, name='async_umamusume_list'),
+    path('api/async/live/list', async_views.live_list, name='async_live_list'),
+
+    # 監視関連
+    path('metrics', metrics.metrics_view, name='metrics'),
+    path('api/monitor/slow-queries', slowQuery.slow_query_list, name='slow_query_list'),
 ]
\ No newline at end of file
@@ -1,7 +1,168 @@
+import json
 import logging
+import logging.handlers
+import queue
+import sys
+from datetime import datetime, timezone
+
+from django.conf import settings
 
 logger = logging.getLogger('uma_api')
 
+# ログ種別ごとのメッセージテンプレートとログレベル
+_LOG_MESSAGES = {
+    'start': ('%sの処理を開始します。%s', logging.INFO),
+    'end': ('%sの処理を終了します。%s', logging.INFO),
+    'error': ('%sに失敗しました。%s', logging.ERROR),
+    'trace': ('%sの処理内訳: %s', logging.DEBUG),
+}
+
+# リクエストデータから除外する機密情報のキー
+_SECRET_KEYS = ('password', 'token', 'secret')
+
+
+class RequestInfo:
+    """リクエスト情報を遅延して組み立てるクラス
+    リクエストのスレッドでは値の参照のみを保持し、辞書・文字列への整形はログを書き出すハンドラ
+    (queueモードではリスナースレッド) で行う。
+    * @param request HTTPリクエストオブジェクト
+    """
+    def __init__(self, request=None):
+        self.user = self.method = self.data = self.params = self.ip = None
+        self._info = None
+        if not request:
+            return
+        # ユーザー情報
+        if hasattr(request, 'user') and request.user:
+            self.user = getattr(request.user, 'user_name', 'Anonymous')
+        # HTTPメソッド
+        self.method = getattr(request, 'method', None)
+        # リクエストデータ・GETパラメータ (整形時に参照する)
+        self.data = getattr(request, 'data', None)
+        self.params = getattr(request, 'GET', None)
+        # IPアドレス
+        if hasattr(request, 'META'):
+            self.ip = request.META.get('REMOTE_ADDR', 'unknown')
+
+    def to_dict(self):
+        """リクエスト情報辞書を作成する (作成済みの場合はそれを返す)
+        * @return dict リクエスト情報辞書
+        """
+        if self._info is not None:
+            return self._info
+        info = {}
+        if self.user is not None:
+            info['user'] = self.user
+        if self.method is not None:
+            info['method'] = self.method
+        if self.data:
+            # パスワードなどの機密情報を除外
+            safe_data = {k: v for k, v in self.data.items() if k.lower() not in _SECRET_KEYS}
+            if safe_data:
+                info['data'] = safe_data
+        if self.params:
+            info['params'] = dict(self.params)
+        if self.ip is not None:
+            info['ip'] = self.ip
+        self._info = info
+        return info
+
+    def __str__(self):
+        """メッセージ末尾に付けるリクエスト情報の文字列"""
+        info = self.to_dict()
+        if not info:
+            return ""
+        return " | " + " | ".join(f"{key}:{value}" for key, value in info.items())
+
+
+class JsonLineFormatter(logging.Formatter):
+    """ログレコードを1行のJSONとして整形するフォーマッタ"""
+    def format(self, record):
+        """ログレコードを整形する
+        * @param record ログレコード
+        * @return str JSON文字列
+        """
+        payload = {
+            'time': datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            'level': record.levelname,
+            'logger': record.name,
+        }
+        event = getattr(record, 'event', None)
+        if event:
+            payload['event'] = event
+            payload['attribute'] = record.attribute
+            request_info = record.request_info
+            payload['request'] = request_info.to_dict() if isinstance(request_info, RequestInfo) else request_info
+            if event == 'trace':
+                payload['trace'] = record.trace
+            elif event == 'slow_query':
+                payload['query'] = record.query
+        else:
+            payload['message'] = record.getMessage()
+        if record.exc_info:
+            payload['exception'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            # QueueListenerHandler.prepare で文字列化済みのトレースバック
+            payload['exception'] = record.exc_text
+        return json.dumps(payload, ensure_ascii=False, default=str)
+
+
+class QueueListenerHandler(logging.handlers.QueueHandler):
+    """キューに積んだログをバックグラウンドスレッドでファイルへ書き込むハンドラ
+    書き込み先はサイズでローテーションし、JSON Lines形式で出力する。
+    * @param filename 出力ファイル名
+    * @param max_bytes ローテーションするファイルサイズ
+    * @param backup_count 保持する世代数
+    * @param queue_size キューの上限 (超過分は破棄してdroppedに計上)
+    * @param console Trueの場合はコンソールにも出力する (リクエストのスレッドでは出力しない)
+    """
+    def __init__(self, filename, max_bytes=10 * 1024 * 1024, backup_count=5, queue_size=10000, console=False):
+        super().__init__(queue.Queue(queue_size))
+        file_handler = logging.handlers.RotatingFileHandler(
+            filename, maxBytes=max_bytes, backupCount=backup_count, encoding='utf-8', delay=True
+        )
+        file_handler.setFormatter(JsonLineFormatter())
+        handlers = [file_handler]
+        if console:
+            console_handler = logging.StreamHandler(sys.stdout)
+            console_handler.setFormatter(logging.Formatter('[%(levelname)s] %(message)s'))
+            handlers.append(console_handler)
+        self.dropped = 0
+        self.listener = logging.handlers.QueueListener(self.queue, *handlers, respect_handler_level=True)
+        self.listener.start()
+        self._stopped = False
+
+    def prepare(self, record):
+        """同一プロセス内のキューのため、メッセージの整形はリスナースレッドに任せる
+        * @param record ログレコード
+        * @return LogRecord ログレコード
+        """
+        if record.exc_info and not record.exc_text:
+            # トレースバックはフレームを保持するため、呼び出し元で文字列化しておく
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        """キューが満杯の場合はリクエスト処理を止めずにログを破棄する
+        * @param record ログレコード
+        * @return None
+        """
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def close(self):
+        """リスナースレッドを停止し、残りのログを書き出してから閉じる
+        logging.shutdown からも呼ばれるため、複数回呼ばれても安全にする。
+        * @return None
+        """
+        if not self._stopped:
+            self._stopped = True
+            self.listener.stop()
+        super().close()
+
 
 class UmamusumeLog:
     """ウマ娘アプリ用ログクラス
@@ -28,87 +189,69 @@ class UmamusumeLog:
         else:
             raise ValueError("msgの値に問題があります。")
     
-    def _get_request_info(self):
-        """リクエスト情報を取得する
-        * @return str リクエスト情報文字列
+    @staticmethod
+    def _print_enabled():
+        """リクエストのスレッドでコンソールに出力するか (queueモードではリスナースレッドが出力する)
+        * @return bool 出力する場合はTrue
         """
-        if not self.request:
-            return ""
-        
-        info_parts = []
-        
-        # ユーザー情報
-        if hasattr(self.request, 'user') and self.request.user:
-            user_name = getattr(self.request.user, 'user_name', 'Anonymous')
-            info_parts.append(f"user:{user_name}")
-        
-        # HTTPメソッド
-        if hasattr(self.request, 'method'):
-            info_parts.append(f"method:{self.request.method}")
-        
-        # リクエストデータ
-        if hasattr(self.request, 'data') and self.request.data:
-            # パスワードなどの機密情報を除外
-            safe_data = {k: v for k, v in self.request.data.items() 
-                        if k.lower() not in ['password', 'token', 'secret']}
-            if safe_data:
-                info_parts.append(f"data:{safe_data}")
+        return getattr(settings, 'UMA_LOG_PRINT', True) and getattr(settings, 'UMA_LOG_MODE', 'sync') != 'queue'
+
+    def _write(self, msg: str, attribute: str):
+        """ログ出力の共通処理
+        ログレベルが無効かつコンソール出力もしない場合は、リクエスト情報を組み立てない。
+        リクエスト情報の整形はハンドラ側で行うため、queueモードではリクエストのスレッドで整形しない。
+        * @param msg メッセージタイプ ('start', 'end', 'error')
+        * @param attribute 処理名
+        * @return None
+        """
+        template, level = _LOG_MESSAGES[msg]
+        print_enabled = self._print_enabled()
+        if not logger.isEnabledFor(level) and not print_enabled:
+            return
         
-        # GETパラメータ
-        if hasattr(self.request, 'GET') and self.request.GET:
-            info_parts.append(f"params:{dict(self.request.GET)}")
+        request_info = RequestInfo(self.request)
         
-        # IPアドレス
-        if hasattr(self.request, 'META'):
-            ip = self.request.META.get('REMOTE_ADDR', 'unknown')
-            info_parts.append(f"ip:{ip}")
-        
-        return " | ".join(info_parts)
+        # ログファイルに出力 (整形はハンドラ側で行われる)
+        logger.log(level, template, attribute, request_info,
+                   extra={'event': msg, 'attribute': attribute, 'request_info': request_info})
+        # コンソールにも出力
+        if print_enabled:
+            print(f"[{logging.getLevelName(level)}] {template % (attribute, request_info)}")
     
     def log_start(self, attribute: str):
         """処理開始ログ出力
         * @param attribute 処理名
         * @return None
         """
-        request_info = self._get_request_info()
-        if request_info:
-            message = f'{attribute}の処理を開始します。 | {request_info}'
-        else:
-            message = f'{attribute}の処理を開始します。'
-        
-        # ログファイルに出力
-        logger.info(message)
-        # コンソールにも出力
-        print(f"[INFO] {message}")
+        self._write('start', attribute)
     
     def log_end(self, attribute: str):
         """処理終了ログ出力
         * @param attribute 処理名
         * @return None
         """
-        request_info = self._get_request_info()
-        if request_info:
-            message = f'{attribute}の処理を終了します。 | {request_info}'
-        else:
-            message = f'{attribute}の処理を終了します。'
-        
-        # ログファイルに出力
-        logger.info(message)
-        # コンソールにも出力
-        print(f"[INFO] {message}")
+        self._write('end', attribute)
+    
+    def log_trace(self, attribute: str, tracer):
+        """処理内訳(トレース)ログ出力
+        DEBUGレベルのため、UMA_LOG_LEVEL=DEBUG の場合のみ出力する。
+        * @param attribute 処理名
+        * @param tracer 終了済みのトレーサー
+        * @return None
+        """
+        template, level = _LOG_MESSAGES['trace']
+        if not logger.isEnabledFor(level):
+            return
+        summary = tracer.summary()
+        logger.log(level, template, attribute, summary,
+                   extra={'event': 'trace', 'attribute': attribute,
+                          'request_info': RequestInfo(self.request), 'trace': tracer.to_dict()})
+        if self._print_enabled():
+            print(f"[{logging.getLevelName(level)}] {template % (attribute, summary)}")
     
     def log_error(self, attribute: str):
         """エラーログ出力
         * @param attribute 処理名
         * @return None
         """
-        request_info = self._get_request_info()
-        if request_info:
-            message = f'{attribute}に失敗しました。 | {request_info}'
-        else:
-            message = f'{attribute}に失敗しました。'
-        
-        # ログファイルに出力
-        logger.error(message)
-        # コンソールにも出力
-        print(f"[ERROR] {message}")
\ No newline at end of file
+        self._write('error', attribute)
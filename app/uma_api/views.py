@@ -1,8 +1,7 @@
 from rest_framework import status
-from rest_framework.decorators import api_view, permission_classes
+from rest_framework.decorators import api_view, authentication_classes, permission_classes
 from rest_framework.permissions import IsAuthenticated, AllowAny
 from rest_framework.response import Response
-from rest_framework_simplejwt.tokens import RefreshToken
 from django.contrib.auth import authenticate
 from django.utils import timezone
 from django.db.models import Q, Count
@@ -10,9 +9,15 @@ from user_agents import parse
 from .models import *
 from .serializers import *
 from .utils import UmamusumeLog
-from itertools import permutations
-import json
-from .calculations import calculate_aptitude_factors
+from .authentication import DatabaseJWTAuthentication, issue_tokens
+from .response_cache import bumps_data_version, cache_user_response
+from .catalog import get_catalog_snapshot
+from .admission import admission_control
+from .calculations import (
+    FACTOR_DISTANCE_MAP, FACTOR_SURFACE_MAP, FACTOR_STYLE_MAP,
+    build_factor_patterns, get_aptitude_profile,
+)
+from .lineageSearch import search_best_lineages
 
 
 @api_view(['GET'])
@@ -20,16 +25,17 @@ from .calculations import calculate_aptitude_factors
 def acter_list(request):
     """声優のリストをデータベースから取得するAPI
     * @param request HTTPリクエストオブジェクト
+    * @param request.query_params.fields 返すフィールド (カンマ区切り、省略時はすべて)
+    * @param request.query_params.expand 展開する入れ子のフィールド (カンマ区切り、指定しないものはIDのみ。省略時はすべて展開)
     * @return Response 声優リストデータ
     """
     logger = UmamusumeLog(request)
     logger.logwrite('start', 'acterList')
     
     try:
-        acters = UmamusumeActer.objects.select_related('umamusume').order_by('-birthday')
-        serializer = UmamusumeActerSerializer(acters, many=True)
-        logger.logwrite('end', f'acterList - 取得件数:{len(serializer.data)}')
-        return Response({'data': serializer.data})
+        data = sparse_rows(get_catalog_snapshot('acter_list'), *parse_sparse_fieldset(request.query_params))
+        logger.logwrite('end', f'acterList - 取得件数:{len(data)}')
+        return Response({'data': data})
     except Exception as e:
         logger.logwrite('error', f'acterList:{e}')
         return Response({'error': '声優リスト取得エラー'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
@@ -37,12 +43,14 @@ def acter_list(request):
 
 @api_view(['POST'])
 @permission_classes([IsAuthenticated])
+@cache_user_response
 def jewel_list(request):
     """ジュエルのリストをデータベースから取得するAPI
     * @param request HTTPリクエストオブジェクト
     * @param request.user.user_id ユーザーID
     * @param request.data.year 年
     * @param request.data.month 月
+    * @param request.query_params.fields 返すフィールド (カンマ区切り、省略時はすべて)
     * @return Response ジュエルリストデータ
     """
     logger = UmamusumeLog(request)
@@ -59,7 +67,8 @@ def jewel_list(request):
             month=month
         ).order_by('day')
         
-        serializer = JewelSerializer(jewels, many=True)
+        fields, _ = parse_sparse_fieldset(request.query_params)
+        serializer = JewelSerializer(jewels, many=True, fields=fields)
         logger.logwrite('end', f'jewelList - 取得件数:{len(serializer.data)} ({year}/{month})')
         return Response({'data': serializer.data})
     except Exception as e:
@@ -69,6 +78,7 @@ def jewel_list(request):
 
 @api_view(['POST'])
 @permission_classes([IsAuthenticated])
+@bumps_data_version
 def jewel_regist(request):
     """当日のジュエルを登録するAPI
     * @param request HTTPリクエストオブジェクト
@@ -104,16 +114,16 @@ def jewel_regist(request):
 def live_list(request):
     """ライブのリストをデータベースから取得するAPI
     * @param request HTTPリクエストオブジェクト
+    * @param request.query_params.fields 返すフィールド (カンマ区切り、省略時はすべて)
     * @return Response ライブリストデータ
     """
     logger = UmamusumeLog(request)
     logger.logwrite('start', 'liveList')
     
     try:
-        lives = Live.objects.all()
-        serializer = LiveSerializer(lives, many=True)
-        logger.logwrite('end', f'liveList - 取得件数:{len(serializer.data)}')
-        return Response({'data': serializer.data})
+        data = sparse_rows(get_catalog_snapshot('live_list'), *parse_sparse_fieldset(request.query_params))
+        logger.logwrite('end', f'liveList - 取得件数:{len(data)}')
+        return Response({'data': data})
     except Exception as e:
         logger.logwrite('error', f'liveList:{e}')
         return Response({'error': 'ライブリスト取得エラー'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
@@ -125,6 +135,7 @@ def umamusume_list_by_live(request):
     """ライブのIDを引数として、紐づくウマ娘の情報をDBから取得するAPI
     * @param request HTTPリクエストオブジェクト
     * @param request.data.liveId ライブID
+    * @param request.query_params.fields 返すフィールド (カンマ区切り、省略時はすべて)
     * @return Response ウマ娘リストデータ
     """
     logger = UmamusumeLog(request)
@@ -134,7 +145,8 @@ def umamusume_list_by_live(request):
         live_id = request.data.get('liveId')
         vocal_umamusumes = VocalUmamusume.objects.filter(live_id=live_id).select_related('umamusume')
         umamusumes = [vu.umamusume for vu in vocal_umamusumes]
-        serializer = UmamusumeSerializer(umamusumes, many=True)
+        fields, _ = parse_sparse_fieldset(request.query_params)
+        serializer = UmamusumeSerializer(umamusumes, many=True, fields=fields)
         logger.logwrite('end', f'umamusumeListByLive - 取得件数:{len(serializer.data)} (liveId:{live_id})')
         return Response({'data': serializer.data})
     except Exception as e:
@@ -144,10 +156,12 @@ def umamusume_list_by_live(request):
 
 @api_view(['GET'])
 @permission_classes([IsAuthenticated])
+@cache_user_response
 def umamusume_regist_list(request):
     """ユーザーが登録していない、ウマ娘情報を取得するAPI
     * @param request HTTPリクエストオブジェクト
     * @param request.user.user_id ユーザーID
+    * @param request.query_params.fields 返すフィールド (カンマ区切り、省略時はすべて)
     * @return Response 未登録ウマ娘リストデータ
     """
     logger = UmamusumeLog(request)
@@ -157,7 +171,8 @@ def umamusume_regist_list(request):
         user_id = request.user.user_id
         regist_umamusume_ids = RegistUmamusume.objects.filter(user_id=user_id).values_list('umamusume_id', flat=True)
         umamusumes = Umamusume.objects.exclude(umamusume_id__in=regist_umamusume_ids).order_by('umamusume_name')
-        serializer = UmamusumeSerializer(umamusumes, many=True)
+        fields, _ = parse_sparse_fieldset(request.query_params)
+        serializer = UmamusumeSerializer(umamusumes, many=True, fields=fields)
         logger.logwrite('end', f'umamusumeRegistList - 未登録件数:{len(serializer.data)}')
         return Response({'data': serializer.data})
     except Exception as e:
@@ -167,6 +182,7 @@ def umamusume_regist_list(request):
 
 @api_view(['POST'])
 @permission_classes([IsAuthenticated])
+@bumps_data_version
 def umamusume_regist(request):
     """ユーザーが選択した、ウマ娘のデータを登録するAPI
     * @param request HTTPリクエストオブジェクト
@@ -192,13 +208,11 @@ def umamusume_regist(request):
             fans=fans
         )
         
-        for race_id in race_id_array:
-            RegistUmamusumeRace.objects.create(
-                user_id=user_id,
-                umamusume_id=umamusume_id,
-                race_id=race_id,
-                regist_date=timezone.now()
-            )
+        now = timezone.now()
+        RegistUmamusumeRace.objects.bulk_create([
+            RegistUmamusumeRace(user_id=user_id, umamusume_id=umamusume_id, race_id=race_id, regist_date=now)
+            for race_id in race_id_array
+        ])
         
         logger.logwrite('end', f'umamusumeRegist - 登録完了 umamusume_id:{umamusume_id}, レース数:{len(race_id_array)}')
         return Response({'message': 'ユーザーが登録されました。'}, status=status.HTTP_201_CREATED)
@@ -209,10 +223,13 @@ def umamusume_regist(request):
 
 @api_view(['GET'])
 @permission_classes([IsAuthenticated])
+@cache_user_response
 def user_regist_umamusume(request):
     """ユーザーが登録したウマ娘の情報を取得するAPI
     * @param request HTTPリクエストオブジェクト
     * @param request.user.user_id ユーザーID
+    * @param request.query_params.fields 返すフィールド (カンマ区切り、省略時はすべて)
+    * @param request.query_params.expand 展開する入れ子のフィールド (カンマ区切り、指定しないものはIDのみ。省略時はすべて展開)
     * @return Response 登録済みウマ娘リストデータ
     """
     logger = UmamusumeLog(request)
@@ -220,8 +237,12 @@ def user_regist_umamusume(request):
     
     try:
         user_id = request.user.user_id
-        regist_umamusumes = RegistUmamusume.objects.filter(user_id=user_id).select_related('umamusume')
-        serializer = RegistUmamusumeSerializer(regist_umamusumes, many=True)
+        fields, expand = parse_sparse_fieldset(request.query_params)
+        regist_umamusumes = RegistUmamusume.objects.filter(user_id=user_id)
+        # ウマ娘を展開する場合のみ結合して取得する
+        if is_field_requested(fields, 'umamusume') and is_field_requested(expand, 'umamusume'):
+            regist_umamusumes = regist_umamusumes.select_related('umamusume')
+        serializer = RegistUmamusumeSerializer(regist_umamusumes, many=True, fields=fields, expand=expand)
         logger.logwrite('end', f'userRegistUmamusume - 登録済み件数:{len(serializer.data)}')
         return Response({'data': serializer.data})
     except Exception as e:
@@ -231,6 +252,7 @@ def user_regist_umamusume(request):
 
 @api_view(['POST'])
 @permission_classes([IsAuthenticated])
+@bumps_data_version
 def fan_up(request):
     """ユーザーが入力したファン数をユーザーが登録したウマ娘データに反映させるAPI
     * @param request HTTPリクエストオブジェクト
@@ -257,6 +279,7 @@ def fan_up(request):
 
 @api_view(['POST'])
 @permission_classes([IsAuthenticated])
+@bumps_data_version
 def register_race_pattern(request):
     """選択されたレースパターンをまとめて登録するAPI
     * @param request HTTPリクエストオブジェクト
@@ -316,19 +339,18 @@ def register_race_pattern(request):
 def umamusume_list(request):
     """ウマ娘情報を取得するAPI
     * @param request HTTPリクエストオブジェクト
+    * @param request.query_params.fields 返すフィールド (カンマ区切り、省略時はすべて)
     * @return Response ウマ娘リストデータ
     """
     logger = UmamusumeLog(request)
     logger.logwrite('start', 'umamusumLList')
     
     try:
-        # umamusume_nameの五十音順でソートして取得
-        umamusumes = Umamusume.objects.all().order_by('umamusume_name')
-        
-        serializer = UmamusumeSerializer(umamusumes, many=True)
+        # umamusume_nameの五十音順でソートしたデータを取得
+        data = sparse_rows(get_catalog_snapshot('umamusume_list'), *parse_sparse_fieldset(request.query_params))
         
-        logger.logwrite('end', f'umamusumeList - 件数:{len(serializer.data)}')
-        return Response({'data': serializer.data})
+        logger.logwrite('end', f'umamusumeList - 件数:{len(data)}')
+        return Response({'data': data})
         
     except Exception as e:
         logger.logwrite('error', f'umamusumeList:{e}')
@@ -336,6 +358,7 @@ def umamusume_list(request):
 
 @api_view(['GET'])
 @permission_classes([AllowAny])
+@admission_control
 def calculate_parent_factors(request):
     """因子情報を取得するAPI
     * @param request HTTPリクエストオブジェクト
@@ -359,94 +382,19 @@ def calculate_parent_factors(request):
         grandparent_umamusume_id = int(request.GET.get('grandparent_umamusume_id', 2))
         grandmother_umamusume_id = int(request.GET.get('grandmother_umamusume_id', 3))
 
-        # IDを文字列に変換するマップ
-        DISTANCE_MAP = {1: "短距離", 2: "マイル", 3: "中距離", 4: "長距離"}
-        SURFACE_MAP = {1: "芝", 2: "ダート"}
-        STYLE_MAP = {1: "逃げ", 2: "先行", 3: "差し", 4: "追込"}
-
-        distance = DISTANCE_MAP.get(distance_id, "不明")
-        surface = SURFACE_MAP.get(surface_id, "不明")
-        style = STYLE_MAP.get(style_id, "不明")
-
-        # ウマ娘情報をDBから取得
-        parent_umamusume = Umamusume.objects.filter(umamusume_id=parent_umamusume_id).first()
-        grandparent_umamusume = Umamusume.objects.filter(umamusume_id=grandparent_umamusume_id).first()
-        grandmother_umamusume = Umamusume.objects.filter(umamusume_id=grandmother_umamusume_id).first()
-
-        # 祖父母Aの適性因子を計算
-        factor_a_1, factor_a_2 = calculate_aptitude_factors(grandparent_umamusume, surface, style)
-
-        # 祖父母Bの適性因子を計算
-        factor_b_1, factor_b_2 = calculate_aptitude_factors(grandmother_umamusume, surface, style)
-
-        # --- パターン生成ロジック ---
-        all_patterns = []
-
-        # 1. 各祖父母のメイン因子プールを決定
-        # 祖父母Aのメイン因子: サブ因子が「差し」x2なら「芝」x2、サブ因子が「芝」x2なら「差し」x2
-        main_a_pool = (surface, style)
-        if factor_a_1 == "差し" and factor_a_2 == "差し":
-            main_a_pool = ("芝", "芝")
-        elif factor_a_1 == "芝" and factor_a_2 == "芝":
-            main_a_pool = ("差し", "差し")
-
-        # 祖父母Bのメイン因子: 同様のロジック
-        main_b_pool = (surface, style)
-        if factor_b_1 == "差し" and factor_b_2 == "差し":
-            main_b_pool = ("芝", "芝")
-        elif factor_b_1 == "芝" and factor_b_2 == "芝":
-            main_b_pool = ("差し", "差し")
-
-        # 2. 各因子の組み合わせ(順列)を生成
-        main_a_perms = sorted(list(set(permutations(main_a_pool))))
-        sub_a_perms = sorted(list(set(permutations((factor_a_1, factor_a_2)))))
-        main_b_perms = sorted(list(set(permutations(main_b_pool))))
-        sub_b_perms = sorted(list(set(permutations((factor_b_1, factor_b_2)))))
-
-        # 3. MainとSubの全組み合わせを生成
-        for p_main_a in main_a_perms:
-            for p_sub_a in sub_a_perms:
-                for p_main_b in main_b_perms:
-                    for p_sub_b in sub_b_perms:
-                        # パターン1: 基本の組み合わせ
-                        grandparent_a_factors = {
-                            "aaa": p_main_a[0], "aba": p_main_a[1],
-                            "aab": p_sub_a[0], "abb": p_sub_a[1],
-                            "aa": factor_a_1, "ab": factor_a_2,
-                        }
-                        grandparent_b_factors = {
-                            "baa": p_main_b[0], "bba": p_main_b[1],
-                            "bab": p_sub_b[0], "bbb": p_sub_b[1],
-                            "ba": factor_b_1, "bb": factor_b_2,
-                        }
-                        all_patterns.append({"factors": {"grandparent_a": grandparent_a_factors, "grandparent_b": grandparent_b_factors}})
-
-                        # パターン2: 祖父母AとBのメイン因子を入れ替えた組み合わせ
-                        grandparent_a_factors_swapped = {
-                            "aaa": p_main_b[0], "aba": p_main_b[1], # Bのメイン因子を使用
-                            "aab": p_sub_a[0], "abb": p_sub_a[1],
-                            "aa": factor_a_1, "ab": factor_a_2,
-                        }
-                        grandparent_b_factors_swapped = {
-                            "baa": p_main_a[0], "bba": p_main_a[1], # Aのメイン因子を使用
-                            "bab": p_sub_b[0], "bbb": p_sub_b[1],
-                            "ba": factor_b_1, "bb": factor_b_2,
-                        }
-                        all_patterns.append({"factors": {"grandparent_a": grandparent_a_factors_swapped, "grandparent_b": grandparent_b_factors_swapped}})
-
-        # 最終的に生成されたパターンの中から重複を削除する
-        unique_patterns = []
-        seen_factors_str = set()
-        for p in all_patterns:
-            # factorsオブジェクトをJSON文字列に変換して比較
-            factors_str = json.dumps(p['factors'], sort_keys=True)
-            if factors_str not in seen_factors_str:
-                # パターン名を追加してユニークリストに追加
-                p["name"] = f"{len(unique_patterns) + 1}"
-                unique_patterns.append(p)
-                seen_factors_str.add(factors_str)
-
-        return Response({'data': {'patterns': unique_patterns}})
+        distance = FACTOR_DISTANCE_MAP.get(distance_id, "不明")
+        surface = FACTOR_SURFACE_MAP.get(surface_id, "不明")
+        style = FACTOR_STYLE_MAP.get(style_id, "不明")
+
+        # ウマ娘情報をDBから1クエリでまとめて取得
+        umamusumes = Umamusume.objects.in_bulk([parent_umamusume_id, grandparent_umamusume_id, grandmother_umamusume_id])
+        grandparent_profile = get_aptitude_profile(umamusumes.get(grandparent_umamusume_id))
+        grandmother_profile = get_aptitude_profile(umamusumes.get(grandmother_umamusume_id))
+
+        # 因子パターンは(祖父母の適性プロファイル, 馬場, 脚質)のみで決まるため、メモ化済みのテーブルから取得
+        unique_patterns = build_factor_patterns(grandparent_profile, grandmother_profile, surface, style)
+
+        return Response({'data': {'patterns': list(unique_patterns)}})
 
     except Exception as e:
         logger.logwrite('error', f'calculate_parent_factors:{e}')
@@ -454,6 +402,145 @@ def calculate_parent_factors(request):
 
 
 
+# 一括因子計算で受け付ける最大件数
+FACTOR_BATCH_MAX_SIZE = 100
+
+# 一括因子計算の各項目と省略時の既定値 (単体APIと同じ)
+FACTOR_BATCH_DEFAULTS = {
+    'parent_umamusume_id': 1,
+    'grandparent_umamusume_id': 2,
+    'grandmother_umamusume_id': 3,
+    'distance_id': 1,
+    'surface_id': 1,
+    'style_id': 1,
+}
+
+
+@api_view(['POST'])
+@permission_classes([AllowAny])
+@admission_control
+def calculate_parent_factors_batch(request):
+    """複数の血統候補の因子情報をまとめて取得するAPI
+    * @param request HTTPリクエストオブジェクト
+    * @param request.data.lineages 血統候補の配列
+    *        (各要素: parent_umamusume_id, grandparent_umamusume_id, grandmother_umamusume_id,
+    *         distance_id, surface_id, style_id)
+    * @return Response 血統候補ごとの因子情報データ (リクエストと同じ順序)
+    """
+    logger = UmamusumeLog(request)
+    logger.logwrite('start', 'calculate_parent_factors_batch')
+
+    try:
+        lineages = request.data.get('lineages')
+        if not isinstance(lineages, list) or not lineages:
+            logger.logwrite('error', 'calculate_parent_factors_batch - 不正なリクエスト: lineagesがありません。')
+            return Response({'error': '血統候補の配列は必須です。'}, status=status.HTTP_400_BAD_REQUEST)
+        if len(lineages) > FACTOR_BATCH_MAX_SIZE:
+            logger.logwrite('error', f'calculate_parent_factors_batch - 件数超過:{len(lineages)}')
+            return Response({'error': f'血統候補は{FACTOR_BATCH_MAX_SIZE}件までです。'}, status=status.HTTP_400_BAD_REQUEST)
+
+        # リクエストを正規化 (省略時は単体APIと同じ既定値)
+        candidates = []
+        for index, lineage in enumerate(lineages):
+            if not isinstance(lineage, dict):
+                logger.logwrite('error', f'calculate_parent_factors_batch - 不正な血統候補 index:{index}')
+                return Response({'error': '血統候補の形式が不正です。', 'index': index}, status=status.HTTP_400_BAD_REQUEST)
+            try:
+                candidates.append({
+                    field: int(lineage.get(field, default))
+                    for field, default in FACTOR_BATCH_DEFAULTS.items()
+                })
+            except (TypeError, ValueError):
+                logger.logwrite('error', f'calculate_parent_factors_batch - 数値でない項目 index:{index}')
+                return Response({'error': '血統候補の項目は整数で指定してください。', 'index': index}, status=status.HTTP_400_BAD_REQUEST)
+
+        # 参照される全ウマ娘を1クエリでまとめて取得
+        umamusume_ids = set()
+        for candidate in candidates:
+            umamusume_ids.update((
+                candidate['parent_umamusume_id'],
+                candidate['grandparent_umamusume_id'],
+                candidate['grandmother_umamusume_id'],
+            ))
+        profiles = {
+            umamusume_id: get_aptitude_profile(umamusume)
+            for umamusume_id, umamusume in Umamusume.objects.in_bulk(umamusume_ids).items()
+        }
+
+        # 因子パターンは適性プロファイル単位でメモ化されているため、同じ組み合わせは再計算されない
+        results = []
+        for candidate in candidates:
+            patterns = build_factor_patterns(
+                profiles.get(candidate['grandparent_umamusume_id']),
+                profiles.get(candidate['grandmother_umamusume_id']),
+                FACTOR_SURFACE_MAP.get(candidate['surface_id'], "不明"),
+                FACTOR_STYLE_MAP.get(candidate['style_id'], "不明"),
+            )
+            results.append({**candidate, 'patterns': list(patterns)})
+
+        logger.logwrite('end', f'calculate_parent_factors_batch - 計算件数:{len(results)}')
+        return Response({'data': results})
+
+    except Exception as e:
+        logger.logwrite('error', f'calculate_parent_factors_batch:{e}')
+        return Response({'error': '因子情報取得エラー'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
+# 血統検索で返却する最大件数
+LINEAGE_SEARCH_MAX_LIMIT = 50
+
+
+@api_view(['POST'])
+@permission_classes([IsAuthenticated])
+def search_lineage(request):
+    """ユーザーの所持ウマ娘から、目標に最適な祖父母の組み合わせを検索するAPI
+    * @param request HTTPリクエストオブジェクト
+    * @param request.user.user_id ユーザーID
+    * @param request.data.umamusumeId 育成対象のウマ娘ID
+    * @param request.data.distanceId 距離ID
+    * @param request.data.surfaceId 馬場ID
+    * @param request.data.styleId 脚質ID
+    * @param request.data.limit 取得件数 (省略時10件)
+    * @return Response スコア上位の血統候補リスト
+    """
+    logger = UmamusumeLog(request)
+    logger.logwrite('start', 'search_lineage')
+
+    try:
+        user_id = request.user.user_id
+        try:
+            umamusume_id = int(request.data.get('umamusumeId'))
+            distance_id = int(request.data.get('distanceId', 1))
+            surface_id = int(request.data.get('surfaceId', 1))
+            style_id = int(request.data.get('styleId', 1))
+            limit = min(int(request.data.get('limit', 10)), LINEAGE_SEARCH_MAX_LIMIT)
+        except (TypeError, ValueError):
+            logger.logwrite('error', 'search_lineage - 数値でない検索条件')
+            return Response({'error': '検索条件が不正です。'}, status=status.HTTP_400_BAD_REQUEST)
+
+        if (distance_id not in FACTOR_DISTANCE_MAP or surface_id not in FACTOR_SURFACE_MAP
+                or style_id not in FACTOR_STYLE_MAP or limit < 1):
+            logger.logwrite('error', f'search_lineage - 不正な検索条件 (distance:{distance_id}, surface:{surface_id}, style:{style_id}, limit:{limit})')
+            return Response({'error': '検索条件が不正です。'}, status=status.HTTP_400_BAD_REQUEST)
+
+        target_umamusume = Umamusume.objects.filter(umamusume_id=umamusume_id).first()
+        if not target_umamusume:
+            logger.logwrite('error', f'search_lineage - 対象のウマ娘が存在しません umamusume_id:{umamusume_id}')
+            return Response({'error': '対象のウマ娘が存在しません。'}, status=status.HTTP_400_BAD_REQUEST)
+
+        candidates = [
+            ru.umamusume for ru in RegistUmamusume.objects.filter(user_id=user_id).select_related('umamusume')
+        ]
+        lineages = search_best_lineages(target_umamusume, candidates, surface_id, distance_id, style_id, limit)
+
+        logger.logwrite('end', f'search_lineage - 候補数:{len(candidates)}, 取得件数:{len(lineages)} (umamusume_id:{umamusume_id})')
+        return Response({'data': lineages})
+
+    except Exception as e:
+        logger.logwrite('error', f'search_lineage:{e}')
+        return Response({'error': '血統検索エラー'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
 """ユーザー関連API群"""
 @api_view(['POST'])
 @permission_classes([AllowAny])
@@ -506,7 +593,7 @@ def user_login(request):
             return Response({'message': 'ユーザーが見つかりません。'}, status=status.HTTP_401_UNAUTHORIZED)
         
         if user.check_password(password):
-            refresh = RefreshToken.for_user(user)
+            refresh = issue_tokens(user)
             logger.logwrite('end', f'userLogin - ログイン成功 user_name:{user_name}')
             return Response({
                 'message': 'ログイン成功',
@@ -541,9 +628,11 @@ def user_logout(request):
 
 
 @api_view(['GET'])
+@authentication_classes([DatabaseJWTAuthentication])
 @permission_classes([IsAuthenticated])
 def get_user_data(request):
     """ログイン中のユーザー情報を取得するAPI
+    メールアドレスなどトークンに含まれない項目を返すため、ユーザーをDBから取得して認証する。
     * @param request HTTPリクエストオブジェクト
     * @param request.user ログインユーザー
     * @return Response ユーザー情報データ